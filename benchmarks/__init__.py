@@ -0,0 +1,55 @@
+import os
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Benchmarks are run from the project root with `python -m benchmarks.<name>`
+def setup_django():
+    if str(BASE_DIR) not in sys.path:
+        sys.path.insert(0, str(BASE_DIR))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'inventory_management_api.settings')
+
+    import django
+    django.setup()
+
+# Create a throwaway test database (in memory for SQLite unless a test_name
+# file is given) with every table. The tables are created from the models,
+# the user table included: the migrations don't manage it and their foreign
+# keys to it fail on a database that checks them (PostgreSQL). The data
+# migrations have nothing to fill in an empty database.
+def setup_database(test_name = None):
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    get_user_model()._meta.managed = True
+    connection.settings_dict['TEST']['MIGRATE'] = False
+
+    setup_test_environment()
+    if test_name is not None:
+        connection.settings_dict['TEST']['NAME'] = test_name
+    connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+
+def teardown_database(old_name = None):
+    from django.db import connection
+    connection.creation.destroy_test_db(old_name or connection.settings_dict['NAME'], verbosity = 0)
+
+# Count the statements executed on the default connection, without the
+# 9000 entries limit of CaptureQueriesContext
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        from django.db import connection
+        self.context = connection.execute_wrapper(self)
+        self.context.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.context.__exit__(*exc_info)
@@ -0,0 +1,149 @@
+# Every endpoint against stores seeded by seed_stores at increasing scales
+# (products and materials per store), recording the median and p95 latency,
+# the query count and the peak Python memory of one request. The JSON report
+# is stable so that two runs (e.g. two commits) can be diffed, or compared with
+# --compare.
+#
+#   python -m benchmarks.api --scales 10 100 1000 --output report.json
+#   python -m benchmarks.api --scales 10 100 1000 --compare report.json
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from . import setup_django, setup_database, teardown_database, QueryCounter
+from .sale_coalescer import percentile
+
+# (name, method, url, body builder of the seeded store)
+ENDPOINTS = [
+    ('material-list', 'get', '/material/', None),
+    ('material-inventory', 'get', '/material/inventory/', None),
+    ('material-restock-get', 'get', '/material/restock/', None),
+    ('material-restock-post', 'post', '/material/restock/', lambda store: {
+        'materials': [{'id': store['materials'][0], 'quantity': 1}], 'total_price': store['prices'][0],
+    }),
+    ('product-capacity', 'get', '/product/product-capacity/', None),
+    ('product-sale', 'post', '/product/sale/', lambda store: {
+        'sale': [{'product': store['products'][0], 'quantity': 1}],
+    }),
+    ('material-quantity-list', 'get', '/material-quantity/', None),
+]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(client, method, url, body, repeat):
+    def request():
+        if method == 'get':
+            return client.get(url)
+        return client.post(url, body, format = 'json')
+
+    # Warm the caches (token, store, matrix) before measuring
+    response = request()
+
+    with QueryCounter() as queries:
+        request()
+
+    tracemalloc.start()
+    request()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        request()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'status': response.status_code,
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 2),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+        'queries': queries.count,
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+# Each scale seeds its own stores in the same database
+def run_scale(scale, args):
+    from rest_framework.test import APIClient
+    from material.models import Material
+    from store.services.seed import seed_stores
+
+    start = time.perf_counter()
+    store = seed_stores(args.stores, scale, scale, bom_density = args.bom_density, stock = 30000, prefix = 'scale%d_' % scale)[0]
+    seconds = time.perf_counter() - start
+    store['prices'] = [Material.objects.get(pk = store['materials'][0]).price]
+
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION = 'Token %s' % store['token'])
+
+    results = []
+    for name, method, url, body in ENDPOINTS:
+        result = measure(client, method, url, body(store) if body else None, args.repeat)
+        results.append({'scale': scale, 'endpoint': name, **result})
+        print("%6d %-24s %3d  p50 %8.2f ms  p95 %8.2f ms  %4d queries  %9.1f KiB" % (
+            scale, name, result['status'], result['p50_ms'], result['p95_ms'], result['queries'], result['peak_kib']))
+
+    return results, seconds
+
+def compare(old, new):
+    previous = {(row['scale'], row['endpoint']): row for row in old['results']}
+    print("\nagainst %s:" % (old['meta'].get('commit') or 'the previous report'))
+    for row in new['results']:
+        before = previous.get((row['scale'], row['endpoint']))
+        if before is None:
+            continue
+        print("%6d %-24s p50 %+8.2f ms (%+.0f%%)  queries %+d  peak %+.1f KiB" % (
+            row['scale'], row['endpoint'], row['p50_ms'] - before['p50_ms'],
+            100 * (row['p50_ms'] - before['p50_ms']) / before['p50_ms'] if before['p50_ms'] else 0,
+            row['queries'] - before['queries'], row['peak_kib'] - before['peak_kib']))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type = int, nargs = '+', default = [10, 100, 1000], help = "Products and materials per store")
+    parser.add_argument('--stores', type = int, default = 2, help = "Stores seeded at each scale, the first one is requested")
+    parser.add_argument('--bom-density', type = float, default = 0.05)
+    parser.add_argument('--repeat', type = int, default = 20)
+    parser.add_argument('--output', help = "Write the JSON report to this file")
+    parser.add_argument('--compare', help = "Print the differences with this JSON report")
+    args = parser.parse_args()
+
+    setup_django()
+    import django
+    from django.conf import settings
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'stores': args.stores,
+            'bom_density': args.bom_density,
+            'repeat': args.repeat,
+        },
+        'seed_seconds': {},
+        'results': [],
+    }
+    setup_database()
+    for scale in args.scales:
+        results, seconds = run_scale(scale, args)
+        report['seed_seconds'][str(scale)] = round(seconds, 2)
+        report['results'].extend(results)
+    teardown_database()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# Latency of the BOM matrix capacity engine, without database access.
+#
+#   python -m benchmarks.capacity_matrix --products 10000 --materials 1000 --density 20
+import argparse
+import random
+import time
+
+from . import setup_django
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, sorted(timings)[len(timings) // 2]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type = int, default = 10000)
+    parser.add_argument('--materials', type = int, default = 1000)
+    parser.add_argument('--density', type = int, default = 20, help = "materials per product")
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    setup_django()
+    from product.services.capacity import BomMatrix
+
+    rng = random.Random(args.seed)
+    material_ids = list(range(1, args.materials + 1))
+    rows = []
+    for product_id in range(1, args.products + 1):
+        for material_id in sorted(rng.sample(material_ids, min(args.density, args.materials))):
+            rows.append((product_id, material_id, rng.randint(1, 20)))
+    current_capacities = [(material_id, rng.randint(0, 32767)) for material_id in material_ids]
+
+    matrix, build = timed(lambda: BomMatrix.from_rows(rows, material_ids), args.repeat)
+    vector, gather = timed(lambda: matrix.capacity_vector(current_capacities), args.repeat)
+    _, compute = timed(lambda: matrix.remaining_capacities(vector), args.repeat)
+
+    print("products=%d materials=%d entries=%d" % (args.products, args.materials, len(rows)))
+    print("build matrix (cache miss)  %8.2f ms" % (build * 1000))
+    print("capacity vector            %8.2f ms" % (gather * 1000))
+    print("remaining capacities       %8.2f ms" % (compute * 1000))
+
+if __name__ == '__main__':
+    main()
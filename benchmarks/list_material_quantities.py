@@ -0,0 +1,113 @@
+# GET /material/material-quantity/?page_size=N while the store grows from 10 to
+# 50,000 products, against the per-product OR chain the viewset used to build.
+# The table is shared with --other-stores stores of --other-products products
+# and a 10 products store is timed along. Exits with status 1 if the page
+# latency of the growing store, or of the small store, at the last size
+# exceeds --max-ratio times the first.
+#
+#   python -m benchmarks.list_material_quantities --sizes 10 1000 50000
+import argparse
+import sys
+import time
+
+from . import setup_django, setup_database, QueryCounter
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10, 100, 1000, 10000, 50000])
+    parser.add_argument('--materials-per-product', type = int, default = 3)
+    parser.add_argument('--page-size', type = int, default = 100)
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--max-ratio', type = float, default = 3.0)
+    # The OR chain grows quadratically, measure it on the small stores only
+    parser.add_argument('--before-max', type = int, default = 2000)
+    parser.add_argument('--other-stores', type = int, default = 3)
+    parser.add_argument('--other-products', type = int, default = 20000)
+    args = parser.parse_args()
+
+    setup_django()
+    setup_database()
+
+    from django.contrib.auth import get_user_model
+    from django.db import DatabaseError
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+    from store.models import Store
+    from product.models import Product
+    from material.models import Material, MaterialQuantity
+
+    def create_store(name, products):
+        user = get_user_model().objects.create_user(username = name, password = 'bench')
+        store = Store.objects.create(name = name, user = user)
+        materials = Material.objects.bulk_create(
+            Material(name = 'material%d' % i, store = store, price = 1, max_capacity = 100, current_capacity = 100)
+            for i in range(args.materials_per_product)
+        )
+        add_products(store, materials, 0, products)
+        client = APIClient()
+        client.force_authenticate(user = user)
+        return store, materials, client
+
+    def add_products(store, materials, start, end):
+        created = Product.objects.bulk_create(
+            Product(name = 'product%d' % i, store = store) for i in range(start, end)
+        )
+        MaterialQuantity.objects.bulk_create(
+            MaterialQuantity(product = product, material = material, quantity = 1, store = store)
+            for product in created for material in materials
+        )
+
+    store, materials, client = create_store('bench', 0)
+    for i in range(args.other_stores):
+        create_store('other%d' % i, args.other_products)
+    _, _, small_client = create_store('small', 10)
+    url = reverse('material_quantity-list')
+
+    # What get_queryset did before: one OR-ed filter per product of the store
+    def before():
+        material_queryset = MaterialQuantity.objects.none()
+        for product in Product.objects.filter(store = store):
+            material_queryset |= MaterialQuantity.objects.filter(product = product)
+        return list(material_queryset[:args.page_size])
+
+    def after():
+        return client.get(url, {'page_size': args.page_size})
+
+    results = []
+    products = 0
+    for size in sorted(args.sizes):
+        # Grow the catalogue up to size products
+        add_products(store, materials, products, size)
+        products = size
+
+        before_time = 'skipped'
+        if size <= args.before_max:
+            try:
+                before_time = '%8.1f ms' % (timed(before, 1) * 1000)
+            except DatabaseError as e:
+                before_time = 'failed (%s)' % e.__class__.__name__
+
+        with QueryCounter() as queries:
+            after()
+        after_time = timed(after, args.repeat)
+        small_time = timed(lambda: small_client.get(url, {'page_size': args.page_size}), args.repeat)
+        results.append((after_time, small_time))
+        print("products=%6d  before: %s  after: %8.1f ms  %d queries  small store: %6.1f ms" % (
+            size, before_time, after_time * 1000, queries.count, small_time * 1000), flush = True)
+
+    ratio = results[-1][0] / results[0][0]
+    small_ratio = results[-1][1] / results[0][1]
+    print("latency ratio %d -> %d products: bench store %.2f, small store %.2f" % (min(args.sizes), max(args.sizes), ratio, small_ratio))
+    if max(ratio, small_ratio) > args.max_ratio:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
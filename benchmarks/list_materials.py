@@ -0,0 +1,66 @@
+# GET /material/ with a large store: ModelSerializer rendering against the values() fast path.
+#
+#   python -m benchmarks.list_materials --materials 50000
+import argparse
+import time
+
+from . import setup_django, setup_database, QueryCounter
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, sorted(timings)[len(timings) // 2]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--materials', type = int, default = 50000)
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+
+    setup_django()
+    setup_database()
+
+    from django.contrib.auth import get_user_model
+    from django.urls import reverse
+    from rest_framework.renderers import JSONRenderer
+    from rest_framework.test import APIClient
+    from store.models import Store
+    from material.models import Material
+    from material.serializers import MaterialSerializer
+
+    user = get_user_model().objects.create_user(username = 'bench', password = 'bench')
+    store = Store.objects.create(name = 'bench', user = user)
+    Material.objects.bulk_create(
+        Material(name = 'material%d' % i, store = store, price = i % 100 + 0.5, max_capacity = 100, current_capacity = i % 100)
+        for i in range(args.materials)
+    )
+
+    # What GET /material/ did before: full ModelSerializer and DRF's JSONRenderer
+    def before():
+        materials = Material.objects.filter(store = Store.objects.get(user = user))
+        return JSONRenderer().render(MaterialSerializer(materials, many = True).data)
+
+    client = APIClient()
+    client.force_authenticate(user = user)
+    url = reverse('material-list')
+
+    def after():
+        return client.get(url).content
+
+    with QueryCounter() as before_queries:
+        before_body, before_time = timed(before, 1)
+    _, before_time = timed(before, args.repeat)
+
+    with QueryCounter() as after_queries:
+        after_body, after_time = timed(after, 1)
+    _, after_time = timed(after, args.repeat)
+
+    print("materials=%d" % args.materials)
+    print("before: %8.1f ms  %6d queries  %d bytes" % (before_time * 1000, before_queries.count, len(before_body)))
+    print("after:  %8.1f ms  %6d queries  %d bytes" % (after_time * 1000, after_queries.count, len(after_body)))
+
+if __name__ == '__main__':
+    main()
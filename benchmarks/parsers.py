@@ -0,0 +1,45 @@
+# Parse time of a sale payload, legacy form encoding against a JSON body.
+#
+#   python -m benchmarks.parsers --lines 10000
+import argparse
+import io
+import json
+import time
+
+from . import setup_django
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type = int, default = 10000)
+    parser.add_argument('--repeat', type = int, default = 7)
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework.parsers import JSONParser
+    from inventory_management_api.parsers import ORJSONParser, parse_form_item
+
+    sales = [{'product': i, 'quantity': i % 7 + 1} for i in range(args.lines)]
+    form_items = [str(sale) for sale in sales]
+    body = json.dumps({'sale': sales}).encode()
+
+    results = [
+        ("form, replace + json.loads", lambda: [json.loads(item.replace('\'', '"')) for item in form_items]),
+        ("form, parse_form_item", lambda: [parse_form_item(item) for item in form_items]),
+        ("json body, DRF JSONParser", lambda: JSONParser().parse(io.BytesIO(body))),
+        ("json body, ORJSONParser", lambda: ORJSONParser().parse(io.BytesIO(body))),
+    ]
+
+    print("lines=%d" % args.lines)
+    for name, function in results:
+        print("%-30s %8.2f ms" % (name, timed(function, args.repeat) * 1000))
+
+if __name__ == '__main__':
+    main()
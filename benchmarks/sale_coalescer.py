@@ -0,0 +1,103 @@
+# Concurrent sales of one product built from a few hot materials: the
+# per-request path (one transaction and guarded UPDATE per sale) against
+# the coalescer (one per micro-batch). Runs on a file SQLite database so
+# that every client thread has its own connection.
+#
+#   python -m benchmarks.sale_coalescer --clients 32 --sales 200
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from . import setup_django, setup_database, teardown_database
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(clients, sales, sell):
+    from django.db import connection
+
+    latencies = []
+    rejected = []
+    errors = set()
+    lock = threading.Lock()
+
+    def client():
+        timings = []
+        failures = 0
+        for _ in range(sales):
+            start = time.perf_counter()
+            try:
+                sell()
+            except Exception as e:
+                failures += 1
+                errors.add(e.__class__.__name__)
+            timings.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(timings)
+            rejected.append(failures)
+
+    threads = [threading.Thread(target = client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99), sum(rejected), errors
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type = int, default = 32)
+    parser.add_argument('--sales', type = int, default = 100, help = "Sales per client")
+    parser.add_argument('--materials', type = int, default = 3)
+    parser.add_argument('--max-batch', type = int, default = 100)
+    parser.add_argument('--max-delay', type = float, default = 0.002)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    settings.DATABASES['default'].setdefault('OPTIONS', {})['timeout'] = 60
+    database = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    setup_database(database)
+
+    from django.contrib.auth import get_user_model
+    from store.models import Store
+    from product.models import Product
+    from material.models import Material, MaterialQuantity
+    from product.services.sale import process_sales
+    from product.services.coalescer import SaleCoalescer
+
+    user = get_user_model().objects.create_user(username = 'bench', password = 'bench')
+    store = Store.objects.create(name = 'bench', user = user)
+    product = Product.objects.create(name = 'bench', store = store)
+    stock = args.clients * args.sales
+    for i in range(args.materials):
+        material = Material.objects.create(name = 'material%d' % i, store = store, price = 1, max_capacity = 32767, current_capacity = min(stock, 32767))
+        MaterialQuantity.objects.create(product = product, material = material, quantity = 1)
+    sales = [{'product': product.pk, 'quantity': 1}]
+
+    def restock():
+        Material.objects.filter(store = store).update(current_capacity = min(stock, 32767))
+
+    coalescer = SaleCoalescer(max_batch = args.max_batch, max_delay = args.max_delay)
+    paths = [
+        ('per-request', lambda: process_sales(sales, store = store)),
+        ('coalesced', lambda: coalescer.sell(sales, store, timeout = 60)),
+    ]
+
+    print("clients=%d sales/client=%d materials=%d" % (args.clients, args.sales, args.materials))
+    for name, sell in paths:
+        restock()
+        throughput, p50, p99, rejected, errors = run(args.clients, args.sales, sell)
+        print("%-12s %8.0f sales/s  p50 %7.2f ms  p99 %7.2f ms  %d failed %s" % (
+            name, throughput, p50 * 1000, p99 * 1000, rejected, ', '.join(sorted(errors))))
+
+    coalescer.stop()
+    teardown_database(database)
+
+if __name__ == '__main__':
+    main()
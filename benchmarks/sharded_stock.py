@@ -0,0 +1,81 @@
+# Concurrent sales of one hot material, used by every product of the store,
+# against its number of stock shards (0 is the unsharded material row). Runs
+# on a file SQLite database so that every client thread has its own
+# connection; SQLite locks the whole database for each write, so the shards
+# only pay off on a server database that locks rows (PostgreSQL, MySQL),
+# point DJANGO_SETTINGS_MODULE at one to compare. --hold-ms keeps every sale's
+# transaction open that long after the stock is taken, without using the CPU,
+# like the round trips to a remote database server would: the client threads
+# share one interpreter, and without it the CPU bounds the throughput before
+# the row locks do.
+#
+#   python -m benchmarks.sharded_stock --clients 16 --sales 100 --products 200 --hold-ms 5 --shards 0 1 4 16
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from . import setup_django, setup_database, teardown_database
+from .sale_coalescer import run
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type = int, default = 16)
+    parser.add_argument('--sales', type = int, default = 100, help = "Sales per client")
+    parser.add_argument('--products', type = int, default = 200, help = "Products using the hot material")
+    parser.add_argument('--hold-ms', type = float, default = 0, help = "Time each sale's transaction stays open")
+    parser.add_argument('--shards', type = int, nargs = '+', default = [0, 1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    database = None
+    if settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+        settings.DATABASES['default'].setdefault('OPTIONS', {})['timeout'] = 60
+        database = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    old_name = settings.DATABASES['default']['NAME']
+    setup_database(database)
+
+    from django.contrib.auth import get_user_model
+    from django.db import transaction
+    from store.models import Store
+    from product.models import Product
+    from material.models import Material, MaterialQuantity
+    from material.services.shards import shard_material, collapse_material
+    from product.services.bom import rebuild_explosions
+    from product.services.capacity import rebuild_product_capacities
+    from product.services.sale import process_sales
+
+    user = get_user_model().objects.create_user(username = 'bench', password = 'bench')
+    store = Store.objects.create(name = 'bench', user = user)
+    # Enough stock that a random shard is rarely short
+    stock = 32767
+    material = Material.objects.create(name = 'hot', store = store, price = 1, max_capacity = 32767, current_capacity = stock)
+    products = Product.objects.bulk_create(Product(name = 'bench%d' % i, store = store) for i in range(args.products))
+    MaterialQuantity.objects.bulk_create(MaterialQuantity(product = product, material = material, quantity = 1, store = store) for product in products)
+    product_ids = [product.pk for product in products]
+    rebuild_explosions(product_ids)
+    rebuild_product_capacities(store)
+
+    def sell():
+        with transaction.atomic():
+            process_sales([{'product': random.choice(product_ids), 'quantity': 1}], store = store)
+            time.sleep(args.hold_ms / 1000)
+
+    print("%s clients=%d sales/client=%d products=%d hold=%gms" % (
+        settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1], args.clients, args.sales, args.products, args.hold_ms))
+    for shards in args.shards:
+        collapse_material(material.pk)
+        Material.objects.filter(pk = material.pk).update(current_capacity = stock)
+        if shards:
+            shard_material(material.pk, shards)
+
+        throughput, p50, p99, rejected, errors = run(args.clients, args.sales, sell)
+        print("%2d shards %8.0f sales/s  p50 %7.2f ms  p99 %7.2f ms  %d failed %s" % (
+            shards, throughput, p50 * 1000, p99 * 1000, rejected, ', '.join(sorted(errors))))
+
+    teardown_database(database or old_name)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# Mixed sale, restock and inventory requests from many threads (and processes)
+# against stores seeded by seed_stores through the whole API stack, then checks that no stock
+# went negative or over max_capacity and that every unit is accounted for:
+# final stock = initial stock + accepted restocks - accepted sales, and the
+# stock matches its ledger balance. Any server error (a 5xx or an exception)
+# breaks an invariant too: valid requests must not fail. Exits with status 1
+# when an invariant breaks.
+#
+# SQLite runs on a temporary file so that every thread has its own connection;
+# point DJANGO_SETTINGS_MODULE at settings using PostgreSQL to stress row locks.
+#
+#   python -m benchmarks.stress --processes 2 --threads 8 --requests 200
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from . import setup_django, setup_database, teardown_database
+from .sale_coalescer import percentile
+
+# Time spent in the statements that lock rows, an upper bound of the lock waits
+class LockTimer:
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.startswith(('UPDATE', 'INSERT', 'DELETE')) and 'FOR UPDATE' not in sql:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+# Exploded recipes of every product {product_id: {material_id: quantity}}
+def load_all_recipes():
+    from product.models import ExplodedMaterialQuantity
+
+    recipes = defaultdict(dict)
+    for product_id, material_id, quantity in ExplodedMaterialQuantity.objects.values_list('product_id', 'material_id', 'quantity'):
+        recipes[product_id][material_id] = quantity
+    return recipes
+
+def client_thread(stores, recipes, requests, mix, seed_value, results):
+    from django.db import connection
+    from django.test import Client
+
+    rng = random.Random(seed_value)
+    timer = LockTimer()
+    samples = []
+    sold = defaultdict(int)
+    # Units of the sales answered 202, sold or not by the coalescer
+    pending = defaultdict(int)
+    restocked = defaultdict(int)
+    operations = [name for name, weight in mix.items() for _ in range(weight)]
+
+    with connection.execute_wrapper(timer):
+        for _ in range(requests):
+            store = rng.choice(stores)
+            # The test client re-raises the exceptions signalled by any thread, server errors are read from the status
+            client = Client(raise_request_exception = False, HTTP_AUTHORIZATION = 'Token %s' % store['token'])
+            operation = rng.choice(operations)
+            start = time.perf_counter()
+            try:
+                if operation == 'sale':
+                    product_id = rng.choice(store['products'])
+                    quantity = rng.randint(1, 3)
+                    response = client.post('/product/sale/', {'sale': [{'product': product_id, 'quantity': quantity}]}, content_type = 'application/json')
+                    accepted = response.status_code == 200 and 'message' in response.json()
+                    if accepted:
+                        for material_id, units in recipes[product_id].items():
+                            sold[material_id] += units * quantity
+                    elif response.status_code == 202:
+                        for material_id, units in recipes[product_id].items():
+                            pending[material_id] += units * quantity
+                elif operation == 'restock':
+                    material_id = rng.choice(store['materials'])
+                    quantity = rng.randint(1, 10)
+                    response = client.post('/material/restock/', {'materials': [{'id': material_id, 'quantity': quantity}], 'total_price': str(store['prices'][material_id] * quantity)}, content_type = 'application/json')
+                    accepted = response.status_code == 200 and 'message' in response.json()
+                    if accepted:
+                        restocked[material_id] += quantity
+                else:
+                    response = client.get('/material/inventory/')
+                    accepted = response.status_code == 200
+                outcome = 'ok' if accepted else 'pending' if response.status_code == 202 else 'error' if response.status_code >= 500 else 'rejected'
+            except Exception as e:
+                outcome = e.__class__.__name__
+            samples.append((operation, time.perf_counter() - start, outcome))
+
+    connection.close()
+    results.append((samples, dict(sold), dict(pending), dict(restocked), timer.seconds))
+
+def client_process(args):
+    stores, recipes, threads, requests, mix, seed_value = args
+    from django.db import connections
+    connections.close_all()
+
+    results = []
+    workers = [
+        threading.Thread(target = client_thread, args = (stores, recipes, requests, mix, seed_value * 1000 + i, results))
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+def check_invariants(initial, sold, pending, restocked):
+    from material.models import Material
+    from material.services.ledger import stock_balances
+    from material.services.shards import stock_expression
+
+    failures = []
+    balances = stock_balances()
+    for material_id, stock, max_capacity in Material.objects.annotate(stock = stock_expression()).values_list('id', 'stock', 'max_capacity'):
+        expected = initial[material_id] + restocked.get(material_id, 0) - sold.get(material_id, 0)
+        if stock < 0 or stock > max_capacity:
+            failures.append("material %d: stock %d outside of 0..%d" % (material_id, stock, max_capacity))
+        if not expected - pending.get(material_id, 0) <= stock <= expected:
+            failures.append("material %d: stock %d, expected %d from the accepted requests (%d units pending)" % (
+                material_id, stock, expected, pending.get(material_id, 0)))
+        if stock != balances[material_id]:
+            failures.append("material %d: stock %d, ledger balance %d" % (material_id, stock, balances[material_id]))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type = int, default = 1)
+    parser.add_argument('--threads', type = int, default = 8, help = "Client threads per process")
+    parser.add_argument('--requests', type = int, default = 100, help = "Requests per thread")
+    parser.add_argument('--stores', type = int, default = 2)
+    parser.add_argument('--products', type = int, default = 20)
+    parser.add_argument('--materials', type = int, default = 10)
+    parser.add_argument('--bom-density', type = float, default = 0.3, help = "Fraction of the materials used by each product")
+    parser.add_argument('--stock', type = int, default = 500, help = "Initial stock of every material")
+    parser.add_argument('--mix', default = 'sale=6,restock=2,inventory=2', help = "Weights of the operations")
+    args = parser.parse_args()
+    mix = {name: int(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+
+    setup_django()
+    from django.conf import settings
+    from django.db import connections
+    # Server errors are counted and fail the run, they aren't logged
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    database = None
+    if settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+        settings.DATABASES['default'].setdefault('OPTIONS', {})['timeout'] = 30
+        database = os.path.join(tempfile.mkdtemp(), 'stress.sqlite3')
+    old_name = settings.DATABASES['default']['NAME']
+    setup_database(database)
+
+    from material.models import Material
+    from material.services.shards import stock_expression
+    from store.services.seed import seed_stores
+
+    stores = seed_stores(args.stores, args.products, args.materials, bom_density = args.bom_density, stock = args.stock, prefix = 'stress')
+    recipes = load_all_recipes()
+    prices = dict(Material.objects.values_list('id', 'price'))
+    for store in stores:
+        store['prices'] = {material_id: prices[material_id] for material_id in store['materials']}
+    initial = dict(Material.objects.annotate(stock = stock_expression()).values_list('id', 'stock'))
+    connections.close_all()
+
+    jobs = [(stores, recipes, args.threads, args.requests, mix, p) for p in range(args.processes)]
+    start = time.perf_counter()
+    if args.processes == 1:
+        results = [client_process(jobs[0])]
+    else:
+        with multiprocessing.get_context('fork').Pool(args.processes) as pool:
+            results = pool.map(client_process, jobs)
+    elapsed = time.perf_counter() - start
+
+    samples = []
+    sold = defaultdict(int)
+    pending = defaultdict(int)
+    restocked = defaultdict(int)
+    lock_seconds = 0.0
+    for process_results in results:
+        for thread_samples, thread_sold, thread_pending, thread_restocked, thread_lock_seconds in process_results:
+            samples.extend(thread_samples)
+            for material_id, units in thread_sold.items():
+                sold[material_id] += units
+            for material_id, units in thread_pending.items():
+                pending[material_id] += units
+            for material_id, units in thread_restocked.items():
+                restocked[material_id] += units
+            lock_seconds += thread_lock_seconds
+
+    print("processes=%d threads=%d requests/thread=%d stores=%d products=%d materials=%d" % (
+        args.processes, args.threads, args.requests, args.stores, args.products, args.materials))
+    print("%d requests in %.2f s: %.0f requests/s, %.2f s in locking statements" % (
+        len(samples), elapsed, len(samples) / elapsed, lock_seconds))
+    for operation in mix:
+        latencies = [latency for name, latency, _ in samples if name == operation]
+        if not latencies:
+            continue
+        outcomes = defaultdict(int)
+        for name, _, outcome in samples:
+            if name == operation:
+                outcomes[outcome] += 1
+        print("%-10s %6d  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  %s" % (
+            operation, len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000, ' '.join('%s=%d' % item for item in sorted(outcomes.items()))))
+
+    failures = check_invariants(initial, sold, pending, restocked)
+    errors = defaultdict(int)
+    for operation, _, outcome in samples:
+        if outcome not in ('ok', 'pending', 'rejected'):
+            errors[(operation, outcome)] += 1
+    for (operation, outcome), count in sorted(errors.items()):
+        failures.append("%d %s requests failed with %s" % (count, operation, outcome))
+    for failure in failures:
+        print("INVARIANT BROKEN: %s" % failure)
+    if not failures:
+        print("Invariants hold: no server error, no negative stock, every unit accounted for, stock matches the ledger")
+
+    teardown_database(database or old_name)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
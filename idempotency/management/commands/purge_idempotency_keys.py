@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from idempotency.storage import get_storage
+
+class Command(BaseCommand):
+    help = "Remove the expired Idempotency-Key records, run it periodically"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type = int, default = 1000, help = "Records removed per DELETE")
+
+    def handle(self, *args, **options):
+        count = get_storage().purge_expired(batch_size = options['batch_size'])
+        self.stdout.write("Purged %d expired idempotency records" % count)
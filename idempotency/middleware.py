@@ -0,0 +1,78 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+
+from .storage import get_storage, idempotency_settings
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+MUTATING_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+# Honour the Idempotency-Key header on mutating requests: the first response
+# is stored with a hash of the request and replayed to the retries sent with
+# the same key, a duplicate arriving while the first request is processed
+# waits for its response instead of running the view again.
+class IdempotencyMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.options = idempotency_settings()
+        self.storage = get_storage()
+
+    def __call__(self, request):
+        idempotency_key = request.META.get(HEADER)
+        if not idempotency_key or request.method not in MUTATING_METHODS:
+            return self.get_response(request)
+
+        key = self.scoped_key(request, idempotency_key)
+        fingerprint = self.fingerprint(request)
+
+        # The claim when this request owns the key, else the owner's record
+        claimed, result = self.storage.claim(key, fingerprint)
+        if not claimed:
+            return self.replay(key, fingerprint, result)
+
+        try:
+            response = self.get_response(request)
+        except Exception:
+            self.storage.release(key, result)
+            raise
+
+        # Server errors and streamed responses aren't replayed, a retry runs again
+        if response.status_code >= 500 or response.streaming:
+            self.storage.release(key, result)
+        else:
+            self.storage.complete(key, result, response.status_code, response.get('Content-Type', ''), response.content)
+        return response
+
+    # Keys of different clients never collide
+    def scoped_key(self, request, idempotency_key):
+        scope = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME, '')
+        return hashlib.sha256(('%s\n%s' % (scope, idempotency_key)).encode()).hexdigest()
+
+    def fingerprint(self, request):
+        digest = hashlib.blake2b(digest_size = 16)
+        digest.update(request.method.encode())
+        digest.update(request.get_full_path().encode())
+        digest.update(request.body)
+        return digest.hexdigest()
+
+    def replay(self, key, fingerprint, record):
+        if record.fingerprint != fingerprint:
+            return JsonResponse({'error_messages': "Idempotency-Key was used for a different request"}, status = 422)
+
+        # Wait for the first request to store its response
+        deadline = time.monotonic() + self.options['WAIT_TIMEOUT']
+        while record is not None and record.status_code is None:
+            if time.monotonic() >= deadline:
+                return JsonResponse({'error_messages': "A request with this Idempotency-Key is in progress"}, status = 409)
+            time.sleep(self.options['POLL_INTERVAL'])
+            record = self.storage.get(key)
+
+        # The first request failed and released the key
+        if record is None:
+            return JsonResponse({'error_messages': "A request with this Idempotency-Key failed, please retry"}, status = 409)
+
+        response = HttpResponse(bytes(record.content or b''), status = record.status_code, content_type = record.content_type or None)
+        response['Idempotent-Replayed'] = 'true'
+        return response
@@ -0,0 +1,16 @@
+from django.db import models
+
+# Response of the first request sent with an Idempotency-Key, replayed to its retries.
+# A record without status_code is still being processed by the first request.
+class IdempotencyRecord(models.Model):
+    class Meta:
+        db_table = "idempotency_record"
+
+    # sha256 of the client scope and the Idempotency-Key
+    key = models.CharField(max_length = 64, unique = True)
+    # Hash of the method, path and body of the first request
+    fingerprint = models.CharField(max_length = 32)
+    status_code = models.PositiveSmallIntegerField(null = True)
+    content_type = models.CharField(max_length = 100, blank = True, default = '')
+    content = models.BinaryField(null = True)
+    expires_at = models.DateTimeField(db_index = True)
@@ -0,0 +1,147 @@
+import secrets
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import IdempotencyRecord
+
+DEFAULTS = {
+    'BACKEND': 'idempotency.storage.DatabaseStorage',
+    'CACHE_ALIAS': 'default',
+    # Seconds a stored response is replayed
+    'TTL': 24 * 60 * 60,
+    # Seconds before the claim of a request that never finished can be taken over
+    'LOCK_TIMEOUT': 30,
+    # Seconds a duplicate waits for the in-flight request
+    'WAIT_TIMEOUT': 10,
+    'POLL_INTERVAL': 0.05,
+}
+
+def idempotency_settings():
+    return {**DEFAULTS, **getattr(settings, 'IDEMPOTENCY', {})}
+
+# Storage interface:
+#   claim(key, fingerprint) -> (True, claim) when the caller must process the request,
+#                              (False, record) when another request owns the key
+#   get(key) -> record or None
+#   complete(key, claim, status_code, content_type, content) stores the response
+#   release(key, claim) forgets the claim of a request that failed
+#   purge_expired(batch_size) removes the expired records
+# complete() and release() only act while the caller's claim holds: once a
+# slow request's claim was taken over, its response doesn't replace the one
+# of the request that took over.
+class DatabaseStorage:
+    def __init__(self, options):
+        self.ttl = timedelta(seconds = options['TTL'])
+        self.lock_timeout = timedelta(seconds = options['LOCK_TIMEOUT'])
+
+    # One INSERT on the unique key for a new key, the SELECT only runs for
+    # duplicates. The claim is the expiry of the lease it wrote.
+    def claim(self, key, fingerprint):
+        while True:
+            now = timezone.now()
+            lease = now + self.lock_timeout
+            try:
+                with transaction.atomic():
+                    IdempotencyRecord.objects.create(key = key, fingerprint = fingerprint, expires_at = lease)
+                return True, lease
+            except IntegrityError:
+                pass
+
+            record = self.get(key, expired = True)
+            if record is None:
+                # Purged in between, try again
+                continue
+            if record.expires_at > now:
+                return False, record
+
+            # Expired response or abandoned claim: take it over unless someone else just did
+            taken = IdempotencyRecord.objects.filter(pk = record.pk, expires_at = record.expires_at).update(
+                fingerprint = fingerprint, status_code = None, content_type = '', content = None,
+                expires_at = lease,
+            )
+            if taken:
+                return True, lease
+
+    def get(self, key, expired = False):
+        records = IdempotencyRecord.objects.filter(key = key)
+        if not expired:
+            records = records.filter(expires_at__gt = timezone.now())
+        return records.first()
+
+    def complete(self, key, claim, status_code, content_type, content):
+        IdempotencyRecord.objects.filter(key = key, status_code = None, expires_at = claim).update(
+            status_code = status_code, content_type = content_type, content = content,
+            expires_at = timezone.now() + self.ttl,
+        )
+
+    def release(self, key, claim):
+        IdempotencyRecord.objects.filter(key = key, status_code = None, expires_at = claim).delete()
+
+    # Each batch is one range scan of the expires_at index and one DELETE
+    def purge_expired(self, batch_size = 1000):
+        now = timezone.now()
+        total = 0
+        while True:
+            ids = list(IdempotencyRecord.objects.filter(expires_at__lte = now).values_list('id', flat = True)[:batch_size])
+            if ids:
+                total += IdempotencyRecord.objects.filter(pk__in = ids).delete()[0]
+            if len(ids) < batch_size:
+                return total
+
+# Records kept in a Django cache, claimed with the atomic cache.add() of a
+# random claim token. Expiry is left to the cache backend. Without a compare
+# and set, complete() and release() check the token then write: a takeover
+# landing in between isn't seen.
+class CacheStorage:
+    def __init__(self, options):
+        self.cache = caches[options['CACHE_ALIAS']]
+        self.ttl = options['TTL']
+        self.lock_timeout = options['LOCK_TIMEOUT']
+
+    def make_key(self, key):
+        return 'idempotency:%s' % key
+
+    def claim(self, key, fingerprint):
+        while True:
+            claim = secrets.token_hex(8)
+            if self.cache.add(self.make_key(key), (fingerprint, None, '', None, claim), self.lock_timeout):
+                return True, claim
+            record = self.get(key)
+            if record is not None:
+                return False, record
+
+    def get(self, key):
+        value = self.cache.get(self.make_key(key))
+        if value is None:
+            return None
+
+        fingerprint, status_code, content_type, content, _ = value
+        return IdempotencyRecord(key = key, fingerprint = fingerprint, status_code = status_code, content_type = content_type, content = content)
+
+    # The pending record while the claim holds, None once it was taken over
+    def held(self, key, claim):
+        value = self.cache.get(self.make_key(key))
+        if value is not None and value[1] is None and value[4] == claim:
+            return value
+        return None
+
+    def complete(self, key, claim, status_code, content_type, content):
+        value = self.held(key, claim)
+        if value is not None:
+            self.cache.set(self.make_key(key), (value[0], status_code, content_type, content, claim), self.ttl)
+
+    def release(self, key, claim):
+        if self.held(key, claim) is not None:
+            self.cache.delete(self.make_key(key))
+
+    def purge_expired(self, batch_size = 1000):
+        return 0
+
+def get_storage():
+    options = idempotency_settings()
+    return import_string(options['BACKEND'])(options)
@@ -0,0 +1,144 @@
+import threading
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from store.models import Store
+from product.models import Product
+from material.models import Material, MaterialQuantity
+from .middleware import IdempotencyMiddleware
+from .models import IdempotencyRecord
+from .storage import DatabaseStorage, idempotency_settings
+
+User = get_user_model()
+
+CACHE_STORAGE = {'BACKEND': 'idempotency.storage.CacheStorage', 'WAIT_TIMEOUT': 5, 'POLL_INTERVAL': 0.01}
+
+class IdempotentSaleTest(APITestCase):
+    def setUp(self):
+        user = User.objects.create_user(username = 'admin', password = 'password')
+        store = Store.objects.create(name = 'store1', user = user)
+        self.product = Product.objects.create(name = 'product1', store = store)
+        self.material = Material.objects.create(name = 'material1', price = 1, store = store, max_capacity = 100, current_capacity = 50)
+        MaterialQuantity.objects.create(product = self.product, material = self.material, quantity = 5)
+        self.client.force_authenticate(user = user)
+
+    def sale(self, quantity = 1, key = 'key-1'):
+        data = {'sale': [{'product': self.product.pk, 'quantity': quantity}]}
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return self.client.post(reverse('product-sale'), data, format = 'json', **headers)
+
+    def stock(self):
+        return Material.objects.get(pk = self.material.pk).current_capacity
+
+    def test_retry_is_replayed_without_selling_twice(self):
+        first = self.sale()
+        retry = self.sale()
+        self.assertEqual(self.stock(), 45)
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    def test_different_keys_and_no_key_are_processed(self):
+        self.sale(key = 'key-1')
+        self.sale(key = 'key-2')
+        self.sale(key = None)
+        self.sale(key = None)
+        self.assertEqual(self.stock(), 30)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.sale(quantity = 1)
+        response = self.sale(quantity = 2)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.stock(), 45)
+
+    def test_expired_key_is_processed_again(self):
+        self.sale()
+        IdempotencyRecord.objects.update(expires_at = timezone.now() - timedelta(seconds = 1))
+        self.sale()
+        self.assertEqual(self.stock(), 40)
+
+class IdempotencyMiddlewareTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.calls = 0
+
+    def request(self, body = b'{}'):
+        return self.factory.post('/product/sale/', body, content_type = 'application/json', HTTP_IDEMPOTENCY_KEY = 'key-1')
+
+    def test_server_errors_are_not_replayed(self):
+        def view(request):
+            self.calls += 1
+            return HttpResponse(status = 503)
+
+        middleware = IdempotencyMiddleware(view)
+        middleware(self.request())
+        middleware(self.request())
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(IdempotencyRecord.objects.count(), 0)
+
+    @override_settings(IDEMPOTENCY = CACHE_STORAGE)
+    def test_concurrent_duplicate_waits_for_the_first_response(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        def view(request):
+            self.calls += 1
+            started.set()
+            finish.wait(5)
+            return HttpResponse(b'{"message": "Sale Successfully"}', content_type = 'application/json')
+
+        middleware = IdempotencyMiddleware(view)
+        middleware.storage.cache.clear()
+        first = threading.Thread(target = middleware, args = (self.request(), ))
+        first.start()
+        started.wait(5)
+
+        # The duplicate arrives while the first request is in flight
+        threading.Timer(0.1, finish.set).start()
+        response = middleware(self.request())
+        first.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(response.content, b'{"message": "Sale Successfully"}')
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+
+class DatabaseStorageTest(TestCase):
+    def test_purge_expired_in_batches(self):
+        now = timezone.now()
+        IdempotencyRecord.objects.bulk_create(
+            IdempotencyRecord(key = 'key-%d' % i, fingerprint = 'f', expires_at = now + timedelta(seconds = -1 if i < 5 else 60))
+            for i in range(7)
+        )
+        storage = DatabaseStorage(idempotency_settings())
+        self.assertEqual(storage.purge_expired(batch_size = 2), 5)
+        self.assertEqual(IdempotencyRecord.objects.count(), 2)
+
+    def test_claim_of_a_new_key_is_one_query(self):
+        storage = DatabaseStorage(idempotency_settings())
+        with CaptureQueriesContext(connection) as queries:
+            claimed, record = storage.claim('key-1', 'f')
+        self.assertTrue(claimed)
+        # Savepoints aside, a single INSERT
+        self.assertEqual([query['sql'].split()[0] for query in queries if 'SAVEPOINT' not in query['sql']], ['INSERT'])
+        self.assertEqual(storage.claim('key-1', 'f')[0], False)
+
+    def test_request_taken_over_does_not_overwrite_the_response(self):
+        storage = DatabaseStorage(idempotency_settings())
+        _, slow = storage.claim('key-1', 'f')
+
+        # The slow request outlives its lock, a retry takes the key over and answers
+        IdempotencyRecord.objects.filter(key = 'key-1').update(expires_at = timezone.now() - timedelta(seconds = 1))
+        claimed, retry = storage.claim('key-1', 'f')
+        self.assertTrue(claimed)
+        storage.complete('key-1', retry, 201, 'application/json', b'retry')
+
+        storage.complete('key-1', slow, 201, 'application/json', b'slow')
+        storage.release('key-1', slow)
+        self.assertEqual(bytes(storage.get('key-1').content), b'retry')
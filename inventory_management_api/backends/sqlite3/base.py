@@ -0,0 +1,8 @@
+from django.db.backends.sqlite3 import base
+
+# SQLite with transactions taking the write lock when they begin. A deferred
+# transaction that read first fails at once with "database is locked" when it
+# writes while another writer holds the lock, instead of waiting for it.
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
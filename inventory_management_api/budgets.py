@@ -0,0 +1,44 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# Viewsets declare the most queries each of their actions may run once the
+# token and store caches are warm, whatever the number of rows:
+#
+#     query_budgets = {'list': 2, 'retrieve': 1, ...}
+#
+# Every routed action needs a budget. inventory_management_api/tests.py
+# checks them against small and large stores.
+
+# Transaction bookkeeping (atomic blocks) isn't counted
+TRANSACTION_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT', 'BEGIN', 'COMMIT', 'ROLLBACK')
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+def query_budget(viewset, action):
+    budget = getattr(viewset, 'query_budgets', {}).get(action)
+    if budget is None:
+        raise QueryBudgetExceeded("%s.%s has no query budget" % (viewset.__name__, action))
+    return budget
+
+# Statements run inside the block, without the transaction bookkeeping
+class CountQueries(CaptureQueriesContext):
+    def __init__(self):
+        super().__init__(connection)
+
+    @property
+    def statements(self):
+        return [query['sql'] for query in self.captured_queries if not query['sql'].startswith(TRANSACTION_STATEMENTS)]
+
+def format_statements(statements):
+    return '\n'.join('%d. %s' % (i, sql) for i, sql in enumerate(statements, start = 1))
+
+def check_budget(label, budget, statements):
+    if len(statements) > budget:
+        raise QueryBudgetExceeded("%s ran %d queries, its budget is %d:\n%s" % (label, len(statements), budget, format_statements(statements)))
+
+# The query count mustn't grow with the number of rows
+def check_flat(label, small, large):
+    if len(large) > len(small):
+        raise QueryBudgetExceeded("%s ran %d queries on the small store and %d on the large one:\n%s" % (
+            label, len(small), len(large), format_statements(large)))
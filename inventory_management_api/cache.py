@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Process-local mapping keeping at most maxsize entries, least recently
+# used first out, each entry expiring ttl seconds after it was set
+class TTLCache:
+    def __init__(self, maxsize = 1024, ttl = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self.data[key]
+                return default
+
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last = False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+# Same interface on top of a Django cache alias, shared by every process
+# using the backend. Keys are prefixed so several caches can share an alias.
+class DjangoCache:
+    def __init__(self, alias = 'default', prefix = '', ttl = 60):
+        self.alias = alias
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def make_key(self, key):
+        return '%s%s' % (self.prefix, key)
+
+    def get(self, key, default = None):
+        return self.cache.get(self.make_key(key), default)
+
+    def set(self, key, value):
+        self.cache.set(self.make_key(key), value, self.ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+    def clear(self):
+        self.cache.clear()
+
+# Build a cache from a settings dict:
+# {'BACKEND': 'local', 'MAXSIZE': ..., 'TTL': ...} or
+# {'BACKEND': 'django', 'ALIAS': ..., 'TTL': ...}
+def build_cache(config, prefix = ''):
+    ttl = config.get('TTL', 60)
+    if config.get('BACKEND', 'local') == 'django':
+        return DjangoCache(alias = config.get('ALIAS', 'default'), prefix = prefix, ttl = ttl)
+    return TTLCache(maxsize = config.get('MAXSIZE', 1024), ttl = ttl)
@@ -0,0 +1,53 @@
+import ast
+
+import orjson
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+class ORJSONParser(BaseParser):
+    media_type = 'application/json'
+
+    def parse(self, stream, media_type = None, parser_context = None):
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as e:
+            raise ParseError('JSON parse error - %s' % e)
+
+# Legacy form clients post every item as the repr() of a dict,
+# JSON encoded items are accepted as well
+def parse_form_item(item):
+    if not isinstance(item, str):
+        return item
+
+    # Without double quotes or escapes, the strings of a repr() are single
+    # quoted and contain no quote: swapping the quotes makes the same JSON.
+    # Anything else is tried as JSON as it is, then as a Python literal.
+    text = item
+    if '"' not in item and '\\' not in item:
+        text = item.replace("'", '"')
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+
+    try:
+        return ast.literal_eval(item)
+    except (ValueError, SyntaxError):
+        raise ParseError('Invalid item - %s' % item)
+
+# Items of a JSON array body, of the key of a JSON object body,
+# or of a repeated form field
+def parse_items(data, key):
+    if isinstance(data, list):
+        return data
+
+    if hasattr(data, 'getlist'):
+        return [parse_form_item(item) for item in data.getlist(key)]
+
+    if not isinstance(data, dict):
+        raise ParseError('Expected an object or a list of items')
+
+    items = data.get(key, [])
+    if not isinstance(items, list):
+        raise ParseError('Expected a list of items in %s' % key)
+    return items
@@ -0,0 +1,31 @@
+from decimal import Decimal
+
+import orjson
+from django.utils.functional import Promise
+from rest_framework.renderers import BaseRenderer
+
+# Types orjson doesn't serialize natively, rendered like DRF's JSONEncoder does
+def default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, Promise):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    raise TypeError("Type is not JSON serializable: %s" % type(obj).__name__)
+
+class ORJSONRenderer(BaseRenderer):
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type = None, renderer_context = None):
+        if data is None:
+            return b''
+        return orjson.dumps(data, default = default, option = orjson.OPT_NON_STR_KEYS)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,18 +44,23 @@ INSTALLED_APPS = [
     'store',
     'product',
     'material',
+    'idempotency',
+    'monitoring',
 ]
 
 AUTH_USER_MODEL = 'user.User'
 
 MIDDLEWARE = [
+    'monitoring.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'monitoring.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'idempotency.middleware.IdempotencyMiddleware',
 ]
 
 ROOT_URLCONF = 'inventory_management_api.urls'
@@ -81,13 +87,32 @@ WSGI_APPLICATION = 'inventory_management_api.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# SQLite transactions begin IMMEDIATE, see inventory_management_api.backends.sqlite3.
+# Requests aren't atomic: the writes open their own transactions (services,
+# Model.save() of the inventory models) and the reads don't hold the lock.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'inventory_management_api.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
     }
 }
 
+# INVENTORY_CACHE_URL (e.g. redis://localhost:6379/1, any Redis compatible
+# server, the redis package is needed) shares the inventory cache between
+# the worker processes, each process keeps its own otherwise
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'inventory': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['INVENTORY_CACHE_URL'],
+    } if os.environ.get('INVENTORY_CACHE_URL') else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'inventory',
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -134,5 +159,130 @@ REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-    ]
-}
\ No newline at end of file
+    ],
+    "DEFAULT_RENDERER_CLASSES": [
+        'inventory_management_api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        'inventory_management_api.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
+# Engine computing GET /product/product-capacity/: 'table', 'matrix' or 'sql'
+PRODUCT_CAPACITY_ENGINE = 'table'
+
+# Seconds a cached BOM matrix is trusted by other worker processes
+BOM_MATRIX_CACHE_TTL = 60
+
+# Per-process LRU cache of user -> store, the TTL bounds how long
+# other worker processes may keep serving a stale entry
+STORE_CACHE = {
+    'MAXSIZE': 10000,
+    'TTL': 300,
+}
+
+# Token -> user and store cache of CachedTokenAuthentication: 'django' to
+# share the ALIAS of CACHES when it is Redis, otherwise a per-process LRU
+# whose short TTL bounds how long the other workers keep accepting a deleted
+# token or a deactivated user
+TOKEN_AUTH_CACHE = {
+    'BACKEND': 'django',
+    'ALIAS': 'inventory',
+    'TTL': 300,
+} if os.environ.get('INVENTORY_CACHE_URL') else {
+    'BACKEND': 'local',
+    'MAXSIZE': 10000,
+    'TTL': 5,
+}
+
+# Seconds a reservation holds its materials before the sweeper gives them back
+RESERVATION_TTL = 900
+# Longest ttl a client may ask for
+RESERVATION_MAX_TTL = 24 * 60 * 60
+
+# Idempotency-Key handling of the mutating requests, the records are kept in
+# the idempotency_record table or, with idempotency.storage.CacheStorage,
+# in the CACHE_ALIAS cache (which must be shared by every worker)
+IDEMPOTENCY = {
+    'BACKEND': 'idempotency.storage.DatabaseStorage',
+    'TTL': 24 * 60 * 60,
+    'LOCK_TIMEOUT': 30,
+    'WAIT_TIMEOUT': 10,
+}
+
+# Apply the sales in micro-batches of at most MAX_BATCH sales collected for
+# MAX_DELAY seconds, each request waiting at most TIMEOUT seconds for its result
+SALE_COALESCING = {
+    'ENABLED': False,
+    'MAX_BATCH': 100,
+    'MAX_DELAY': 0.005,
+    'TIMEOUT': 5,
+}
+
+# shard_stock spreads the stock of the materials with more than SHARD_ABOVE
+# stock movements in the last WINDOW seconds over SHARDS rows (None only
+# shards on demand) and collapses the sharded ones back below COLLAPSE_BELOW
+STOCK_SHARDING = {
+    'SHARDS': 8,
+    'WINDOW': 60,
+    'SHARD_ABOVE': None,
+    'COLLAPSE_BELOW': 30,
+}
+
+# Per route request metrics exposed at /metrics in the Prometheus text
+# format. With METRICS_DIR (a directory shared by the worker processes) every
+# process writes its metrics there every FLUSH_INTERVAL seconds and /metrics
+# adds up the metrics of all of them. METRICS_TOKEN is the bearer token the
+# scraper must send, None leaves /metrics open.
+#
+# Staff users profile a request by sending the PROFILE_HEADER header (or
+# PROFILE_SAMPLE_RATE of their requests are profiled) with the PROFILER,
+# 'cprofile' or 'sampling'. The last MAX_PROFILES profiles are kept in
+# PROFILE_DIR and served to the staff at /profiles/.
+#
+# Statements taking SLOW_QUERY_SECONDS or more are logged by the
+# monitoring.slow_queries logger, once per fingerprint and hour with their
+# plan, and aggregated at /slow-queries/ (staff only).
+MONITORING = {
+    'METRICS': True,
+    'METRICS_DIR': None,
+    'FLUSH_INTERVAL': 5,
+    'METRICS_TOKEN': None,
+    'PROFILE_HEADER': 'X-Profile',
+    'PROFILE_SAMPLE_RATE': 0,
+    'PROFILER': 'cprofile',
+    'PROFILE_DIR': None,
+    'MAX_PROFILES': 50,
+    'EXPLAIN_SLOWEST': 5,
+    'SLOW_QUERY_SECONDS': 0.1,
+    'SLOW_QUERY_ANALYZE': False,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'monitoring': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# Read-through cache of GET /material/inventory/, /material/restock/ and
+# /product/product-capacity/ in the ALIAS cache, keyed by the inventory
+# version of the store which every write to its inventory bumps
+INVENTORY_CACHE = {
+    'ENABLED': True,
+    'ALIAS': 'inventory',
+    'TTL': 300,
+}
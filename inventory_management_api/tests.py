@@ -0,0 +1,177 @@
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+from django.urls import get_resolver, URLResolver
+from store.models import Store
+from store.services.seed import seed_stores
+from store.views import StoreViewSet
+from material.models import MaterialQuantity
+from material.views import MaterialViewSet, MaterialQuantityViewSet
+from product.models import Product, ProductComponent
+from product.services.reservation import reserve
+from product.views import ProductViewSet, ProductComponentViewSet, ReservationViewSet
+from monitoring.views import ProfileViewSet, SlowQueryViewSet
+from .budgets import CountQueries, QueryBudgetExceeded, query_budget, check_budget, check_flat
+
+# (viewset, action, method, path, body) of one request of the seeded store s
+SCENARIOS = [
+    (StoreViewSet, 'list', 'get', lambda s: '/store/', None),
+    (StoreViewSet, 'retrieve', 'get', lambda s: '/store/%d/' % s['store'], None),
+    (StoreViewSet, 'create', 'post', lambda s: '/store/', lambda s: {'name': 'other'}),
+    (StoreViewSet, 'update', 'put', lambda s: '/store/%d/' % s['user'], lambda s: {'name': 'renamed'}),
+    (StoreViewSet, 'partial_update', 'patch', lambda s: '/store/%d/' % s['user'], lambda s: {'name': 'patched'}),
+
+    (MaterialViewSet, 'list', 'get', lambda s: '/material/', None),
+    (MaterialViewSet, 'retrieve', 'get', lambda s: '/material/%d/' % s['materials'][0], None),
+    (MaterialViewSet, 'create', 'post', lambda s: '/material/', lambda s: {'name': 'new', 'price': 1, 'max_capacity': 10}),
+    (MaterialViewSet, 'restock', 'get', lambda s: '/material/restock/', None),
+    (MaterialViewSet, 'restock', 'post', lambda s: '/material/restock/', lambda s: {
+        'materials': [{'id': s['materials'][0], 'quantity': 1}, {'id': s['materials'][1], 'quantity': 1}], 'total_price': s['restock_price'],
+    }),
+    (MaterialViewSet, 'update', 'put', lambda s: '/material/%d/' % s['materials'][0], lambda s: {'price': 2}),
+    (MaterialViewSet, 'partial_update', 'patch', lambda s: '/material/%d/' % s['materials'][0], lambda s: {'price': 3}),
+    (MaterialViewSet, 'inventory', 'get', lambda s: '/material/inventory/', None),
+
+    (MaterialQuantityViewSet, 'list', 'get', lambda s: '/material-quantity/?page_size=20', None),
+    (MaterialQuantityViewSet, 'retrieve', 'get', lambda s: '/material-quantity/%d/' % s['material_quantity'], None),
+    (MaterialQuantityViewSet, 'create', 'post', lambda s: '/material-quantity/', lambda s: {
+        'product': s['product_names'][-1], 'material': 'new', 'quantity': 1,
+    }),
+    (MaterialQuantityViewSet, 'update', 'put', lambda s: '/material-quantity/%d/' % s['material_quantity'], lambda s: {
+        'product': s['product_names'][0], 'material': s['material_quantity_material'], 'quantity': 2,
+    }),
+    (MaterialQuantityViewSet, 'partial_update', 'patch', lambda s: '/material-quantity/%d/' % s['material_quantity'], lambda s: {'quantity': 3}),
+    (MaterialQuantityViewSet, 'bulk', 'post', lambda s: '/material-quantity/bulk/', lambda s: {
+        'recipes': [{'product': name, 'materials': [{'material': 'material0', 'quantity': 1}]} for name in s['product_names'][-2:]],
+    }),
+
+    (ProductViewSet, 'list', 'get', lambda s: '/product/', None),
+    (ProductViewSet, 'retrieve', 'get', lambda s: '/product/%d/' % s['products'][0], None),
+    (ProductViewSet, 'create', 'post', lambda s: '/product/', lambda s: {'name': 'new'}),
+    (ProductViewSet, 'update', 'put', lambda s: '/product/%d/' % s['products'][0], lambda s: {'name': 'renamed'}),
+    (ProductViewSet, 'partial_update', 'patch', lambda s: '/product/%d/' % s['products'][0], lambda s: {'name': 'patched'}),
+    (ProductViewSet, 'product_capacity', 'get', lambda s: '/product/product-capacity/', None),
+    (ProductViewSet, 'sale', 'post', lambda s: '/product/sale/', lambda s: {
+        'sale': [{'product': s['products'][2], 'quantity': 1}, {'product': s['products'][3], 'quantity': 1}],
+    }),
+
+    (ProductComponentViewSet, 'list', 'get', lambda s: '/product-component/', None),
+    (ProductComponentViewSet, 'retrieve', 'get', lambda s: '/product-component/%d/' % s['component'], None),
+    (ProductComponentViewSet, 'create', 'post', lambda s: '/product-component/', lambda s: {
+        'parent': s['product_names'][4], 'component': s['product_names'][5], 'quantity': 1,
+    }),
+    (ProductComponentViewSet, 'update', 'put', lambda s: '/product-component/%d/' % s['component'], lambda s: {
+        'parent': s['product_names'][2], 'component': s['product_names'][3], 'quantity': 2,
+    }),
+    (ProductComponentViewSet, 'partial_update', 'patch', lambda s: '/product-component/%d/' % s['component'], lambda s: {'quantity': 3}),
+
+    (ReservationViewSet, 'list', 'get', lambda s: '/reservation/', None),
+    (ReservationViewSet, 'retrieve', 'get', lambda s: '/reservation/%d/' % s['reservations'][0], None),
+    (ReservationViewSet, 'create', 'post', lambda s: '/reservation/', lambda s: {
+        'sale': [{'product': s['products'][2], 'quantity': 1}, {'product': s['products'][3], 'quantity': 1}],
+    }),
+    (ReservationViewSet, 'commit', 'post', lambda s: '/reservation/%d/commit/' % s['reservations'][0], None),
+    (ReservationViewSet, 'cancel', 'post', lambda s: '/reservation/%d/cancel/' % s['reservations'][1], None),
+
+    # No profile is saved, the store's user is staff
+    (ProfileViewSet, 'list', 'get', lambda s: '/profiles/', None),
+    (ProfileViewSet, 'retrieve', 'get', lambda s: '/profiles/20260101T000000000000-00000000/', None),
+    (ProfileViewSet, 'download', 'get', lambda s: '/profiles/20260101T000000000000-00000000/download/', None),
+    (SlowQueryViewSet, 'list', 'get', lambda s: '/slow-queries/', None),
+
+    (ProductComponentViewSet, 'destroy', 'delete', lambda s: '/product-component/%d/' % s['component'], None),
+    (MaterialQuantityViewSet, 'destroy', 'delete', lambda s: '/material-quantity/%d/' % s['material_quantity'], None),
+    (ProductViewSet, 'destroy', 'delete', lambda s: '/product/%d/' % s['products'][0], None),
+    (MaterialViewSet, 'destroy', 'delete', lambda s: '/material/%d/' % s['materials'][0], None),
+    (StoreViewSet, 'destroy', 'delete', lambda s: '/store/%d/' % s['user'], None),
+]
+
+User = get_user_model()
+
+@override_settings(MONITORING = {'PROFILE_DIR': tempfile.mkdtemp()})
+class QueryBudgetTest(APITestCase):
+    def seed(self, prefix, size, bom_density):
+        s = seed_stores(1, size, size, bom_density = bom_density, stock = 1000, prefix = prefix)[0]
+        store = Store.objects.get(pk = s['store'])
+        s['user'] = store.user_id
+        User.objects.filter(pk = store.user_id).update(is_staff = True)
+        s['product_names'] = list(Product.objects.filter(pk__in = s['products']).order_by('id').values_list('name', flat = True))
+        s['restock_price'] = str(sum(store.material_entries.filter(pk__in = s['materials'][:2]).values_list('price', flat = True)))
+
+        material_quantity = MaterialQuantity.objects.filter(product_id = s['products'][0]).select_related('material').first()
+        s['material_quantity'] = material_quantity.pk
+        s['material_quantity_material'] = material_quantity.material.name
+        s['component'] = ProductComponent.objects.create(parent_id = s['products'][0], component_id = s['products'][1], quantity = 1).pk
+        s['reservations'] = [
+            reserve([{'product': s['products'][2], 'quantity': 1}], store).pk
+            for _ in range(2)
+        ]
+        return s
+
+    def request(self, s, method, path, body):
+        self.client.credentials(HTTP_AUTHORIZATION = 'Token %s' % s['token'])
+        # The versions bumped on commit count too
+        with CountQueries() as queries, self.captureOnCommitCallbacks(execute = True):
+            response = getattr(self.client, method)(path(s), body(s) if body else None, format = 'json')
+        self.assertLess(response.status_code, 500)
+        return queries.statements
+
+    def test_every_action_has_a_budget(self):
+        actions = set()
+        for pattern in get_resolver().url_patterns:
+            if not isinstance(pattern, URLResolver):
+                continue
+            for url in pattern.url_patterns:
+                cls = getattr(url.callback, 'cls', None)
+                for action in (getattr(url.callback, 'actions', None) or {}).values():
+                    actions.add((cls, action))
+
+        for cls, action in actions:
+            query_budget(cls, action)
+        self.assertEqual({(cls, action) for cls, action, *_ in SCENARIOS}, actions)
+
+    def test_budgets_hold_at_small_and_large_volumes(self):
+        # Every material is used by every product of the small store,
+        # by about 12 products of the large one
+        small = self.seed('small', 6, 1)
+        large = self.seed('large', 60, 0.2)
+
+        # Warm the token and store caches
+        for s in (small, large):
+            self.request(s, 'get', lambda s: '/store/', None)
+
+        for cls, action, method, path, body in SCENARIOS:
+            label = '%s %s %s' % (cls.__name__, action, method.upper())
+            with self.subTest(label):
+                budget = query_budget(cls, action)
+                small_statements = self.request(small, method, path, body)
+                large_statements = self.request(large, method, path, body)
+                check_budget(label, budget, small_statements)
+                check_budget(label, budget, large_statements)
+                check_flat(label, small_statements, large_statements)
+
+    def test_budget_failure_lists_the_queries(self):
+        with self.assertRaisesRegex(QueryBudgetExceeded, r"ran 2 queries, its budget is 1:\n1\. SELECT 1\n2\. SELECT 2"):
+            check_budget('view', 1, ['SELECT 1', 'SELECT 2'])
+        with self.assertRaisesRegex(QueryBudgetExceeded, "ran 1 queries on the small store and 2 on the large one"):
+            check_flat('view', ['SELECT 1'], ['SELECT 1', 'SELECT 2'])
+
+class ImmediateTransactionTest(TransactionTestCase):
+    # The write lock is taken by BEGIN, not by the first write after a read
+    def test_transactions_begin_immediate(self):
+        with CaptureQueriesContext(connection) as queries, transaction.atomic():
+            Store.objects.exists()
+        self.assertEqual(queries.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+    # Requests aren't atomic, a read doesn't take the write lock
+    def test_reads_open_no_transaction(self):
+        store = seed_stores(1, 2, 2, prefix = 'reads')[0]
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token %s' % store['token']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/material/inventory/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('BEGIN IMMEDIATE', [query['sql'] for query in queries.captured_queries])
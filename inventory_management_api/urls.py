@@ -22,4 +22,5 @@ urlpatterns = [
     path('', include('store.urls')),
     path('', include('product.urls')),
     path('', include('material.urls')),
+    path('', include('monitoring.urls')),
 ]
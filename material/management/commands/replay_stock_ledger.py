@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Store
+from material.services.ledger import replay_stores
+
+class Command(BaseCommand):
+    help = "Rebuild the stock of every material from the stock ledger, one store per worker process"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store', type = int, action = 'append', help = "Only replay this store id, can be repeated")
+        parser.add_argument('--workers', type = int, default = None, help = "Number of worker processes, defaults to the CPU count")
+
+    def handle(self, *args, **options):
+        store_ids = options['store'] or list(Store.objects.order_by('id').values_list('id', flat = True))
+
+        for store_id, changed in replay_stores(store_ids, workers = options['workers']):
+            self.stdout.write("Store %d: %d materials corrected" % (store_id, changed))
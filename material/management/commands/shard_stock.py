@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from material.services.shards import shard_material, collapse_material, rebalance_shards
+
+class Command(BaseCommand):
+    help = "Shard or collapse the stock of a material, or of the materials whose sales contention changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--material', type = int, help = "Only change this material id")
+        parser.add_argument('--shards', type = int, help = "Shards of the material, 0 collapses it")
+        parser.add_argument('--interval', type = float, help = "Keep rebalancing, sleeping this many seconds between runs")
+
+    def handle(self, *args, **options):
+        sharding = getattr(settings, 'STOCK_SHARDING', {})
+        shards = options['shards'] if options['shards'] is not None else sharding.get('SHARDS', 8)
+
+        if options['material'] is not None:
+            if shards:
+                shard_material(options['material'], shards)
+            else:
+                collapse_material(options['material'])
+            self.stdout.write("Material %d has %d stock shards" % (options['material'], shards))
+            return
+
+        while True:
+            sharded, collapsed = rebalance_shards(
+                window = sharding.get('WINDOW', 60),
+                shard_above = sharding.get('SHARD_ABOVE'),
+                collapse_below = sharding.get('COLLAPSE_BELOW', 0),
+                shards = shards,
+            )
+            self.stdout.write("Sharded %d and collapsed %d materials" % (len(sharded), len(collapsed)))
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from material.models import Material
+from material.services.ledger import take_snapshots
+
+class Command(BaseCommand):
+    help = "Fold the stock movements into a new snapshot of every material, run it periodically"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store', type = int, help = "Only snapshot the materials of this store id")
+
+    def handle(self, *args, **options):
+        materials = Material.objects.all()
+        if options['store'] is not None:
+            materials = materials.filter(store_id = options['store'])
+
+        count = take_snapshots(materials)
+        self.stdout.write("Took %d stock snapshots" % count)
@@ -0,0 +1,61 @@
+# Generated by Django 4.1.3 on 2026-10-18 04:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# Open the ledger with the stock every material already holds
+def open_stock_ledger(apps, schema_editor):
+    Material = apps.get_model('material', 'Material')
+    StockMovement = apps.get_model('material', 'StockMovement')
+
+    StockMovement.objects.bulk_create(
+        StockMovement(material_id = material_id, delta = current_capacity, reason = 'adjustment')
+        for material_id, current_capacity in Material.objects.filter(current_capacity__gt = 0).values_list('id', 'current_capacity')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('material', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.IntegerField()),
+                ('movement_id', models.BigIntegerField(default=0)),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_snapshots', to='material.material')),
+            ],
+            options={
+                'db_table': 'stock_snapshot',
+            },
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.IntegerField()),
+                ('reason', models.CharField(choices=[('sale', 'Sale'), ('restock', 'Restock'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='material.material')),
+            ],
+            options={
+                'db_table': 'stock_movement',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='stocksnapshot',
+            index=models.Index(fields=['material', '-movement_id'], name='stock_snaps_materia_96262d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stockmovement',
+            index=models.Index(fields=['material', 'id'], name='stock_movem_materia_6ae81f_idx'),
+        ),
+        migrations.RunPython(open_stock_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.1.3 on 2026-10-18 05:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('material', '0003_reservation_reasons'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='material',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StockShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('quantity', models.PositiveSmallIntegerField(default=0)),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_shards', to='material.material')),
+            ],
+            options={
+                'db_table': 'stock_shard',
+                'unique_together': {('material', 'index')},
+            },
+        ),
+    ]
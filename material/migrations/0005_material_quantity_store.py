@@ -0,0 +1,39 @@
+# Generated by Django 4.1.3 on 2026-10-18 07:45
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+# Copy the store of the product on every existing recipe row
+def fill_material_quantity_store(apps, schema_editor):
+    MaterialQuantity = apps.get_model('material', 'MaterialQuantity')
+    Product = apps.get_model('product', 'Product')
+
+    MaterialQuantity.objects.update(store_id = Subquery(Product.objects.filter(pk = OuterRef('product_id')).values('store_id')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0003_inventory_modified'),
+        ('material', '0004_stock_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='materialquantity',
+            name='store',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='material_quantity_entries', to='store.store'),
+        ),
+        migrations.RunPython(fill_material_quantity_store, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='materialquantity',
+            name='store',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='material_quantity_entries', to='store.store'),
+        ),
+        migrations.AddIndex(
+            model_name='materialquantity',
+            index=models.Index(fields=['store', 'product', 'material'], name='material_qu_store_i_3bf4d0_idx'),
+        ),
+    ]
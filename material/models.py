@@ -1,5 +1,8 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from store.models import Store
+from store.querysets import InventoryQuerySet
+from product.services.deletion import deletion
 from product.models import Product
 
 class Material(models.Model):
@@ -10,18 +13,104 @@ class Material(models.Model):
     def __str__(self):
         return self.name
 
+    # Cascades through the recipes, see product.services.deletion
+    def delete(self, *args, **kwargs):
+        with deletion():
+            return super().delete(*args, **kwargs)
+
+    # The row, its ledger movement and the capacities commit together
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     name = models.CharField(max_length = 40)   
     store = models.ForeignKey(Store, on_delete = models.CASCADE, related_name = "material_entries")
     price = models.DecimalField(max_digits = 20, decimal_places = 2)
     max_capacity = models.PositiveSmallIntegerField(default = 0)
     current_capacity = models.PositiveSmallIntegerField(default = 0)
+    # Number of StockShard rows holding part of the stock, 0 when the stock is only in current_capacity
+    shard_count = models.PositiveSmallIntegerField(default = 0)
     product = models.ManyToManyField(Product, through = "MaterialQuantity", related_name = "material_entries")
 
+    objects = InventoryQuerySet.as_manager()
+    store_lookup = 'store'
+
+    # Remember the stock read from the database so that a save() can be recorded in the ledger
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_current_capacity = instance.__dict__.get('current_capacity')
+        return instance
+
 class MaterialQuantity(models.Model):
     class Meta:
         db_table = "material_quantity"
         unique_together = ['product', 'material']
+        # A store's recipes are read in (product, material) order from the index
+        indexes = [models.Index(fields = ['store', 'product', 'material'])]
 
     product = models.ForeignKey(Product, on_delete = models.CASCADE, related_name = "product_material_quantity")
     material = models.ForeignKey(Material, on_delete = models.CASCADE, related_name = "material_material_quantity")
     quantity = models.PositiveSmallIntegerField(default = 0)
+    # Store of the product, set by save(), bulk writers set it themselves. The
+    # rows are deleted along with their product, the store doesn't collect them.
+    store = models.ForeignKey(Store, on_delete = models.DO_NOTHING, related_name = "material_quantity_entries")
+
+    objects = InventoryQuerySet.as_manager()
+    store_lookup = 'store'
+
+    # The row and the rebuilt exploded BOM commit together
+    def save(self, *args, **kwargs):
+        if self.store_id is None:
+            self.store_id = self.product.store_id
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+# Part of the stock of a contended material: sales take it from a random shard
+# instead of all locking the material row, see material.services.shards
+class StockShard(models.Model):
+    class Meta:
+        db_table = "stock_shard"
+        unique_together = ['material', 'index']
+
+    material = models.ForeignKey(Material, on_delete = models.CASCADE, related_name = "stock_shards")
+    index = models.PositiveSmallIntegerField()
+    quantity = models.PositiveSmallIntegerField(default = 0)
+
+    objects = InventoryQuerySet.as_manager()
+    store_lookup = 'material__store'
+
+# Append-only ledger of every change of Material.current_capacity
+class StockMovement(models.Model):
+    class Meta:
+        db_table = "stock_movement"
+        indexes = [models.Index(fields = ['material', 'id'])]
+
+    SALE = 'sale'
+    RESTOCK = 'restock'
+    ADJUSTMENT = 'adjustment'
+    RESERVATION = 'reservation'
+    RELEASE = 'release'
+    REASON_CHOICES = [
+        (SALE, 'Sale'),
+        (RESTOCK, 'Restock'),
+        (ADJUSTMENT, 'Adjustment'),
+        (RESERVATION, 'Reservation'),
+        (RELEASE, 'Release'),
+    ]
+
+    material = models.ForeignKey(Material, on_delete = models.CASCADE, related_name = "stock_movements")
+    delta = models.IntegerField()
+    reason = models.CharField(max_length = 20, choices = REASON_CHOICES)
+    created_at = models.DateTimeField(default = timezone.now)
+
+# Balance of a material once every movement up to movement_id has been folded in
+class StockSnapshot(models.Model):
+    class Meta:
+        db_table = "stock_snapshot"
+        indexes = [models.Index(fields = ['material', '-movement_id'])]
+
+    material = models.ForeignKey(Material, on_delete = models.CASCADE, related_name = "stock_snapshots")
+    balance = models.IntegerField()
+    movement_id = models.BigIntegerField(default = 0)
+    taken_at = models.DateTimeField(default = timezone.now)
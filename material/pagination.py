@@ -0,0 +1,8 @@
+from product.pagination import IdCursorPagination
+
+# Cursor pagination in (product, material) order. DRF's cursor holds the
+# product of the last row and an offset within that product's rows: a page
+# starts from the index at that product, the offset is bounded by the
+# materials of one product instead of the rows before it
+class MaterialQuantityCursorPagination(IdCursorPagination):
+    ordering = ('product_id', 'material_id')
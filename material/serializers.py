@@ -1,5 +1,11 @@
+from collections import defaultdict
+
+from django.db import transaction
 from rest_framework import serializers
-from .models import Material, MaterialQuantity
+from .models import Material, MaterialQuantity, StockMovement
+from .services.stock import apply_stock_deltas, StockError
+from .services.recipes import upsert_recipes
+from .services.shards import stock_expression
 from product.models import Product
 
 class MaterialSerializer(serializers.ModelSerializer):
@@ -10,6 +16,13 @@ class MaterialSerializer(serializers.ModelSerializer):
         model = Material
         fields = ['id', 'name', 'price', 'store', 'max_capacity', 'current_capacity', 'percentage_of_capacity']
 
+    # Sharded materials hold part of their stock outside of current_capacity
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if getattr(instance, 'stock', None) is not None:
+            data['current_capacity'] = instance.stock
+        return data
+
     def validate_max_capacity(self, value):
         if value < 0:
             raise serializers.ValidationError({"Please enter a valid value"})
@@ -28,6 +41,30 @@ class MaterialSerializer(serializers.ModelSerializer):
 
         return data
 
+    # Only the edited fields are written. The stock belongs to the stock
+    # services: writing back the current_capacity read before would undo
+    # the sales and restocks committed since.
+    def update(self, instance, validated_data):
+        validated_data.pop('current_capacity', None)
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        instance.save(update_fields = list(validated_data))
+        return instance
+
+# Read-only representation of MaterialSerializer built from a values() row
+class MaterialListSerializer(serializers.BaseSerializer):
+    values = ['id', 'name', 'price', 'store__name', 'max_capacity', 'stock']
+
+    def to_representation(self, row):
+        return {
+            'id': row['id'],
+            'name': row['name'],
+            'price': format(row['price'], '.2f'),
+            'store': row['store__name'],
+            'max_capacity': row['max_capacity'],
+            'current_capacity': row['stock'],
+        }
+
 class MaterialQuantitySerializer(serializers.ModelSerializer):
     product = serializers.SlugRelatedField(queryset = Product.objects.all(), slug_field = 'name')
     material = serializers.SlugRelatedField(queryset = Material.objects.all(), slug_field = 'name')
@@ -36,11 +73,61 @@ class MaterialQuantitySerializer(serializers.ModelSerializer):
         model = MaterialQuantity
         fields = ['id', 'product', 'material', 'quantity']
 
+    # Names are only unique within a store, resolve them among the store's products and materials
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        store = self.context.get('store')
+        if store is not None:
+            self.fields['product'].queryset = Product.objects.filter(store = store)
+            self.fields['material'].queryset = Material.objects.filter(store = store)
+
     def validate_quantity(self, value):
         if value < 0:
             raise serializers.ValidationError("Please enter a valid value")
         return value
 
+# Validates every restock line with one IN query and applies them with one guarded UPDATE
+class MaterialsListSerializer(serializers.ListSerializer):
+    def validate(self, data):
+        # Merge the lines restocking the same material
+        quantities = defaultdict(int)
+        for line in data:
+            quantities[line['id']] += line['quantity']
+
+        materials = Material.objects.filter(pk__in = quantities.keys()).annotate(stock = stock_expression())
+        # Lock the rows until the restock is applied when validating inside a transaction
+        if not transaction.get_autocommit():
+            materials = materials.select_for_update()
+        materials = {material.pk: material for material in materials}
+
+        # Check whether materials exist in the store of the user
+        store = self.context.get('store')
+        for material_id in quantities:
+            material = materials.get(material_id)
+            if material is None or (store is not None and material.store_id != store.pk):
+                raise serializers.ValidationError({'material': "Material doesn't exists!"})
+
+        # Check whether restock quantity will exceed max_capacity
+        for material_id, quantity in quantities.items():
+            material = materials[material_id]
+            if material.stock + quantity > material.max_capacity:
+                raise serializers.ValidationError({'error_messages': "Invalid restock quantity"})
+
+        for line in data:
+            line['material'] = materials[line['id']]
+        return data
+
+    def create(self, validated_data):
+        quantities = defaultdict(int)
+        for line in validated_data:
+            quantities[line['id']] += line['quantity']
+
+        try:
+            apply_stock_deltas(quantities, StockMovement.RESTOCK)
+        except StockError:
+            raise serializers.ValidationError({'error_messages': "Invalid restock quantity"})
+        return [line['material'] for line in validated_data]
+
 class MaterialsSerializer(serializers.ModelSerializer):
     quantity = serializers.IntegerField(required = True)
     id = serializers.IntegerField(required = True)
@@ -48,6 +135,7 @@ class MaterialsSerializer(serializers.ModelSerializer):
     class Meta:
         model = Material
         fields = ['id', 'quantity']
+        list_serializer_class = MaterialsListSerializer
 
     def validate_quantity(self, value):
         if value < 0:
@@ -55,52 +143,85 @@ class MaterialsSerializer(serializers.ModelSerializer):
         
         return value
 
-    def validate_id(self, value):
-        try:
-            Material.objects.get(pk = value)
-        except Material.DoesNotExist:
-            raise serializers.ValidationError("Material doesn't exists!")
-
-        return value
-
-    def validate(self, data):
-        material_id = data['id']
-        quantity = data['quantity']
-        
-        # Check whether material exists
-        try:
-            material = Material.objects.get(pk = material_id)
-        except Material.DoesNotExist:
-            raise serializers.ValidationError({'material': "Material doesn't exists!"})
-
-        # Check whether restock quantity will exceed max_capacity
-        if material.current_capacity + quantity > material.max_capacity:
-            raise serializers.ValidationError({'error_messages': "Invalid restock quantity"})
-
-        return data
-
     def create(self, validated_data):
         material_id = validated_data['id']
         quantity = validated_data['quantity']
-        material = Material.objects.get(pk = material_id)
-        material.current_capacity += quantity
-        return material.save()
+        try:
+            apply_stock_deltas({material_id: quantity}, StockMovement.RESTOCK)
+        except StockError:
+            raise serializers.ValidationError({'error_messages': "Invalid restock quantity"})
+        return Material.objects.get(pk = material_id)
 
 class RestockSerializer(serializers.Serializer):
     materials = MaterialsSerializer(required = True, many = True)
     total_price = serializers.DecimalField(max_digits = 10, decimal_places = 2)
 
-    def save(self):
-        materials = self.validated_data.pop('materials')
-        serializer = MaterialsSerializer(data = materials, many = True)
+    # Check the quoted total against the price of the materials
+    def validate(self, data):
+        total_price = sum(line['material'].price * line['quantity'] for line in data['materials'])
+        if total_price != data['total_price']:
+            raise serializers.ValidationError({'total_price': "Total price doesn't match the materials"})
+
+        return data
 
-        # Check validation of the data
-        if serializer.is_valid():
-            serializer.save()
+    def create(self, validated_data):
+        with transaction.atomic():
+            return self.fields['materials'].create(validated_data['materials'])
 
 class InventorySerializer(serializers.ModelSerializer):
+    current_capacity = serializers.IntegerField(source = 'stock')
     percentage_of_capacity = serializers.DecimalField(max_digits = 3, decimal_places = 2)
 
     class Meta:
         model = Material
-        fields = ['id', 'max_capacity', 'current_capacity', 'percentage_of_capacity']
\ No newline at end of file
+        fields = ['id', 'max_capacity', 'current_capacity', 'percentage_of_capacity']
+
+class RecipeLineSerializer(serializers.Serializer):
+    material = serializers.CharField(max_length = 40)
+    quantity = serializers.IntegerField()
+
+    def validate_quantity(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Please enter a valid value")
+        return value
+
+class RecipeSerializer(serializers.Serializer):
+    product = serializers.CharField(max_length = 40)
+    materials = RecipeLineSerializer(many = True)
+
+# Whole recipes of the store, every name is resolved with one IN query per model
+class BulkRecipeSerializer(serializers.Serializer):
+    recipes = RecipeSerializer(many = True, allow_empty = False)
+    replace = serializers.BooleanField(default = False)
+
+    def validate(self, data):
+        store = self.context['store']
+        product_names = {recipe['product'] for recipe in data['recipes']}
+        material_names = {line['material'] for recipe in data['recipes'] for line in recipe['materials']}
+
+        products = dict(Product.objects.filter(store = store, name__in = product_names).values_list('name', 'id'))
+        materials = dict(Material.objects.filter(store = store, name__in = material_names).values_list('name', 'id'))
+
+        # Check whether products and materials exist in the store of the user
+        if len(products) != len(product_names):
+            raise serializers.ValidationError({'product': "Product doesn't exists!"})
+        if len(materials) != len(material_names):
+            raise serializers.ValidationError({'material': "Material doesn't exists!"})
+
+        # {product_id: {material_id: quantity}}, the last line of a repeated pair wins
+        recipes = {}
+        for recipe in data['recipes']:
+            lines = recipes.setdefault(products[recipe['product']], {})
+            for line in recipe['materials']:
+                lines[materials[line['material']]] = line['quantity']
+
+        data['resolved_recipes'] = recipes
+        return data
+
+    def create(self, validated_data):
+        deleted = upsert_recipes(validated_data['resolved_recipes'], validated_data['replace'], store = self.context['store'])
+        return {
+            'products': len(validated_data['resolved_recipes']),
+            'material_quantities': sum(len(lines) for lines in validated_data['resolved_recipes'].values()),
+            'deleted': deleted,
+        }
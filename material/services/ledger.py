@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import connection, connections, transaction
+from django.db.models import F, Sum, OuterRef, Subquery, Max
+from django.db.models.functions import Coalesce
+
+from material.models import Material, StockShard, StockMovement, StockSnapshot
+from material.services.shards import stock_expression
+
+def record_movements(deltas, reason):
+    StockMovement.objects.bulk_create(
+        StockMovement(material_id = material_id, delta = delta, reason = reason)
+        for material_id, delta in deltas.items()
+    )
+
+# Annotate ledger_balance: the latest snapshot plus the movements recorded
+# after it (up to the until movement), read with one range scan of the (material, id) index
+def with_ledger_balance(materials, until = None):
+    latest = StockSnapshot.objects.filter(material = OuterRef('pk')).order_by('-movement_id')
+    materials = materials.annotate(
+        snapshot_balance = Coalesce(Subquery(latest.values('balance')[:1]), 0),
+        snapshot_movement = Coalesce(Subquery(latest.values('movement_id')[:1]), 0),
+    )
+
+    recent = StockMovement.objects.filter(
+        material = OuterRef('pk'),
+        id__gt = OuterRef('snapshot_movement'),
+    )
+    if until is not None:
+        recent = recent.filter(id__lte = until)
+    recent = recent.order_by().values('material').annotate(total = Sum('delta')).values('total')
+
+    return materials.annotate(ledger_balance = F('snapshot_balance') + Coalesce(Subquery(recent), 0))
+
+def stock_balances(materials = None):
+    if materials is None:
+        materials = Material.objects.all()
+    return dict(with_ledger_balance(materials).values_list('id', 'ledger_balance'))
+
+# Fold every movement recorded so far into a new snapshot of each material
+def take_snapshots(materials = None):
+    if materials is None:
+        materials = Material.objects.all()
+
+    with transaction.atomic():
+        # Movements inserted while the snapshots are taken are left to the next ones
+        last_movement = StockMovement.objects.aggregate(last = Max('id'))['last'] or 0
+        balances = with_ledger_balance(materials, until = last_movement).values_list('id', 'ledger_balance')
+        snapshots = [
+            StockSnapshot(material_id = material_id, balance = balance, movement_id = last_movement)
+            for material_id, balance in balances
+        ]
+        StockSnapshot.objects.bulk_create(snapshots)
+
+    return len(snapshots)
+
+# Reset the stock of the materials of a store to their ledger balance
+def replay_store(store_id):
+    from product.services.capacity import rebuild_product_capacities
+
+    with transaction.atomic():
+        materials = Material.objects.select_for_update().filter(store_id = store_id).order_by('id')
+        materials = list(materials.annotate(stock = stock_expression()))
+        balances = stock_balances(Material.objects.filter(store_id = store_id))
+
+        changed = []
+        for material in materials:
+            balance = balances[material.pk]
+            if material.stock != balance:
+                material.current_capacity = balance
+                changed.append(material)
+
+        # The whole balance goes to current_capacity, the next sale spreads it over the shards again
+        Material.objects.bulk_update(changed, ['current_capacity'])
+        StockShard.objects.filter(material__in = [material.pk for material in changed if material.shard_count]).update(quantity = 0)
+        rebuild_product_capacities(store = store_id)
+
+    return store_id, len(changed)
+
+def replay_stores(store_ids, workers = None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # SQLite only allows one writer at a time, stores are replayed one after another
+    if workers <= 1 or connection.vendor == 'sqlite':
+        return [replay_store(store_id) for store_id in store_ids]
+
+    # Forked workers must open their own database connections
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        return list(executor.map(replay_store, store_ids))
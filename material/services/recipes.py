@@ -0,0 +1,49 @@
+from django.db import transaction
+
+from material.models import MaterialQuantity
+from product.models import Product
+from product.services.bom import rebuild_explosions
+
+# Write the recipes {product_id: {material_id: quantity}} with one
+# upsert on the (product, material) unique constraint. With replace, the
+# materials missing from the recipe of a product are removed as well.
+# Bulk writes don't send signals: the exploded BOM, the capacities and the
+# BOM matrix are rebuilt once for the whole batch instead.
+def upsert_recipes(recipes, replace = False, store = None):
+    # The products of a single store or of the stores looked up
+    if store is not None:
+        stores = dict.fromkeys(recipes.keys(), store.pk)
+    else:
+        stores = dict(Product.objects.filter(pk__in = recipes.keys()).values_list('id', 'store_id'))
+    with transaction.atomic():
+        MaterialQuantity.objects.bulk_create(
+            [
+                MaterialQuantity(product_id = product_id, material_id = material_id, quantity = quantity, store_id = stores[product_id])
+                for product_id, materials in recipes.items()
+                for material_id, quantity in materials.items()
+            ],
+            update_conflicts = True,
+            unique_fields = ['product_id', 'material_id'],
+            update_fields = ['quantity'],
+        )
+
+        deleted = 0
+        if replace:
+            rows = MaterialQuantity.objects.filter(product_id__in = recipes.keys()).values_list('id', 'product_id', 'material_id')
+            stale = [pk for pk, product_id, material_id in rows if material_id not in recipes[product_id]]
+            if stale:
+                # Nothing references a material quantity, the rows are removed
+                # without collecting them one by one for the signals
+                deleted = MaterialQuantity.objects.filter(pk__in = stale).delete_rows()
+
+        rebuild_explosions(list(recipes.keys()))
+
+    return deleted
+
+# Recipe rows of a store about to be deleted, removed without their per-row
+# delete signals: the products they would rebuild are deleted with the store
+def delete_store_recipes(store):
+    from product.models import ProductComponent
+
+    MaterialQuantity.objects.filter(store = store).delete_rows()
+    ProductComponent.objects.filter(parent__store = store).delete_rows()
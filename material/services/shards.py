@@ -0,0 +1,115 @@
+import random
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Count, Case, When, IntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from material.models import Material, StockShard, StockMovement
+
+# Stock of a material: current_capacity plus its shards. The shards are only
+# summed for sharded materials, prefix is the path to the material
+# (e.g. 'exploded_material_quantity__material__') or '' on Material querysets.
+def stock_expression(prefix = ''):
+    shard_total = StockShard.objects.filter(material = OuterRef(prefix + 'id')).order_by().values('material')
+    shard_total = shard_total.annotate(total = Sum('quantity')).values('total')
+    return Case(
+        When(**{prefix + 'shard_count': 0}, then = F(prefix + 'current_capacity')),
+        default = F(prefix + 'current_capacity') + Coalesce(Subquery(shard_total), 0),
+        output_field = IntegerField(),
+    )
+
+# Spread total over the shards, current_capacity is left empty
+def spread(material_id, shards, total):
+    quantity, extra = divmod(total, len(shards))
+    for shard in shards:
+        shard.quantity = quantity + (1 if shard.index < extra else 0)
+    Material.objects.filter(pk = material_id).update(current_capacity = 0)
+    StockShard.objects.bulk_update(shards, ['quantity'])
+
+# Take quantity from the shards of a material, inside the caller's transaction.
+# The common case is one guarded UPDATE of a random shard. When that shard runs
+# short the material and its shards are locked, quantity is taken from the
+# whole stock and the rest (restocks land in current_capacity) is spread over
+# the shards again. Returns False when the whole stock is short. The material
+# is locked FOR NO KEY UPDATE: the ledger inserts of concurrent sales, which
+# hold a shard, key share lock it for their foreign key check.
+def take_from_shards(material_id, shard_count, quantity):
+    taken = StockShard.objects.filter(
+        material_id = material_id, index = random.randrange(shard_count), quantity__gte = quantity,
+    ).update(quantity = F('quantity') - quantity)
+    if taken:
+        return True
+
+    material = Material.objects.select_for_update(no_key = True).get(pk = material_id)
+    shards = list(StockShard.objects.select_for_update().filter(material_id = material_id).order_by('index'))
+    total = material.current_capacity + sum(shard.quantity for shard in shards) - quantity
+    if total < 0:
+        return False
+
+    if shards:
+        spread(material_id, shards, total)
+    else:
+        Material.objects.filter(pk = material_id).update(current_capacity = total, shard_count = 0)
+    return True
+
+# Split the stock of a material over count shards (or change the number of
+# shards). The stock doesn't change so nothing is recorded in the ledger.
+def shard_material(material_id, count):
+    if count < 1:
+        return collapse_material(material_id)
+
+    with transaction.atomic():
+        material = Material.objects.select_for_update(no_key = True).get(pk = material_id)
+        shards = list(StockShard.objects.select_for_update().filter(material_id = material_id).order_by('index'))
+        total = material.current_capacity + sum(shard.quantity for shard in shards)
+
+        StockShard.objects.filter(material_id = material_id, index__gte = count).delete()
+        shards = shards[:count]
+        shards += StockShard.objects.bulk_create(
+            StockShard(material_id = material_id, index = index) for index in range(len(shards), count)
+        )
+        spread(material_id, shards, total)
+        Material.objects.filter(pk = material_id).update(shard_count = count)
+
+# Fold the shards back into current_capacity. The capacities of the products
+# using the material, computed on read while it was sharded, are stored again.
+def collapse_material(material_id):
+    from product.services.capacity import refresh_material_capacities
+
+    with transaction.atomic():
+        material = Material.objects.select_for_update(no_key = True).get(pk = material_id)
+        shards = StockShard.objects.select_for_update().filter(material_id = material_id)
+        total = material.current_capacity + sum(shard.quantity for shard in shards)
+
+        shards.delete()
+        Material.objects.filter(pk = material_id).update(current_capacity = total, shard_count = 0)
+        refresh_material_capacities([material_id])
+
+# Shard the materials that had more than shard_above stock movements in the
+# last window seconds and collapse the sharded ones that had fewer than
+# collapse_below. Returns the ids of the sharded and collapsed materials.
+def rebalance_shards(window = 60, shard_above = None, collapse_below = 0, shards = 8, now = None):
+    since = (now or timezone.now()) - timedelta(seconds = window)
+    movements = dict(
+        StockMovement.objects.filter(created_at__gte = since).order_by()
+        .values('material_id').annotate(count = Count('id')).values_list('material_id', 'count')
+    )
+
+    sharded = []
+    if shard_above is not None:
+        hot = [material_id for material_id, count in movements.items() if count > shard_above]
+        sharded = list(Material.objects.filter(pk__in = hot, shard_count = 0).values_list('id', flat = True))
+        for material_id in sharded:
+            shard_material(material_id, shards)
+
+    collapsed = [
+        material_id
+        for material_id in Material.objects.filter(shard_count__gt = 0).values_list('id', flat = True)
+        if movements.get(material_id, 0) < collapse_below
+    ]
+    for material_id in collapsed:
+        collapse_material(material_id)
+
+    return sharded, collapsed
@@ -0,0 +1,60 @@
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value, IntegerField
+
+from material.models import Material
+from material.services.ledger import record_movements
+from store.services.inventory import bump_inventory_versions, bumps_skipped
+from material.services.shards import stock_expression, take_from_shards
+from product.services.capacity import refresh_material_capacities
+
+class StockError(Exception):
+    pass
+
+# CASE expression mapping each material to its signed delta
+def delta_case(deltas):
+    return Case(
+        *[When(pk = material_id, then = Value(delta)) for material_id, delta in deltas.items()],
+        default = Value(0),
+        output_field = IntegerField(),
+    )
+
+# Apply signed {material_id: delta} changes to the stock, all or nothing.
+# One guarded UPDATE keeps every stock between 0 and max_capacity even
+# under concurrent writers, then the movements are appended to the ledger
+# and the capacities of the products using the unsharded materials are refreshed.
+# Decrements of sharded materials are taken from their shards instead. The
+# inventory versions of the stores are bumped once, after the commit.
+# Unbounded, increments only give back units taken before (released holds)
+# and may go above a max_capacity reached or lowered in the meantime.
+def apply_stock_deltas(deltas, reason, bounded = True):
+    deltas = {material_id: delta for material_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    with transaction.atomic():
+        with bumps_skipped():
+            change = delta_case(deltas)
+            materials = Material.objects.filter(pk__in = deltas.keys())
+
+            # Decrements are bounded by 0 and increments by max_capacity,
+            # sharded materials take their decrements from their shards
+            decrements = [material_id for material_id, delta in deltas.items() if delta < 0]
+            if decrements:
+                materials = materials.exclude(pk__in = decrements, shard_count__gt = 0).filter(current_capacity__gte = -change)
+            if len(decrements) != len(deltas) and bounded:
+                materials = materials.alias(stock = stock_expression())
+                materials = materials.filter(Q(pk__in = decrements) | Q(stock__lte = F('max_capacity') - change))
+
+            updated = materials.update(current_capacity = F('current_capacity') + change)
+            if updated != len(deltas) and decrements:
+                sharded = Material.objects.filter(pk__in = decrements, shard_count__gt = 0).values_list('id', 'shard_count')
+                for material_id, shard_count in sharded:
+                    if take_from_shards(material_id, shard_count, -deltas[material_id]):
+                        updated += 1
+            if updated != len(deltas):
+                raise StockError("Insufficient stock or capacity")
+
+            record_movements(deltas, reason)
+            refresh_material_capacities(deltas.keys())
+
+        bump_inventory_versions(Material.objects.filter(pk__in = deltas.keys()).values('store'))
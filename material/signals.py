@@ -0,0 +1,18 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Material, StockMovement
+from .services.ledger import record_movements
+
+# Stock changed through Model.save() (material creation, admin) is recorded as an adjustment,
+# stock services update the rows in bulk and record their own movements
+@receiver(post_save, sender = Material)
+def record_stock_adjustment(sender, instance, created, **kwargs):
+    loaded = 0 if created else getattr(instance, '_loaded_current_capacity', None)
+    if loaded is None:
+        return
+
+    delta = instance.current_capacity - loaded
+    if delta:
+        record_movements({instance.pk: delta}, StockMovement.ADJUSTMENT)
+    instance._loaded_current_capacity = instance.current_capacity
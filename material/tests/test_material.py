@@ -132,6 +132,23 @@ class MaterialViewTest(BaseMaterialTest):
         # Didn't change current_capacity
         self.assertEqual(m.current_capacity, 0)
 
+    def test_cannot_update_material_of_another_store(self):
+        # authentication
+        self.force_authentication()
+
+        user = User.objects.create_user(username = "admin2", password = "password123")
+        store = Store.objects.create(name = 'store2', user = user)
+        material = Material.objects.create(name = "material1", price = 12.50, store = store)
+
+        url = reverse('material-detail', args = (material.pk, ))
+        response = self.client.patch(url, {'price': 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Material.objects.get(pk = material.pk).price, 12.50)
+
+        url = reverse('material-detail', args = (material.pk + 1, ))
+        response = self.client.patch(url, {'price': 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_delete_material(self):
         # authentication
         self.force_authentication()
@@ -170,4 +187,19 @@ class MaterialViewTest(BaseMaterialTest):
         Store.objects.create(name = 'store2', user = user)
         url = reverse('material-list')
         response = self.client.get(url)
-        self.assertIn('[]', response.content.decode())
\ No newline at end of file
+        self.assertIn('[]', response.content.decode())
+
+    def test_list_material_matches_material_serializer(self):
+        # authentication
+        self.force_authentication()
+
+        store = Store.objects.get(pk = 1)
+        self.create_material("material1", store, price = 3.1, max_capacity = 10, current_capacity = 5)
+        self.create_material("material2", store)
+
+        url = reverse('material-list')
+        response = self.client.get(url)
+        expected = MaterialSerializer(Material.objects.order_by('id'), many = True).data
+        self.assertEqual(response.json(), [dict(material) for material in expected])
+        self.assertEqual(response.json()[0]['price'], '3.10')
+
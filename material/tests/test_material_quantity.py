@@ -1,11 +1,12 @@
 from .base_test import BaseMaterialQuantityTest
 from ..models import Material, MaterialQuantity
 from store.models import Store
-from product.models import Product
+from product.models import Product, ProductCapacity
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.db import IntegrityError
-from ..serializers import MaterialQuantitySerializer
+from ..serializers import MaterialQuantitySerializer, BulkRecipeSerializer
+from ..services.recipes import upsert_recipes
 from rest_framework.test import APITestCase
 from rest_framework import status
 
@@ -34,6 +35,14 @@ class MaterialQuantityModelTest(BaseMaterialQuantityTest):
         with self.assertRaises(IntegrityError):
             MaterialQuantity.objects.create(product = product, material = material, quantity = 10)
 
+    # The rows carry the store of their product, however they are written
+    def test_rows_carry_the_store_of_their_product(self):
+        product = Product.objects.get(pk = 1)
+        MaterialQuantity.objects.create(product_id = 1, material_id = 1, quantity = 10)
+        upsert_recipes({2: {2: 3}})
+        upsert_recipes({1: {2: 4}}, store = product.store)
+        self.assertEqual(set(MaterialQuantity.objects.values_list('store_id', flat = True)), {product.store_id})
+
 class MaterialQuantitySerializerTest(BaseMaterialQuantityTest):
     def test_serialize(self):
         product = Product.objects.get(pk = 1)
@@ -191,4 +200,108 @@ class MaterialQuantityViewTest(APITestCase):
         url = reverse("material_quantity-detail", args = (1, ))
         response = self.client.delete(url)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
-        self.assertEqual(MaterialQuantity.objects.count(), 0)
\ No newline at end of file
+        self.assertEqual(MaterialQuantity.objects.count(), 0)
+
+    def test_list_mq_is_scoped_to_store_and_filtered(self):
+        # authenticate
+        self.force_authentication()
+
+        # Material quantity of another store
+        other = Store.objects.create(name = 'store2', user = User.objects.create_user(username = 'other', password = 'password123'))
+        other_product = Product.objects.create(name = 'product1', store = other)
+        other_material = Material.objects.create(name = 'material1', price = 12.50, store = other)
+        MaterialQuantity.objects.create(product = other_product, material = other_material, quantity = 1)
+
+        for product in Product.objects.filter(pk__in = [1, 2]):
+            for material in Material.objects.filter(pk__in = [1, 2]):
+                MaterialQuantity.objects.create(product = product, material = material, quantity = 3)
+
+        url = reverse("material_quantity-list")
+        response = self.client.get(url)
+        self.assertEqual(len(response.data), 4)
+
+        response = self.client.get(url, {'product': 'product1'})
+        self.assertEqual([(row['product'], row['material']) for row in response.data], [('product1', 'material1'), ('product1', 'material2')])
+
+        response = self.client.get(url, {'product': 'product2', 'material': 'material1'})
+        self.assertEqual([(row['product'], row['material']) for row in response.data], [('product2', 'material1')])
+
+    def test_list_mq_with_page_size(self):
+        # authenticate
+        self.force_authentication()
+
+        for product in Product.objects.filter(pk__in = [1, 2]):
+            for material in Material.objects.all():
+                MaterialQuantity.objects.create(product = product, material = material, quantity = 3)
+
+        url = reverse("material_quantity-list")
+        ids = []
+        response = self.client.get(url, {'page_size': 3})
+        while True:
+            ids += [row['id'] for row in response.data['results']]
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(ids, list(MaterialQuantity.objects.order_by('product_id', 'material_id').values_list('id', flat = True)))
+
+class BulkRecipeViewTest(APITestCase):
+    def setUp(self):
+        user = User.objects.create_user(username = "admin", password = "password123")
+        store = Store.objects.create(name = 'store1', user = user)
+        Product.objects.create(name = 'product1', store = store)
+        Product.objects.create(name = 'product2', store = store)
+        Material.objects.create(name = 'material1', price = 12.50, store = store, max_capacity = 100, current_capacity = 60)
+        Material.objects.create(name = 'material2', price = 12.50, store = store, max_capacity = 100, current_capacity = 60)
+        Material.objects.create(name = 'material3', price = 12.50, store = store, max_capacity = 100, current_capacity = 60)
+        self.client.force_authenticate(user = user)
+        self.url = reverse('material_quantity-bulk')
+
+    def recipe(self, product, **materials):
+        return {'product': product, 'materials': [{'material': name, 'quantity': quantity} for name, quantity in materials.items()]}
+
+    def quantities(self):
+        return set(MaterialQuantity.objects.values_list('product__name', 'material__name', 'quantity'))
+
+    def test_bulk_create_recipes(self):
+        data = {'recipes': [self.recipe('product1', material1 = 2, material2 = 3), self.recipe('product2', material3 = 5)]}
+        response = self.client.post(self.url, data, format = 'json')
+        self.assertEqual(response.data, {'products': 2, 'material_quantities': 3, 'deleted': 0})
+        self.assertEqual(self.quantities(), {
+            ('product1', 'material1', 2), ('product1', 'material2', 3), ('product2', 'material3', 5),
+        })
+        # Capacities are refreshed for the bulk write
+        self.assertEqual(ProductCapacity.objects.get(product__name = 'product1').quantity, 20)
+        self.assertEqual(ProductCapacity.objects.get(product__name = 'product2').quantity, 12)
+
+    def test_bulk_upsert_updates_existing_rows(self):
+        self.client.post(self.url, self.recipe('product1', material1 = 2, material2 = 3), format = 'json')
+        pk = MaterialQuantity.objects.get(material__name = 'material1').pk
+        self.client.post(self.url, self.recipe('product1', material1 = 6), format = 'json')
+        self.assertEqual(self.quantities(), {('product1', 'material1', 6), ('product1', 'material2', 3)})
+        self.assertEqual(MaterialQuantity.objects.get(material__name = 'material1').pk, pk)
+
+    def test_bulk_replace_removes_missing_materials(self):
+        data = {'recipes': [self.recipe('product1', material1 = 2, material2 = 3), self.recipe('product2', material2 = 1)]}
+        self.client.post(self.url, data, format = 'json')
+        data = {'recipes': [self.recipe('product1', material2 = 4, material3 = 1)], 'replace': True}
+        response = self.client.post(self.url, data, format = 'json')
+        self.assertEqual(response.data['deleted'], 1)
+        self.assertEqual(self.quantities(), {
+            ('product1', 'material2', 4), ('product1', 'material3', 1), ('product2', 'material2', 1),
+        })
+        self.assertEqual(ProductCapacity.objects.get(product__name = 'product1').quantity, 15)
+
+    def test_bulk_rejects_names_of_another_store(self):
+        other = Store.objects.create(name = 'store2', user = User.objects.create_user(username = 'other', password = 'password123'))
+        Material.objects.create(name = 'material9', price = 1, store = other)
+        response = self.client.post(self.url, self.recipe('product1', material9 = 1), format = 'json')
+        self.assertEqual(response.data, {'material': ["Material doesn't exists!"]})
+        response = self.client.post(self.url, self.recipe('product9', material1 = 1), format = 'json')
+        self.assertEqual(response.data, {'product': ["Product doesn't exists!"]})
+        self.assertEqual(MaterialQuantity.objects.count(), 0)
+
+    def test_bulk_resolves_names_with_two_queries(self):
+        data = {'recipes': [self.recipe('product1', material1 = 2, material2 = 3), self.recipe('product2', material3 = 5)]}
+        serializer = BulkRecipeSerializer(data = data, context = {'store': Store.objects.get()})
+        with self.assertNumQueries(2):
+            self.assertTrue(serializer.is_valid())
@@ -5,6 +5,10 @@ from django.urls import reverse
 from django.db.models import F
 from ..serializers import RestockSerializer, MaterialsSerializer
 from rest_framework import status
+from inventory_management_api.parsers import parse_form_item
+from store.models import Store
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 User = get_user_model()
 class MaterialsSerializerTest(BaseRestockTest):
@@ -61,7 +65,7 @@ class RestockSerializerTest(BaseRestockTest):
                     'quantity': 10,
                 }
             ],
-            'total_price': 50
+            'total_price': 187.50
         }
         serializer = RestockSerializer(data = data)
         self.assertTrue(serializer.is_valid())
@@ -77,7 +81,7 @@ class RestockSerializerTest(BaseRestockTest):
                     'quantity': 10,
                 }
             ],
-            'total_price': 50
+            'total_price': 187.50
         }
         serializer = RestockSerializer(data = data)
         self.assertTrue(serializer.is_valid())
@@ -121,7 +125,7 @@ class RestockViewTest(BaseRestockTest):
                     'quantity': 20,
                 }
             ],
-            'total_price': 100.0
+            'total_price': 437.50
         }
         response = self.client.post(url, data)
         self.assertTrue(response.status_code, status.HTTP_201_CREATED)
@@ -131,6 +135,20 @@ class RestockViewTest(BaseRestockTest):
         self.assertEqual(material2.current_capacity, 64)
         self.assertEqual(material3.current_capacity, 68)
 
+    def test_create_restock_with_json_body(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('material-restock')
+        data = {
+            'materials': [{'id': 2, 'quantity': 15}, {'id': 3, 'quantity': 20}],
+            'total_price': '437.50'
+        }
+        response = self.client.post(url, data, format = 'json')
+        self.assertIn("Restock successfully", response.content.decode())
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 64)
+        self.assertEqual(Material.objects.get(pk = 3).current_capacity, 68)
+
     def test_invalid_quantity_restock(self):
         # authentication
         self.force_authentication()
@@ -147,3 +165,49 @@ class RestockViewTest(BaseRestockTest):
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn("error_messages", response.content.decode())
+
+class BatchedRestockTest(BaseRestockTest):
+    def restock(self, materials, total_price, store = None):
+        serializer = RestockSerializer(data = {'materials': materials, 'total_price': total_price}, context = {'store': store})
+        if serializer.is_valid():
+            serializer.save()
+        return serializer
+
+    def test_reject_wrong_total_price(self):
+        serializer = self.restock([{'id': 2, 'quantity': 10}], 100)
+        self.assertIn('total_price', serializer.errors)
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 49)
+
+    def test_merge_lines_of_same_material(self):
+        # Each line fits but not both of them
+        serializer = self.restock([{'id': 2, 'quantity': 30}, {'id': 2, 'quantity': 30}], 750)
+        self.assertIn('error_messages', str(serializer.errors))
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 49)
+
+    def test_reject_material_of_other_store(self):
+        user = User.objects.create_user(username = "admin2", password = "password123")
+        store = Store.objects.create(name = 'store2', user = user)
+        serializer = self.restock([{'id': 2, 'quantity': 10}], 125, store = store)
+        self.assertIn('material', str(serializer.errors))
+
+    def test_query_count_does_not_depend_on_line_count(self):
+        with CaptureQueriesContext(connection) as small:
+            self.restock([{'id': 2, 'quantity': 1}], 12.50)
+        with CaptureQueriesContext(connection) as large:
+            self.restock([{'id': 2, 'quantity': 1}, {'id': 3, 'quantity': 1}] * 20, 500)
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 70)
+        self.assertEqual(Material.objects.get(pk = 3).current_capacity, 68)
+
+class ParseItemsTest(BaseRestockTest):
+    def test_legacy_form_item_with_quote_in_name(self):
+        item = str({'name': "Baker's flour", 'quantity': 2})
+        self.assertEqual(parse_form_item(item), {'name': "Baker's flour", 'quantity': 2})
+
+    def test_json_form_item(self):
+        self.assertEqual(parse_form_item('{"id": 2, "quantity": 5}'), {'id': 2, 'quantity': 5})
+
+    def test_legacy_form_item(self):
+        self.assertEqual(parse_form_item(str({'name': 'flour', 'quantity': 2})), {'name': 'flour', 'quantity': 2})
+        self.assertEqual(parse_form_item(str({'name': 'a"b', 'quantity': 2})), {'name': 'a"b', 'quantity': 2})
+        self.assertEqual(parse_form_item(str({'name': 'a\'"b', 'quantity': 2})), {'name': 'a\'"b', 'quantity': 2})
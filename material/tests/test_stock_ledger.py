@@ -0,0 +1,64 @@
+from .base_test import BaseRestockTest
+from ..models import Material, StockMovement, StockSnapshot
+from ..serializers import MaterialSerializer
+from ..services.stock import apply_stock_deltas, StockError
+from ..services.ledger import stock_balances, take_snapshots, replay_stores
+from django.core.management import call_command
+from io import StringIO
+
+class StockLedgerTest(BaseRestockTest):
+    def test_material_creation_opens_the_ledger(self):
+        self.assertEqual(stock_balances(), {1: 100, 2: 49, 3: 48})
+        self.assertEqual(StockMovement.objects.filter(reason = StockMovement.ADJUSTMENT).count(), 3)
+
+    def test_apply_stock_deltas_records_movements(self):
+        apply_stock_deltas({2: 10, 3: -8}, StockMovement.RESTOCK)
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 59)
+        self.assertEqual(Material.objects.get(pk = 3).current_capacity, 40)
+        self.assertEqual(stock_balances(), {1: 100, 2: 59, 3: 40})
+
+    def test_apply_stock_deltas_is_all_or_nothing(self):
+        # material1 is already full
+        with self.assertRaises(StockError):
+            apply_stock_deltas({1: 1, 2: 10}, StockMovement.RESTOCK)
+        with self.assertRaises(StockError):
+            apply_stock_deltas({2: -50}, StockMovement.SALE)
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 49)
+        self.assertEqual(stock_balances(), {1: 100, 2: 49, 3: 48})
+
+    def test_save_records_adjustment(self):
+        material = Material.objects.get(pk = 2)
+        material.current_capacity = 40
+        material.save()
+        self.assertEqual(StockMovement.objects.filter(material = material).last().delta, -9)
+
+    # A sale committed between the load and the save of an edit is kept
+    def test_serializer_update_keeps_concurrent_stock_changes(self):
+        material = Material.objects.get(pk = 2)
+        apply_stock_deltas({2: -20}, StockMovement.SALE)
+        serializer = MaterialSerializer(material, data = {'price': 3}, partial = True)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        material = Material.objects.get(pk = 2)
+        self.assertEqual((material.current_capacity, material.price), (29, 3))
+        self.assertEqual(stock_balances()[2], 29)
+
+    def test_balance_from_snapshot_and_recent_movements(self):
+        self.assertEqual(take_snapshots(), 3)
+        apply_stock_deltas({2: 1}, StockMovement.RESTOCK)
+        self.assertEqual(StockSnapshot.objects.get(material = 2).balance, 49)
+        with self.assertNumQueries(1):
+            self.assertEqual(stock_balances(Material.objects.filter(pk = 2)), {2: 50})
+
+    def test_replay_corrects_stock_drift(self):
+        Material.objects.filter(pk = 3).update(current_capacity = 0)
+        self.assertEqual(replay_stores([1], workers = 1), [(1, 1)])
+        self.assertEqual(Material.objects.get(pk = 3).current_capacity, 48)
+
+    def test_replay_command(self):
+        Material.objects.filter(pk = 1).update(current_capacity = 7)
+        out = StringIO()
+        call_command('replay_stock_ledger', workers = 1, stdout = out)
+        self.assertIn("1 materials corrected", out.getvalue())
+        self.assertEqual(Material.objects.get(pk = 1).current_capacity, 100)
@@ -0,0 +1,126 @@
+from .base_test import BaseRestockTest
+from ..models import Material, MaterialQuantity, StockShard, StockMovement
+from ..services.stock import apply_stock_deltas, StockError
+from ..services.shards import shard_material, collapse_material, rebalance_shards
+from ..services.ledger import stock_balances, replay_stores
+from product.models import Product, ProductCapacity
+from product.services.sale import process_sales
+from product.services.capacity import sql_capacities
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.urls import reverse
+from io import StringIO
+
+User = get_user_model()
+
+class StockShardTest(BaseRestockTest):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user = User.objects.get(username = "admin"))
+        MaterialQuantity.objects.create(product_id = 1, material_id = 2, quantity = 2)
+
+    def shards(self, material_id):
+        return list(StockShard.objects.filter(material_id = material_id).order_by('index').values_list('quantity', flat = True))
+
+    def stock(self, material_id):
+        material = Material.objects.get(pk = material_id)
+        return material.current_capacity + sum(self.shards(material_id))
+
+    def test_shard_material_spreads_the_stock(self):
+        shard_material(2, 4)
+        material = Material.objects.get(pk = 2)
+        self.assertEqual((material.shard_count, material.current_capacity), (4, 0))
+        self.assertEqual(self.shards(2), [13, 12, 12, 12])
+
+        shard_material(2, 2)
+        self.assertEqual(self.shards(2), [25, 24])
+
+    def test_readers_see_the_whole_stock(self):
+        shard_material(2, 4)
+        apply_stock_deltas({2: 10}, StockMovement.RESTOCK)
+
+        response = self.client.get(reverse('material-detail', args = [2]))
+        self.assertEqual(response.data['current_capacity'], 59)
+        response = self.client.get(reverse('material-list'))
+        self.assertEqual(response.data[1]['current_capacity'], 59)
+        response = self.client.get(reverse('material-inventory'))
+        self.assertEqual(response.data[1]['current_capacity'], 59)
+        response = self.client.get(reverse('material-restock'))
+        self.assertIn({'id': 2, 'quantity': 41}, response.data['materials'])
+        # Computed on read, the stock writes leave the table row alone
+        response = self.client.get(reverse('product-product_capacity'))
+        self.assertIn({'product': 1, 'quantity': 29}, response.data['remaining_capacities'])
+        response = self.client.get(reverse('product-product_capacity'), {'page_size': 10})
+        self.assertEqual(response.data['remaining_capacities'][0], {'product': 1, 'quantity': 29})
+
+    def test_sales_take_from_one_shard(self):
+        shard_material(2, 4)
+        # The savepoint statements and the inventory version bump included,
+        # no capacity row is written
+        with self.assertNumQueries(8), self.captureOnCommitCallbacks(execute = True):
+            apply_stock_deltas({2: -2}, StockMovement.SALE)
+        self.assertEqual(self.stock(2), 47)
+        # Only the random shard changed
+        self.assertEqual(sum(a != b for a, b in zip(self.shards(2), [13, 12, 12, 12])), 1)
+        self.assertEqual(stock_balances()[2], 47)
+
+    def test_short_shard_spreads_the_rest(self):
+        shard_material(2, 4)
+        apply_stock_deltas({2: 10}, StockMovement.RESTOCK)
+        # No shard holds 40 but the whole stock does
+        process_sales([{'product': 1, 'quantity': 20}], store = Product.objects.get(pk = 1).store)
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 0)
+        self.assertEqual(self.shards(2), [5, 5, 5, 4])
+        self.assertEqual(stock_balances()[2], 19)
+
+        with self.assertRaises(StockError):
+            apply_stock_deltas({2: -20, 3: -1}, StockMovement.SALE)
+        self.assertEqual(self.stock(2), 19)
+        self.assertEqual(Material.objects.get(pk = 3).current_capacity, 48)
+
+    def test_restock_is_bounded_by_the_whole_stock(self):
+        shard_material(2, 4)
+        with self.assertRaises(StockError):
+            apply_stock_deltas({2: 52}, StockMovement.RESTOCK)
+        apply_stock_deltas({2: 51}, StockMovement.RESTOCK)
+        self.assertEqual(self.stock(2), 100)
+
+        response = self.client.post(reverse('material-restock'), {'materials': [{'id': 2, 'quantity': 1}], 'total_price': 12.5}, format = 'json')
+        self.assertEqual(response.data['materials'], {'error_messages': ["Invalid restock quantity"]})
+
+    def test_collapse_material(self):
+        shard_material(2, 4)
+        apply_stock_deltas({2: -2}, StockMovement.SALE)
+        collapse_material(2)
+        material = Material.objects.get(pk = 2)
+        self.assertEqual((material.shard_count, material.current_capacity), (0, 47))
+        self.assertFalse(StockShard.objects.exists())
+        # The capacity computed on read while sharded is stored again
+        capacities = {row['product']: row['quantity'] for row in sql_capacities(material.store)}
+        self.assertEqual(ProductCapacity.objects.get(product_id = 1).quantity, capacities[1])
+
+    def test_rebalance_shards_follows_contention(self):
+        for _ in range(3):
+            apply_stock_deltas({3: -1}, StockMovement.SALE)
+        shard_material(2, 4)
+
+        sharded, collapsed = rebalance_shards(shard_above = 2, collapse_below = 2, shards = 2)
+        self.assertEqual((sharded, collapsed), ([3], [2]))
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 49)
+        self.assertEqual(self.shards(3), [23, 22])
+
+    def test_shard_stock_command(self):
+        out = StringIO()
+        call_command('shard_stock', material = 2, shards = 3, stdout = out)
+        self.assertIn("Material 2 has 3 stock shards", out.getvalue())
+        self.assertEqual(self.shards(2), [17, 16, 16])
+
+        call_command('shard_stock', stdout = out)
+        self.assertIn("Sharded 0 and collapsed 1 materials", out.getvalue())
+        self.assertEqual(Material.objects.get(pk = 2).shard_count, 0)
+
+    def test_replay_sharded_material(self):
+        shard_material(2, 4)
+        StockShard.objects.filter(material_id = 2, index = 0).update(quantity = 0)
+        self.assertEqual(replay_stores([1], workers = 1), [(1, 1)])
+        self.assertEqual(self.stock(2), 49)
@@ -3,30 +3,43 @@ from rest_framework import viewsets
 from .models import Material, MaterialQuantity
 from .serializers import (
     MaterialSerializer, MaterialQuantitySerializer, MaterialsSerializer, RestockSerializer,
-    InventorySerializer
+    InventorySerializer, MaterialListSerializer, BulkRecipeSerializer
 )
-from store.models import Store
-from product.models import Product
+from store.mixins import StoreMixin, conditional_inventory
+from .pagination import MaterialQuantityCursorPagination
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.authentication import TokenAuthentication
+from store.authentication import CachedTokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 from django.db.models import F, Sum, ExpressionWrapper, FloatField, Func
-import json
+from django.db import transaction
+from inventory_management_api.parsers import parse_items
+from .services.shards import stock_expression
 
-class MaterialViewSet(viewsets.ModelViewSet):
+class MaterialViewSet(StoreMixin, viewsets.ModelViewSet):
     serializer_class = MaterialSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
+    query_budgets = {
+        'list': 3, 'retrieve': 1, 'create': 3, 'update': 5, 'partial_update': 5, 'destroy': 17,
+        'restock': 6, 'inventory': 2,
+    }
+
     # Only using user's own materials
     def get_queryset(self):
-        store = Store.objects.get(user = self.request.user)
-        return Material.objects.filter(store = store)
+        store = self.get_store()
+        return Material.objects.filter(store = store).select_related('store').annotate(stock = stock_expression())
+
+    @conditional_inventory
+    def list(self, request):
+        materials = self.get_queryset().values(*MaterialListSerializer.values)
+        serializer = MaterialListSerializer(materials, many = True)
+        return Response(serializer.data)
 
     def create(self, request):
-        store = Store.objects.get(user = request.user)
+        store = self.get_store()
         name = request.data.get('name')
         price = request.data.get('price')
         max_capacity = request.data.get("max_capacity", 0)
@@ -51,8 +64,9 @@ class MaterialViewSet(viewsets.ModelViewSet):
             return Response(serializer.data, status = status.HTTP_201_CREATED)
         return Response(serializer.errors)
 
-    def update(self, request, pk):
-        material = Material.objects.get(pk = pk)
+    # Always partial, PATCH lands here too. Only the materials of the user's store are found.
+    def update(self, request, *args, **kwargs):
+        material = self.get_object()
         price = request.data.get('price', material.price)
         max_capacity = request.data.get("max_capacity", material.max_capacity)
 
@@ -71,23 +85,17 @@ class MaterialViewSet(viewsets.ModelViewSet):
         return Response(serializer.errors)
 
     @action(detail = False, methods = ['get', 'post'])
+    @conditional_inventory
     def restock(self, request):
         if request.method == "GET":
-            materials = self.get_queryset()
-            # Calculate the quantity of each material needed to be restock and only get those that need to be restocked
-            restock_material = materials.annotate(quantity = F('max_capacity') - F('current_capacity')).filter(quantity__gt = 0)
-
-            # Check is there anything to restock
-            if not restock_material.exists():
-                return Response({'messages': 'Nothing to restock!'})
-
-            serializer = MaterialsSerializer(restock_material.values('id', 'quantity'), many = True)
-            total_price = round(restock_material.aggregate(total_price = Sum(F('quantity') * F('price'))).get('total_price'), 2)
-            return Response({'materials': serializer.data, 'total_price': total_price})
+            return Response(self.cached_inventory('restock', self.restock_data))
 
         elif request.method == "POST":
-            # replace single quote to double quote to parsing from json.load()
-            materials = [json.loads(material.replace('\'', "\"")) for material in request.data.getlist("materials")]
+            # The total price can't be given with a bare JSON array
+            if isinstance(request.data, list):
+                return Response({"error_messages": "Please enter materials and total_price"})
+
+            materials = parse_items(request.data, "materials")
             total_price = request.data.get("total_price", 0)
 
             data = {
@@ -95,46 +103,91 @@ class MaterialViewSet(viewsets.ModelViewSet):
                 'total_price': total_price,
             }
 
-            serializer = RestockSerializer(data = data)
+            store = self.get_store()
+            serializer = RestockSerializer(data = data, context = {'store': store})
 
-            # Check validation of the data
-            if serializer.is_valid():
-                # Update material current_capacity
-                serializer.save()
-                return Response({"message": "Restock successfully"})
-            else:
-                return Response(serializer.errors)
+            # Validate and apply the whole restock in one transaction
+            with transaction.atomic():
+                # Check validation of the data
+                if serializer.is_valid():
+                    # Update material current_capacity
+                    serializer.save()
+                    return Response({"message": "Restock successfully"})
+                else:
+                    return Response(serializer.errors)
+
+    def restock_data(self):
+        materials = self.get_queryset()
+        # Calculate the quantity of each material needed to be restock and only get those that need to be restocked
+        restock_material = materials.annotate(quantity = F('max_capacity') - F('stock')).filter(quantity__gt = 0)
+
+        # Check is there anything to restock
+        if not restock_material.exists():
+            return {'messages': 'Nothing to restock!'}
+
+        serializer = MaterialsSerializer(restock_material.values('id', 'quantity'), many = True)
+        total_price = round(restock_material.aggregate(total_price = Sum(F('quantity') * F('price'))).get('total_price'), 2)
+        return {'materials': list(serializer.data), 'total_price': total_price}
 
     @action(detail = False, methods = ['get'])
+    @conditional_inventory
     def inventory(self, request):
+        return Response(self.cached_inventory('inventory', self.inventory_data))
+
+    def inventory_data(self):
         queryset = self.get_queryset()
 
         # Change current_capacity and max_capacity to float
         template = "%(function)s(%(expressions)s AS FLOAT)"
-        current_capacity = Func(F('current_capacity'), function = "CAST", template = template)
+        current_capacity = Func(F('stock'), function = "CAST", template = template)
         max_capacity = Func(F('max_capacity'), function = "CAST", template = template)
 
         materials = queryset.annotate(
             percentage_of_capacity = ExpressionWrapper(
                 current_capacity / max_capacity, output_field = FloatField())
         )
-        inventories = materials.values('id', 'max_capacity', 'current_capacity', 'percentage_of_capacity')
+        inventories = materials.values('id', 'max_capacity', 'stock', 'percentage_of_capacity')
         serializer = InventorySerializer(inventories, many = True)
-        return Response(serializer.data)
+        return list(serializer.data)
 
-class MaterialQuantityViewSet(viewsets.ModelViewSet):
+class MaterialQuantityViewSet(StoreMixin, viewsets.ModelViewSet):
     serializer_class = MaterialQuantitySerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
+    query_budgets = {
+        'list': 2, 'retrieve': 1, 'create': 12, 'update': 14, 'partial_update': 12, 'destroy': 10,
+        'bulk': 11,
+    }
+
+    pagination_class = MaterialQuantityCursorPagination
+
+    @conditional_inventory
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    # One store-scoped query whatever the size of the catalogue, optionally
+    # narrowed with ?product=<name> and/or ?material=<name>. The rows carry
+    # their store: a page is read in (product, material) order from the
+    # (store, product, material) index, without sorting the store's recipes.
     def get_queryset(self):
-        store = Store.objects.get(user = self.request.user)
-        products = Product.objects.filter(store = store)
-        material_queryset = MaterialQuantity.objects.none()
-        for product in products:
-            material_queryset |= MaterialQuantity.objects.filter(product = product)
+        store = self.get_store()
+        material_queryset = MaterialQuantity.objects.filter(store = store)
 
-        return material_queryset
+        product = self.request.query_params.get('product')
+        if product is not None:
+            material_queryset = material_queryset.filter(product__name = product)
+        material = self.request.query_params.get('material')
+        if material is not None:
+            material_queryset = material_queryset.filter(material__name = material)
+
+        return material_queryset.select_related('product', 'material').order_by('product_id', 'material_id')
+
+    # Product and material names are looked up in the store of the user
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['store'] = self.get_store()
+        return context
 
     def create(self, request):
         product = request.data.get("product")
@@ -147,9 +200,29 @@ class MaterialQuantityViewSet(viewsets.ModelViewSet):
             'quantity': quantity
         }
 
-        serializer = MaterialQuantitySerializer(data = data)
+        serializer = MaterialQuantitySerializer(data = data, context = self.get_serializer_context())
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data, status = status.HTTP_201_CREATED)
         
-        return Response({"error_messages": "Please enter valid data"})
\ No newline at end of file
+        return Response({"error_messages": "Please enter valid data"})
+
+    # Upsert whole recipes in one request:
+    # {"recipes": [{"product": name, "materials": [{"material": name, "quantity": n}, ...]}, ...], "replace": false}
+    # or a single {"product": name, "materials": [...]}. With replace, the materials
+    # missing from the recipe of a product are removed from it.
+    @action(detail = False, methods = ['post'])
+    def bulk(self, request):
+        data = request.data
+        if isinstance(data, dict) and 'recipes' not in data:
+            data = {
+                'recipes': [{'product': data.get('product'), 'materials': data.get('materials')}],
+                'replace': data.get('replace', False),
+            }
+
+        store = self.get_store()
+        serializer = BulkRecipeSerializer(data = data, context = {'store': store})
+        if serializer.is_valid():
+            return Response(serializer.save())
+
+        return Response(serializer.errors)
@@ -0,0 +1,19 @@
+from django.apps import AppConfig
+
+
+class MonitoringConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'monitoring'
+
+    def ready(self):
+        from django.core.signals import setting_changed
+        from django.db.backends.signals import connection_created
+        from .conf import monitoring_settings
+        from .metrics import instrument_serializers, registry
+        from .slow_queries import install_slow_query_log, reset_slow_query_settings
+
+        registry.start()
+        if monitoring_settings()['METRICS']:
+            instrument_serializers()
+        connection_created.connect(install_slow_query_log)
+        setting_changed.connect(reset_slow_query_settings)
@@ -0,0 +1,39 @@
+from django.conf import settings
+
+DEFAULTS = {
+    # Record the request metrics
+    'METRICS': True,
+    # Directory shared by the worker processes, None keeps the metrics per process
+    'METRICS_DIR': None,
+    # Seconds between two writes of the metrics of a process to METRICS_DIR
+    'FLUSH_INTERVAL': 5,
+    # Bearer token the scraper sends to /metrics, None leaves it open
+    'METRICS_TOKEN': None,
+    # Profile the requests of staff users sending the header, and this
+    # fraction of their other requests
+    'PROFILE_HEADER': 'X-Profile',
+    'PROFILE_SAMPLE_RATE': 0,
+    # 'cprofile' or 'sampling' (folded stacks)
+    'PROFILER': 'cprofile',
+    'SAMPLING_INTERVAL': 0.005,
+    # Ring buffer of the profiles, None is a directory in the temporary directory
+    'PROFILE_DIR': None,
+    'MAX_PROFILES': 50,
+    # Statements kept per profile and slowest SELECTs explained
+    'PROFILE_MAX_QUERIES': 1000,
+    'EXPLAIN_SLOWEST': 5,
+    # Statements slower than this are logged, None turns the slow query log off
+    'SLOW_QUERY_SECONDS': 0.1,
+    # EXPLAIN ANALYZE (PostgreSQL, MySQL) runs the statement again
+    'SLOW_QUERY_ANALYZE': False,
+    # Hours kept, fingerprints kept per hour
+    'SLOW_QUERY_HOURS': 24,
+    'SLOW_QUERY_FINGERPRINTS': 500,
+    # Keep the parameters of the slow statements and of the profiled ones.
+    # They are the values looked up and written, token keys and password
+    # hashes among them: off, each one is replaced by ?
+    'LOG_QUERY_PARAMS': False,
+}
+
+def monitoring_settings():
+    return {**DEFAULTS, **getattr(settings, 'MONITORING', {})}
@@ -0,0 +1,246 @@
+import atexit
+import bisect
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+
+from rest_framework.serializers import BaseSerializer
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name: (help, buckets), labelled with the route and the method
+HISTOGRAMS = {
+    'http_request_duration_seconds': ("Time to answer the request", LATENCY_BUCKETS),
+    'http_request_db_queries': ("Database statements run by the request", QUERY_BUCKETS),
+    'http_request_db_duration_seconds': ("Time the request spent in database statements", LATENCY_BUCKETS),
+    'http_request_serialization_seconds': ("Time the request spent in serializer data and in the renderer", LATENCY_BUCKETS),
+    'http_response_size_bytes': ("Size of the response body", SIZE_BUCKETS),
+}
+# name: help
+COUNTERS = {
+    # Labelled with the route, the method and the status code
+    'http_responses_total': "Responses sent",
+    # Labelled with the endpoint and the result, hit or miss
+    'inventory_cache_requests_total': "Lookups of the inventory response cache",
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metrics of the request being processed
+current_stats = contextvars.ContextVar('monitoring_request_stats', default = None)
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.serializing = False
+
+    # connection.execute_wrapper
+    def execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_seconds += time.perf_counter() - start
+
+# Time spent in the data property of every serializer (the nested ones are
+# rendered by their parent's data), the property of the subclasses calls this one
+def instrument_serializers():
+    data = BaseSerializer.data
+    if getattr(data.fget, 'instrumented', False):
+        return
+
+    def timed_data(serializer):
+        stats = current_stats.get()
+        if stats is None or stats.serializing:
+            return data.fget(serializer)
+        stats.serializing = True
+        start = time.perf_counter()
+        try:
+            return data.fget(serializer)
+        finally:
+            stats.serializing = False
+            stats.serialization_seconds += time.perf_counter() - start
+
+    timed_data.instrumented = True
+    BaseSerializer.data = property(timed_data)
+
+# Histograms {(name, labels): [count of every bucket and +Inf, sum]} and
+# counters {(name, labels): value}, labels is a tuple of (label, value)
+class Shard:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = [0] * (len(buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def inc(self, name, labels, value = 1):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def merge(self, other):
+        # list() copies the items of a shard still written by its thread at once
+        for key, histogram in list(other.histograms.items()):
+            mine = self.histograms.get(key)
+            if mine is None:
+                self.histograms[key] = list(histogram)
+            else:
+                for i, value in enumerate(list(histogram)):
+                    mine[i] += value
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def dump(self):
+        return {
+            'histograms': [[name, labels, histogram] for (name, labels), histogram in self.histograms.items()],
+            'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+        }
+
+    @classmethod
+    def load(cls, data):
+        shard = cls()
+        for name, labels, histogram in data['histograms']:
+            if name in HISTOGRAMS and len(histogram) == len(HISTOGRAMS[name][1]) + 2:
+                shard.histograms[(name, tuple(map(tuple, labels)))] = histogram
+        for name, labels, value in data['counters']:
+            shard.counters[(name, tuple(map(tuple, labels)))] = value
+        return shard
+
+# Every thread writes to its own shard without locking, the lock is only
+# taken when a thread creates its shard and when the shards are collected.
+# With a shared directory every process writes its metrics to its own file
+# (replaced atomically) and the scrape adds up the files of all the processes.
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = False
+        self.reset()
+
+    def reset(self):
+        self.local = threading.local()
+        self.shards = []
+        # Shards of the threads that exited
+        self.retired = Shard()
+        self.pid = os.getpid()
+        self.filename = 'metrics-%d-%d.json' % (self.pid, time.time_ns())
+        self.flushed_at = time.monotonic()
+
+    # A forked worker starts from empty metrics and writes the last ones on exit
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        os.register_at_fork(after_in_child = self.reset)
+        atexit.register(self.flush)
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def observe(self, name, labels, value):
+        self.shard().observe(name, labels, value)
+
+    def inc(self, name, labels, value = 1):
+        self.shard().inc(name, labels, value)
+
+    def collect(self):
+        total = Shard()
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self.retired.merge(shard)
+            self.shards = alive
+            total.merge(self.retired)
+        for _, shard in alive:
+            total.merge(shard)
+        return total
+
+    def flush(self, directory = None):
+        from .conf import monitoring_settings
+
+        directory = directory or monitoring_settings()['METRICS_DIR']
+        if not directory or os.getpid() != self.pid:
+            return
+        self.flushed_at = time.monotonic()
+        path = os.path.join(directory, self.filename)
+        temporary = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(temporary, 'w') as f:
+            json.dump(self.collect().dump(), f)
+        os.replace(temporary, path)
+
+    def flush_due(self, directory, interval):
+        if time.monotonic() - self.flushed_at >= interval:
+            self.flush(directory)
+
+    # Metrics of this process and of the other processes writing to directory
+    def gather(self, directory = None):
+        total = self.collect()
+        if not directory:
+            return total
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            if os.path.basename(path) == self.filename:
+                continue
+            try:
+                with open(path) as f:
+                    total.merge(Shard.load(json.load(f)))
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+        return total
+
+registry = Registry()
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, escape(value)) for label, value in labels)
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+# Prometheus text exposition format
+def exposition(shard):
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s histogram' % name)
+        for (metric, labels), histogram in sorted(shard.histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip([repr(float(bound)) for bound in buckets] + ['+Inf'], histogram):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(float(histogram[-1]))))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), cumulative))
+
+    for name, help_text in COUNTERS.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % name)
+        for (metric, labels), value in sorted(shard.counters.items()):
+            if metric == name:
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,139 @@
+import random
+import time
+from contextlib import ExitStack
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+
+from store.authentication import CachedTokenAuthentication
+from .conf import monitoring_settings
+from .metrics import RequestStats, current_stats, registry
+from .profiling import PROFILERS, ProfileStore, QueryRecorder
+
+# Requests that didn't resolve to a view share one route
+UNMATCHED_ROUTE = 'unmatched'
+
+# Record the latency, the database statements and their time, the
+# serialization time and the response size of every request per route
+# (the URL name, e.g. material-restock) in the metrics registry. Keep it
+# first in MIDDLEWARE so that the other middleware is measured too.
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.options = monitoring_settings()
+        if not self.options['METRICS']:
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        stats = RequestStats()
+        token = current_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(stats.execute))
+                response = self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        route = match.view_name if match else UNMATCHED_ROUTE
+        if route != 'metrics':
+            self.record(route, request.method, response, stats, duration)
+            if self.options['METRICS_DIR']:
+                registry.flush_due(self.options['METRICS_DIR'], self.options['FLUSH_INTERVAL'])
+        return response
+
+    # Called last (this middleware is the outermost) right before the response is rendered
+    def process_template_response(self, request, response):
+        stats = current_stats.get()
+        if stats is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                stats.serialization_seconds += time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def record(self, route, method, response, stats, duration):
+        shard = registry.shard()
+        labels = (('method', method), ('route', route))
+        shard.observe('http_request_duration_seconds', labels, duration)
+        shard.observe('http_request_db_queries', labels, stats.queries)
+        shard.observe('http_request_db_duration_seconds', labels, stats.db_seconds)
+        shard.observe('http_request_serialization_seconds', labels, stats.serialization_seconds)
+        if not response.streaming:
+            shard.observe('http_response_size_bytes', labels, len(response.content))
+        shard.inc('http_responses_total', labels + (('status', str(response.status_code)),))
+
+# Run the requests of staff users sending the PROFILE_HEADER header (or
+# picked at PROFILE_SAMPLE_RATE) under the PROFILER and save the profile with
+# the request's statements and their timings, the slowest SELECTs explained,
+# to the ring buffer served by ProfileViewSet. The response carries the
+# profile id in X-Profile-Id. Placed after AuthenticationMiddleware for the
+# session users, token users are authenticated here.
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.options = monitoring_settings()
+        self.header = 'HTTP_' + self.options['PROFILE_HEADER'].upper().replace('-', '_')
+        self.store = ProfileStore(self.options['PROFILE_DIR'], self.options['MAX_PROFILES'])
+
+    def __call__(self, request):
+        user = self.profiled_user(request)
+        if user is None:
+            return self.get_response(request)
+
+        profiler = PROFILERS[self.options['PROFILER']](self.options)
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+            profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.stop()
+        duration = time.perf_counter() - start
+
+        profile_id = self.store.new_id()
+        match = request.resolver_match
+        self.store.save(profile_id, {
+            'id': profile_id,
+            'created': timezone.now().isoformat(),
+            'method': request.method,
+            'path': request.get_full_path(),
+            'route': match.view_name if match else UNMATCHED_ROUTE,
+            'user': user.get_username(),
+            'status': response.status_code,
+            'seconds': round(duration, 6),
+            'profiler': self.options['PROFILER'],
+            'query_count': len(recorder.queries),
+            'db_seconds': round(sum(query[-1] for query in recorder.queries), 6),
+            'queries': recorder.report(
+                self.options['EXPLAIN_SLOWEST'], self.options['PROFILE_MAX_QUERIES'], self.options['LOG_QUERY_PARAMS'],
+            ),
+            'functions': profiler.top_functions(),
+        }, profiler.dump(), profiler.extension)
+        response['X-Profile-Id'] = profile_id
+        return response
+
+    # The staff user (of the session or of the token) of a request to
+    # profile, None when the request isn't profiled
+    def profiled_user(self, request):
+        rate = self.options['PROFILE_SAMPLE_RATE']
+        if self.header not in request.META and not (rate and random.random() < rate):
+            return None
+
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated:
+            try:
+                user = (CachedTokenAuthentication().authenticate(request) or (None, None))[0]
+            except AuthenticationFailed:
+                user = None
+        return user if user is not None and user.is_active and user.is_staff else None
@@ -0,0 +1,189 @@
+import cProfile
+import getpass
+import glob
+import json
+import marshal
+import os
+import re
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.db import connections
+from django.utils import timezone
+
+from .sql import explain, json_params
+
+PROFILE_ID = r'[0-9]{8}T[0-9]{12}-[0-9a-f]{8}'
+
+# Functions listed in the summary of a profile
+TOP_FUNCTIONS = 30
+
+# cProfile of the request thread, saved in the pstats format read by
+# snakeviz, flameprof or gprof2dot
+class CProfiler:
+    extension = 'prof'
+
+    def __init__(self, options):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.create_stats()
+
+    def dump(self):
+        return marshal.dumps(self.profile.stats)
+
+    def top_functions(self):
+        rows = sorted(self.profile.stats.items(), key = lambda item: item[1][3], reverse = True)[:TOP_FUNCTIONS]
+        return [
+            {
+                'function': '%s (%s:%d)' % (name, filename, line),
+                'calls': calls,
+                'self_seconds': round(self_seconds, 6),
+                'cumulative_seconds': round(cumulative_seconds, 6),
+            }
+            for (filename, line, name), (_, calls, self_seconds, cumulative_seconds, _) in rows
+        ]
+
+# Stack samples of the request thread taken every SAMPLING_INTERVAL seconds by
+# another thread, saved as folded stacks read by flamegraph.pl and speedscope.
+# Cheaper than cProfile on deep call trees, blind to what's shorter than the interval.
+class SamplingProfiler:
+    extension = 'folded'
+
+    def __init__(self, options):
+        self.interval = options['SAMPLING_INTERVAL']
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self):
+        return ''.join('%s %d\n' % item for item in sorted(self.stacks.items())).encode()
+
+    # Functions by the samples they were running in, callees included
+    def top_functions(self):
+        samples = Counter()
+        for stack, count in self.stacks.items():
+            for function in set(stack.split(';')):
+                samples[function] += count
+        return [{'function': function, 'samples': count} for function, count in samples.most_common(TOP_FUNCTIONS)]
+
+PROFILERS = {
+    'cprofile': CProfiler,
+    'sampling': SamplingProfiler,
+}
+
+# connection.execute_wrapper keeping every statement of the request with its time
+class QueryRecorder:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((context['connection'].alias, sql, params, many, time.perf_counter() - start))
+
+    # Statements in execution order, the slowest SELECTs with their plan. The
+    # parameters are redacted unless log_params, as in the slow query log.
+    def report(self, explain_slowest, max_queries, log_params = False):
+        queries = [
+            {'alias': alias, 'sql': sql, 'params': json_params(params, many, redact = not log_params), 'seconds': round(seconds, 6)}
+            for alias, sql, params, many, seconds in self.queries[:max_queries]
+        ]
+        slowest = sorted(
+            (i for i, (_, sql, _, many, _) in enumerate(self.queries[:max_queries]) if not many),
+            key = lambda i: self.queries[i][4], reverse = True,
+        )
+        explained = 0
+        for i in slowest:
+            if explained >= explain_slowest:
+                break
+            alias, sql, params, _, _ = self.queries[i]
+            plan = explain(connections[alias], sql, params)
+            if plan is not None:
+                queries[i]['explain'] = plan
+                explained += 1
+        return queries
+
+# Bounded directory of profiles, each one is <id>.json (request, SQL, top
+# functions) next to <id>.prof or <id>.folded. Ids sort by creation time,
+# saving a profile removes the oldest ones beyond max_profiles. The files,
+# and the default directory, are only readable by the user running the server.
+class ProfileStore:
+    def __init__(self, directory, max_profiles):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'inventory-profiles-%s' % getpass.getuser())
+        self.max_profiles = max_profiles
+
+    def new_id(self):
+        return '%s-%s' % (timezone.now().strftime('%Y%m%dT%H%M%S%f'), secrets.token_hex(4))
+
+    def path(self, profile_id, extension):
+        if not re.fullmatch(PROFILE_ID, profile_id or ''):
+            return None
+        return os.path.join(self.directory, '%s.%s' % (profile_id, extension))
+
+    def save(self, profile_id, report, profile, extension):
+        os.makedirs(self.directory, mode = 0o700, exist_ok = True)
+        # The report is written last, a profile is listed once complete
+        for data, name in ((profile, self.path(profile_id, extension)), (json.dumps(report).encode(), self.path(profile_id, 'json'))):
+            temporary = '%s.tmp' % name
+            with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(data)
+            os.replace(temporary, name)
+        self.prune()
+
+    def ids(self):
+        return sorted(os.path.basename(path)[:-len('.json')] for path in glob.glob(os.path.join(self.directory, '*.json')))
+
+    def prune(self):
+        ids = self.ids()
+        for profile_id in ids[:max(len(ids) - self.max_profiles, 0)]:
+            for path in glob.glob(os.path.join(self.directory, profile_id + '.*')):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def get(self, profile_id):
+        path = self.path(profile_id, 'json')
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (TypeError, OSError, ValueError):
+            return None
+
+    # Newest first, without the statements and the functions
+    def list(self):
+        reports = (self.get(profile_id) for profile_id in reversed(self.ids()))
+        return [
+            {key: value for key, value in report.items() if key not in ('queries', 'functions')}
+            for report in reports if report is not None
+        ]
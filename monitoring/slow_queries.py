@@ -0,0 +1,192 @@
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.views import APIView
+
+from .conf import monitoring_settings
+from .sql import explain, json_params
+
+logger = logging.getLogger('monitoring.slow_queries')
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'\b[0-9]+(?:\.[0-9]+)?\b')
+PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+SAVEPOINT = re.compile(r'SAVEPOINT\s+"?\w+"?')
+
+# Offenders logged when an hour is over
+SUMMARY_SIZE = 10
+
+MONITORING_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The statement with its literals, placeholders and savepoint names replaced
+# by ? and the lists of placeholders (IN (%s, %s, ...)) by (...), so that
+# statements differing only by their values or the length of their lists share it
+def normalize(sql):
+    sql = SAVEPOINT.sub('SAVEPOINT ?', sql)
+    sql = STRING.sub('?', sql)
+    sql = NUMBER.sub('?', sql.replace('%s', '?'))
+    sql = PLACEHOLDER_LIST.sub('(...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+def fingerprint(normalized):
+    return hashlib.blake2b(normalized.encode(), digest_size = 8).hexdigest()
+
+def is_project_file(filename):
+    return (
+        filename.startswith(str(settings.BASE_DIR)) and not filename.startswith(MONITORING_DIR)
+        and 'site-packages' not in filename
+    )
+
+# The innermost frame of the project's code ("material/views.py:120 in
+# inventory") and the view running the statement ("MaterialViewSet.inventory")
+def call_site():
+    site = view = None
+    frame = sys._getframe(1)
+    while frame is not None and (site is None or view is None):
+        code = frame.f_code
+        if site is None and is_project_file(code.co_filename):
+            site = '%s:%d in %s' % (os.path.relpath(code.co_filename, settings.BASE_DIR), frame.f_lineno, code.co_name)
+        if view is None:
+            instance = frame.f_locals.get('self')
+            if isinstance(instance, APIView):
+                view = '%s.%s' % (type(instance).__name__, getattr(instance, 'action', None) or code.co_name)
+        frame = frame.f_back
+    return site, view
+
+# connection.execute_wrapper installed on every connection, statements taking
+# SLOW_QUERY_SECONDS or more are aggregated per hour by fingerprint. The first
+# occurrence of a fingerprint in an hour is logged with its call site,
+# parameters (redacted unless LOG_QUERY_PARAMS) and plan, the repeats are only counted, and when an hour is over
+# its top offenders are logged. The last SLOW_QUERY_HOURS hours are kept.
+class SlowQueryLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hours = OrderedDict()
+        self.options = None
+
+    def reset(self):
+        with self.lock:
+            self.hours = OrderedDict()
+        self.options = None
+
+    def settings(self):
+        if self.options is None:
+            self.options = monitoring_settings()
+        return self.options
+
+    def __call__(self, execute, sql, params, many, context):
+        threshold = self.settings()['SLOW_QUERY_SECONDS']
+        if threshold is None or getattr(self.local, 'explaining', False):
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        seconds = time.perf_counter() - start
+        if seconds >= threshold:
+            self.record(context['connection'], sql, params, many, seconds)
+        return result
+
+    def record(self, connection, sql, params, many, seconds):
+        options = self.settings()
+        normalized = normalize(sql)
+        key = fingerprint(normalized)
+        site, view = call_site()
+        hour = timezone.now().strftime('%Y-%m-%dT%H:00')
+
+        with self.lock:
+            entries = self.hours.get(hour)
+            if entries is None:
+                entries = self.start_hour(hour, options['SLOW_QUERY_HOURS'])
+            entry = entries.get(key)
+            first = entry is None
+            if first:
+                if len(entries) >= options['SLOW_QUERY_FINGERPRINTS']:
+                    return
+                entry = entries[key] = {
+                    'fingerprint': key, 'sql': normalized, 'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+                    'call_sites': Counter(), 'views': Counter(), 'statement': None, 'params': None, 'explain': None,
+                }
+            entry['count'] += 1
+            entry['total_seconds'] += seconds
+            entry['call_sites'][site] += 1
+            entry['views'][view] += 1
+            if seconds >= entry['max_seconds']:
+                entry['max_seconds'] = seconds
+                entry['statement'] = sql
+                entry['params'] = json_params(params, many, redact = not options['LOG_QUERY_PARAMS'])
+
+        if first:
+            if not many:
+                entry['explain'] = self.explain(connection, sql, params, options['SLOW_QUERY_ANALYZE'])
+            logger.warning(
+                "Slow query %s (%.3f s) at %s in %s: %s\nparams: %s\nplan:\n%s",
+                key, seconds, site, view, sql, entry['params'], entry['explain'],
+            )
+
+    def explain(self, connection, sql, params, analyze):
+        self.local.explaining = True
+        try:
+            return explain(connection, sql, params, analyze)
+        finally:
+            self.local.explaining = False
+
+    # Called with the lock held
+    def start_hour(self, hour, hours_kept):
+        if self.hours:
+            previous, entries = next(reversed(self.hours.items()))
+            for entry in self.rank(entries)[:SUMMARY_SIZE]:
+                logger.info(
+                    "Slow queries of %s: %s ran %d times, %.3f s in total: %s",
+                    previous, entry['fingerprint'], entry['count'], entry['total_seconds'], entry['sql'],
+                )
+        entries = self.hours[hour] = {}
+        while len(self.hours) > hours_kept:
+            self.hours.popitem(last = False)
+        return entries
+
+    def rank(self, entries):
+        return sorted(entries.values(), key = lambda entry: entry['total_seconds'], reverse = True)
+
+    # The offenders of every hour kept (or of one hour), newest hour first,
+    # by total time
+    def top(self, hour = None, limit = 20):
+        with self.lock:
+            hours = [(key, self.rank(entries)[:limit]) for key, entries in reversed(self.hours.items()) if hour in (None, key)]
+            return [
+                {
+                    'hour': key,
+                    'queries': [
+                        {
+                            **entry,
+                            'total_seconds': round(entry['total_seconds'], 6),
+                            'max_seconds': round(entry['max_seconds'], 6),
+                            'call_sites': dict(entry['call_sites'].most_common()),
+                            'views': dict(entry['views'].most_common()),
+                        }
+                        for entry in entries
+                    ],
+                }
+                for key, entries in hours
+            ]
+
+slow_query_log = SlowQueryLog()
+
+# First in the list, the innermost wrapper: connection.execute_wrapper()
+# blocks open around the connection pop the last one
+def install_slow_query_log(sender, connection, **kwargs):
+    if slow_query_log not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, slow_query_log)
+
+def reset_slow_query_settings(setting, **kwargs):
+    if setting == 'MONITORING':
+        slow_query_log.options = None
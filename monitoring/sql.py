@@ -0,0 +1,43 @@
+from django.db import transaction, DatabaseError
+
+# EXPLAIN of each vendor, ANALYZE runs the statement again
+EXPLAIN = {
+    'sqlite': ('EXPLAIN QUERY PLAN ', 'EXPLAIN QUERY PLAN '),
+    'postgresql': ('EXPLAIN ', 'EXPLAIN ANALYZE '),
+    'mysql': ('EXPLAIN ', 'EXPLAIN ANALYZE '),
+}
+
+# Query plan of a SELECT as text, None for the other statements. The
+# savepoint keeps a failing EXPLAIN from breaking the caller's transaction.
+def explain(connection, sql, params, analyze = False):
+    prefixes = EXPLAIN.get(connection.vendor)
+    if prefixes is None or not sql.lstrip()[:6].upper() == 'SELECT':
+        return None
+
+    try:
+        with transaction.atomic(using = connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(prefixes[analyze] + sql, params)
+                rows = cursor.fetchall()
+    except DatabaseError as e:
+        return "EXPLAIN failed: %s" % e
+
+    # SQLite rows are (id, parent, notused, detail)
+    if connection.vendor == 'sqlite':
+        return '\n'.join(str(row[-1]) for row in rows)
+    return '\n'.join(' '.join(str(column) for column in row) for row in rows)
+
+# Parameters as JSON friendly values, each one replaced by ? when redacted
+def json_params(params, many = False, redact = False):
+    if params is None:
+        return None
+    if many:
+        return "%d parameter sets" % len(params) if hasattr(params, '__len__') else "parameter sets"
+    def plain(value):
+        if redact:
+            return '?'
+        return value if value is None or isinstance(value, (bool, int, float, str)) else str(value)
+
+    if isinstance(params, dict):
+        return {key: plain(value) for key, value in params.items()}
+    return [plain(value) for value in params]
@@ -0,0 +1,262 @@
+import json
+import marshal
+import os
+import tempfile
+import threading
+
+from django.contrib.auth import get_user_model
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+
+from store.models import Store
+from product.models import Product
+from material.models import Material, MaterialQuantity
+from .metrics import Shard, registry, exposition
+from .profiling import ProfileStore
+from .slow_queries import slow_query_log, normalize
+
+User = get_user_model()
+
+def sample(text, line):
+    for row in text.splitlines():
+        if row.startswith(line + ' '):
+            return float(row.rsplit(' ', 1)[1])
+    return None
+
+class MetricsTest(APITestCase):
+    def setUp(self):
+        registry.reset()
+        user = User.objects.create_user(username = 'admin', password = 'password')
+        store = Store.objects.create(name = 'store1', user = user)
+        product = Product.objects.create(name = 'product1', store = store)
+        material = Material.objects.create(name = 'material1', price = 1, store = store, max_capacity = 100, current_capacity = 50)
+        MaterialQuantity.objects.create(product = product, material = material, quantity = 5)
+        self.client.force_authenticate(user = user)
+
+    def metrics(self, **headers):
+        response = self.client.get('/metrics', **headers)
+        return response, response.content.decode()
+
+    def test_request_metrics_per_route(self):
+        self.client.get(reverse('material-restock'))
+        self.client.get(reverse('material-restock'))
+        self.client.get(reverse('product-product_capacity'))
+
+        response, text = self.metrics()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+
+        labels = '{method="GET",route="material-restock"}'
+        self.assertEqual(sample(text, 'http_request_duration_seconds_count' + labels), 2)
+        self.assertEqual(sample(text, 'http_request_duration_seconds_bucket{method="GET",route="material-restock",le="+Inf"}'), 2)
+        self.assertGreater(sample(text, 'http_request_db_queries_sum' + labels), 0)
+        self.assertGreater(sample(text, 'http_request_db_duration_seconds_sum' + labels), 0)
+        self.assertGreater(sample(text, 'http_request_serialization_seconds_sum' + labels), 0)
+        self.assertGreater(sample(text, 'http_response_size_bytes_sum' + labels), 0)
+        self.assertEqual(sample(text, 'http_responses_total{method="GET",route="material-restock",status="200"}'), 2)
+        self.assertEqual(sample(text, 'http_responses_total{method="GET",route="product-product_capacity",status="200"}'), 1)
+        # The scrapes aren't recorded
+        self.assertNotIn('route="metrics"', self.metrics()[1])
+
+    def test_unmatched_requests_share_a_route(self):
+        self.client.get('/nothing-here/')
+        self.client.get('/nothing-there/')
+        text = self.metrics()[1]
+        self.assertEqual(sample(text, 'http_responses_total{method="GET",route="unmatched",status="404"}'), 2)
+
+    def test_histogram_buckets_are_cumulative(self):
+        shard = Shard()
+        for value in (0.003, 0.005, 0.2, 20):
+            shard.observe('http_request_duration_seconds', (('route', 'r'),), value)
+        text = exposition(shard)
+        self.assertEqual(sample(text, 'http_request_duration_seconds_bucket{route="r",le="0.001"}'), 0)
+        self.assertEqual(sample(text, 'http_request_duration_seconds_bucket{route="r",le="0.005"}'), 2)
+        self.assertEqual(sample(text, 'http_request_duration_seconds_bucket{route="r",le="0.25"}'), 3)
+        self.assertEqual(sample(text, 'http_request_duration_seconds_bucket{route="r",le="10.0"}'), 3)
+        self.assertEqual(sample(text, 'http_request_duration_seconds_bucket{route="r",le="+Inf"}'), 4)
+        self.assertAlmostEqual(sample(text, 'http_request_duration_seconds_sum{route="r"}'), 20.208)
+
+    def test_threads_write_their_own_shards(self):
+        def work():
+            for _ in range(1000):
+                registry.inc('http_responses_total', (('route', 'r'),))
+
+        threads = [threading.Thread(target = work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The shards of the exited threads are kept
+        self.assertEqual(registry.collect().counters[('http_responses_total', (('route', 'r'),))], 4000)
+        self.assertEqual(registry.shards, [])
+        self.assertEqual(registry.collect().counters[('http_responses_total', (('route', 'r'),))], 4000)
+
+    def test_processes_share_a_directory(self):
+        directory = tempfile.mkdtemp()
+        other = Shard()
+        other.inc('http_responses_total', (('method', 'GET'), ('route', 'material-restock'), ('status', '200')), 5)
+        with open(os.path.join(directory, 'metrics-1-1.json'), 'w') as f:
+            json.dump(other.dump(), f)
+        with open(os.path.join(directory, 'metrics-2-2.json'), 'w') as f:
+            f.write('{"truncated')
+
+        with override_settings(MONITORING = {'METRICS_DIR': directory, 'FLUSH_INTERVAL': 0}):
+            self.client.get(reverse('material-restock'))
+            text = self.metrics()[1]
+        self.assertEqual(sample(text, 'http_responses_total{method="GET",route="material-restock",status="200"}'), 6)
+
+        # This process flushed its own file
+        with open(os.path.join(directory, registry.filename)) as f:
+            mine = Shard.load(json.load(f))
+        self.assertEqual(mine.counters[('http_responses_total', (('method', 'GET'), ('route', 'material-restock'), ('status', '200')))], 1)
+
+    def test_metrics_token(self):
+        with override_settings(MONITORING = {'METRICS_TOKEN': 'secret'}):
+            self.assertEqual(self.metrics()[0].status_code, 401)
+            self.assertEqual(self.metrics(HTTP_AUTHORIZATION = 'Bearer wrong')[0].status_code, 401)
+            self.assertEqual(self.metrics(HTTP_AUTHORIZATION = 'Bearer secret')[0].status_code, 200)
+
+class ProfilingTest(APITestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        staff = User.objects.create_user(username = 'staff', password = 'password', is_staff = True)
+        Store.objects.create(name = 'store1', user = staff)
+        user = User.objects.create_user(username = 'user', password = 'password')
+        Store.objects.create(name = 'store2', user = user)
+        self.staff_token = Token.objects.create(user = staff).key
+        self.user_token = Token.objects.create(user = user).key
+
+    # The middleware reads the settings when a client sends its first request
+    def get(self, path, token, options = None, **headers):
+        client = self.client_class()
+        client.credentials(HTTP_AUTHORIZATION = 'Token %s' % token)
+        with override_settings(MONITORING = {'PROFILE_DIR': self.directory, **(options or {})}):
+            return client.get(path, **headers)
+
+    def profile(self, **options):
+        return self.get(reverse('material-inventory'), self.staff_token, options, HTTP_X_PROFILE = '1')
+
+    def test_staff_request_with_header_is_profiled(self):
+        response = self.profile()
+        self.assertEqual(response.status_code, 200)
+        profile_id = response['X-Profile-Id']
+
+        listed = self.get(reverse('profile-list'), self.staff_token).json()
+        report = self.get(reverse('profile-detail', args = [profile_id]), self.staff_token).json()
+        download = self.get(reverse('profile-download', args = [profile_id]), self.staff_token)
+
+        self.assertEqual([profile['id'] for profile in listed], [profile_id])
+        self.assertNotIn('queries', listed[0])
+        self.assertEqual((report['route'], report['user'], report['status']), ('material-inventory', 'staff', 200))
+        self.assertEqual(report['query_count'], len(report['queries']))
+        self.assertTrue(any('material' in query['sql'] for query in report['queries']))
+        plans = [query['explain'] for query in report['queries'] if 'explain' in query]
+        self.assertTrue(plans)
+        self.assertFalse([plan for plan in plans if plan.startswith("EXPLAIN failed")])
+        self.assertTrue(report['functions'])
+        # pstats file
+        self.assertIsInstance(marshal.loads(b''.join(download.streaming_content)), dict)
+
+    def test_params_are_redacted_and_files_are_private(self):
+        for opted_in in (False, True):
+            profile_id = self.profile(LOG_QUERY_PARAMS = opted_in)['X-Profile-Id']
+            with open(os.path.join(self.directory, profile_id + '.json')) as f:
+                params = [value for query in json.load(f)['queries'] for value in query['params'] or []]
+            self.assertTrue(params)
+            self.assertEqual(set(params) != {'?'}, opted_in)
+        for name in os.listdir(self.directory):
+            self.assertEqual(os.stat(os.path.join(self.directory, name)).st_mode & 0o777, 0o600)
+
+    def test_sampling_profiler_writes_folded_stacks(self):
+        profile_id = self.profile(PROFILER = 'sampling', SAMPLING_INTERVAL = 0.0001)['X-Profile-Id']
+        with open(os.path.join(self.directory, profile_id + '.folded')) as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in stacks))
+
+    def test_only_staff_requests_are_profiled(self):
+        sampled = {'PROFILE_SAMPLE_RATE': 1}
+        self.assertNotIn('X-Profile-Id', self.get(reverse('material-inventory'), self.user_token, sampled, HTTP_X_PROFILE = '1'))
+        self.assertEqual(self.get(reverse('profile-list'), self.user_token).status_code, 403)
+        # Without the header nor sampling
+        self.assertNotIn('X-Profile-Id', self.get(reverse('material-inventory'), self.staff_token))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_sampled_staff_request_is_profiled(self):
+        self.assertIn('X-Profile-Id', self.get(reverse('material-inventory'), self.staff_token, {'PROFILE_SAMPLE_RATE': 1}))
+
+    def test_ring_buffer_keeps_the_newest_profiles(self):
+        ids = [self.profile(MAX_PROFILES = 2)['X-Profile-Id'] for _ in range(3)]
+        self.assertEqual(ProfileStore(self.directory, 2).ids(), ids[1:])
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+        self.assertEqual(self.get(reverse('profile-detail', args = [ids[0]]), self.staff_token).status_code, 404)
+
+class SlowQueryLogTest(APITestCase):
+    def setUp(self):
+        slow_query_log.reset()
+        self.staff = User.objects.create_user(username = 'admin', password = 'password', is_staff = True)
+        store = Store.objects.create(name = 'store1', user = self.staff)
+        Material.objects.create(name = 'material1', price = 1, store = store, max_capacity = 100, current_capacity = 50)
+        self.client.force_authenticate(user = self.staff)
+
+    def tearDown(self):
+        slow_query_log.reset()
+
+    def test_normalize(self):
+        self.assertEqual(
+            normalize("SELECT  * FROM material\nWHERE id IN (%s, %s, %s) AND name = 'it''s' LIMIT 21"),
+            normalize("SELECT * FROM material WHERE id IN (%s) AND name = 'other' LIMIT 5"),
+        )
+        self.assertEqual(normalize("SELECT T2.id FROM t1 WHERE x > 1.5"), "SELECT T2.id FROM t1 WHERE x > ?")
+        self.assertEqual(normalize('RELEASE SAVEPOINT "s1402_x12"'), "RELEASE SAVEPOINT ?")
+
+    def test_fast_statements_are_ignored(self):
+        self.client.get(reverse('material-inventory'))
+        self.assertEqual(slow_query_log.top(), [])
+
+    def test_slow_statements_are_aggregated_by_fingerprint(self):
+        # Both requests run the inventory query
+        with override_settings(MONITORING = {'SLOW_QUERY_SECONDS': 0}, INVENTORY_CACHE = {'ENABLED': False}):
+            with self.assertLogs('monitoring.slow_queries', 'WARNING') as logs:
+                self.client.get(reverse('material-inventory'))
+                logged = len(logs.records)
+                self.client.get(reverse('material-inventory'))
+            # The repeats aren't logged
+            self.assertEqual(len(logs.records), logged)
+
+            hours = slow_query_log.top()
+        self.assertEqual(len(hours), 1)
+        inventory = [query for query in hours[0]['queries'] if 'CAST' in query['sql']]
+        self.assertEqual(len(inventory), 1)
+        query = inventory[0]
+        self.assertEqual(query['count'], 2)
+        self.assertEqual(query['views'], {'MaterialViewSet.inventory': 2})
+        self.assertTrue(list(query['call_sites'])[0].startswith('material/views.py:'))
+        self.assertIn('material', query['explain'])
+        self.assertIn('Slow query %s' % query['fingerprint'], '\n'.join(record.getMessage() for record in logs.records))
+
+    def test_params_are_redacted_unless_opted_in(self):
+        for opted_in, params in [(False, ['?']), (True, ['secret'])]:
+            slow_query_log.reset()
+            with override_settings(MONITORING = {'SLOW_QUERY_SECONDS': 0, 'LOG_QUERY_PARAMS': opted_in}):
+                with self.assertLogs('monitoring.slow_queries', 'WARNING') as logs:
+                    list(Material.objects.filter(name = 'secret'))
+            query = slow_query_log.top()[0]['queries'][0]
+            self.assertEqual(query['params'], params)
+            self.assertIn('material', query['explain'])
+            self.assertEqual('secret' in logs.output[0], opted_in)
+
+    def test_slow_queries_endpoint_is_for_staff(self):
+        with override_settings(MONITORING = {'SLOW_QUERY_SECONDS': 0}):
+            with self.assertLogs('monitoring.slow_queries', 'WARNING'):
+                self.client.get(reverse('material-inventory'))
+        response = self.client.get(reverse('slow_query-list'), {'limit': 1})
+        self.assertEqual(len(response.data[0]['queries']), 1)
+        self.assertEqual(self.client.get(reverse('slow_query-list'), {'hour': '2000-01-01T00:00'}).data, [])
+
+        self.staff.is_staff = False
+        self.staff.save()
+        self.client.force_authenticate(user = self.staff)
+        self.assertEqual(self.client.get(reverse('slow_query-list')).status_code, 403)
@@ -0,0 +1,11 @@
+from django.urls import path
+from rest_framework.routers import SimpleRouter
+from . import views
+
+router = SimpleRouter()
+router.register(r'profiles', views.ProfileViewSet, basename = 'profile')
+router.register(r'slow-queries', views.SlowQueryViewSet, basename = 'slow_query')
+
+urlpatterns = [
+    path('metrics', views.metrics, name = 'metrics'),
+] + router.urls
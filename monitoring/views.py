@@ -0,0 +1,73 @@
+from django.http import HttpResponse, FileResponse, Http404
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+from rest_framework import viewsets
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from store.authentication import CachedTokenAuthentication
+from .conf import monitoring_settings
+from .metrics import CONTENT_TYPE, exposition, registry
+from .profiling import PROFILE_ID, PROFILERS, ProfileStore
+from .slow_queries import slow_query_log
+
+@require_GET
+def metrics(request):
+    options = monitoring_settings()
+    token = options['METRICS_TOKEN']
+    if token and not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer %s' % token):
+        return HttpResponse(status = 401)
+    return HttpResponse(exposition(registry.gather(options['METRICS_DIR'])), content_type = CONTENT_TYPE)
+
+# Profiles saved by ProfilingMiddleware, staff only: profiles/ lists them,
+# profiles/<id>/ returns the statements and the top functions of one and
+# profiles/<id>/download/ its .prof or .folded file
+class ProfileViewSet(viewsets.ViewSet):
+    authentication_classes = [CachedTokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAdminUser]
+    lookup_value_regex = PROFILE_ID
+
+    query_budgets = {'list': 0, 'retrieve': 0, 'download': 0}
+
+    def get_profile_store(self):
+        options = monitoring_settings()
+        return ProfileStore(options['PROFILE_DIR'], options['MAX_PROFILES'])
+
+    def get_report(self, pk):
+        report = self.get_profile_store().get(pk)
+        if report is None:
+            raise Http404
+        return report
+
+    def list(self, request):
+        return Response(self.get_profile_store().list())
+
+    def retrieve(self, request, pk = None):
+        return Response(self.get_report(pk))
+
+    @action(detail = True, methods = ['get'])
+    def download(self, request, pk = None):
+        extension = PROFILERS[self.get_report(pk)['profiler']].extension
+        try:
+            profile = open(self.get_profile_store().path(pk, extension), 'rb')
+        except OSError:
+            raise Http404
+        return FileResponse(profile, as_attachment = True, filename = '%s.%s' % (pk, extension))
+
+# Slow statements of this process aggregated per hour by fingerprint, newest
+# hour first and the statements by total time, staff only: slow-queries/ or
+# slow-queries/?hour=2026-01-01T10:00
+class SlowQueryViewSet(viewsets.ViewSet):
+    authentication_classes = [CachedTokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAdminUser]
+
+    query_budgets = {'list': 0}
+
+    def list(self, request):
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            limit = 20
+        return Response(slow_query_log.top(hour = request.query_params.get('hour'), limit = limit))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.models import Store
+from product.models import ProductCapacity
+from product.services.capacity import rebuild_product_capacities
+
+class Command(BaseCommand):
+    help = "Rebuild the product_capacity table from the materials and recipes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store', type = int, help = "Only rebuild the products of this store id")
+
+    def handle(self, *args, **options):
+        store = None
+        if options['store'] is not None:
+            try:
+                store = Store.objects.get(pk = options['store'])
+            except Store.DoesNotExist:
+                raise CommandError("Store doesn't exists!")
+
+        rebuild_product_capacities(store)
+
+        capacities = ProductCapacity.objects.all()
+        if store is not None:
+            capacities = capacities.filter(store = store)
+        self.stdout.write("Rebuilt %d product capacities" % capacities.count())
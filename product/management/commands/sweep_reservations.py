@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from product.services.reservation import release_expired
+
+class Command(BaseCommand):
+    help = "Give the stock of expired reservations back, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type = int, default = 1000, help = "Reservations released per transaction")
+        parser.add_argument('--interval', type = float, help = "Keep sweeping, sleeping this many seconds between sweeps")
+
+    def handle(self, *args, **options):
+        while True:
+            count = release_expired(batch_size = options['batch_size'])
+            self.stdout.write("Released %d expired reservations" % count)
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
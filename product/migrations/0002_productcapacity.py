@@ -0,0 +1,54 @@
+# Generated by Django 4.1.3 on 2026-10-18 04:01
+
+from django.db import migrations, models
+from django.db.models import F, Q, Min
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def fill_product_capacity(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+    ProductCapacity = apps.get_model('product', 'ProductCapacity')
+
+    products = Product.objects.annotate(
+        quantity = Coalesce(
+            Min(
+                F('product_material_quantity__material__current_capacity') / F('product_material_quantity__quantity'),
+                filter = Q(product_material_quantity__quantity__gt = 0),
+            ),
+            0,
+        )
+    ).values_list('id', 'store_id', 'quantity')
+
+    ProductCapacity.objects.bulk_create(
+        ProductCapacity(product_id = product_id, store_id = store_id, quantity = quantity)
+        for product_id, store_id, quantity in products
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0001_initial'),
+        ('product', '0001_initial'),
+        ('material', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductCapacity',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='capacity_entry', serialize=False, to='product.product')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='product_capacity_entries', to='store.store')),
+            ],
+            options={
+                'db_table': 'product_capacity',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='productcapacity',
+            index=models.Index(fields=['store', 'product'], name='product_cap_store_i_4ba493_idx'),
+        ),
+        migrations.RunPython(fill_product_capacity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.1.3 on 2026-10-18 04:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Every existing recipe is single-level: the exploded BOM is the recipe itself
+def fill_exploded_material_quantity(apps, schema_editor):
+    MaterialQuantity = apps.get_model('material', 'MaterialQuantity')
+    ExplodedMaterialQuantity = apps.get_model('product', 'ExplodedMaterialQuantity')
+
+    rows = MaterialQuantity.objects.filter(quantity__gt = 0).values_list('product_id', 'material_id', 'quantity')
+    ExplodedMaterialQuantity.objects.bulk_create(
+        ExplodedMaterialQuantity(product_id = product_id, material_id = material_id, quantity = quantity)
+        for product_id, material_id, quantity in rows.iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('material', '0002_stock_ledger'),
+        ('product', '0002_productcapacity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductComponent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveSmallIntegerField(default=0)),
+                ('component', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parent_entries', to='product.product')),
+                ('parent', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='component_entries', to='product.product')),
+            ],
+            options={
+                'db_table': 'product_component',
+                'unique_together': {('parent', 'component')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ExplodedMaterialQuantity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exploded_material_quantity', to='material.material')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exploded_material_quantity', to='product.product')),
+            ],
+            options={
+                'db_table': 'exploded_material_quantity',
+                'unique_together': {('product', 'material')},
+            },
+        ),
+        migrations.RunPython(fill_exploded_material_quantity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.3 on 2026-10-18 04:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0001_initial'),
+        ('material', '0003_reservation_reasons'),
+        ('product', '0003_bom_explosion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('held', 'Held'), ('committed', 'Committed'), ('cancelled', 'Cancelled'), ('expired', 'Expired')], default='held', max_length=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField()),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservation_entries', to='store.store')),
+            ],
+            options={
+                'db_table': 'reservation',
+            },
+        ),
+        migrations.CreateModel(
+            name='ReservationLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservation_lines', to='material.material')),
+                ('reservation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='product.reservation')),
+            ],
+            options={
+                'db_table': 'reservation_line',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['status', 'expires_at'], name='reservation_status_32109c_idx'),
+        ),
+    ]
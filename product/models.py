@@ -1,5 +1,8 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from store.models import Store
+from store.querysets import InventoryQuerySet
+from product.services.deletion import deletion
 
 class Product(models.Model):
     class Meta:
@@ -9,5 +12,93 @@ class Product(models.Model):
     name = models.CharField(max_length = 40)
     store = models.ForeignKey(Store, on_delete = models.CASCADE, related_name = "product_entries")
 
+    objects = InventoryQuerySet.as_manager()
+    store_lookup = 'store'
+
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+    # The row and its capacity row commit together
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    # Cascades through the recipes, see product.services.deletion
+    def delete(self, *args, **kwargs):
+        with deletion():
+            return super().delete(*args, **kwargs)
+
+# Remaining capacity of each product, maintained incrementally
+# whenever the stock or the recipe of the product changes
+class ProductCapacity(models.Model):
+    class Meta:
+        db_table = "product_capacity"
+        indexes = [models.Index(fields = ['store', 'product'])]
+
+    product = models.OneToOneField(Product, on_delete = models.CASCADE, primary_key = True, related_name = "capacity_entry")
+    store = models.ForeignKey(Store, on_delete = models.CASCADE, related_name = "product_capacity_entries")
+    quantity = models.PositiveIntegerField(default = 0)
+
+# Sub-assembly: quantity of the component product consumed by one parent product
+class ProductComponent(models.Model):
+    class Meta:
+        db_table = "product_component"
+        unique_together = ['parent', 'component']
+
+    parent = models.ForeignKey(Product, on_delete = models.CASCADE, related_name = "component_entries")
+    component = models.ForeignKey(Product, on_delete = models.CASCADE, related_name = "parent_entries")
+    quantity = models.PositiveSmallIntegerField(default = 0)
+
+    objects = InventoryQuerySet.as_manager()
+    store_lookup = 'parent__store'
+
+    # The row and the rebuilt exploded BOM commit together
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+# Flattened bill of materials: total raw material consumed by one product once
+# its materials and the materials of all its components are added up.
+# Rebuilt for the product and its ancestors whenever a recipe changes,
+# so that sales and capacities never walk the component tree.
+class ExplodedMaterialQuantity(models.Model):
+    class Meta:
+        db_table = "exploded_material_quantity"
+        unique_together = ['product', 'material']
+
+    product = models.ForeignKey(Product, on_delete = models.CASCADE, related_name = "exploded_material_quantity")
+    material = models.ForeignKey('material.Material', on_delete = models.CASCADE, related_name = "exploded_material_quantity")
+    quantity = models.PositiveIntegerField(default = 0)
+
+# Materials held for a basket between "add to cart" and "pay". The stock is
+# deducted when the hold is taken, so capacities and inventory already leave
+# it out, and given back when the hold is cancelled or expires.
+class Reservation(models.Model):
+    class Meta:
+        db_table = "reservation"
+        # Sweeping looks up the held reservations by expiry
+        indexes = [models.Index(fields = ['status', 'expires_at'])]
+
+    HELD = 'held'
+    COMMITTED = 'committed'
+    CANCELLED = 'cancelled'
+    EXPIRED = 'expired'
+    STATUS_CHOICES = [
+        (HELD, 'Held'),
+        (COMMITTED, 'Committed'),
+        (CANCELLED, 'Cancelled'),
+        (EXPIRED, 'Expired'),
+    ]
+
+    store = models.ForeignKey(Store, on_delete = models.CASCADE, related_name = "reservation_entries")
+    status = models.CharField(max_length = 10, choices = STATUS_CHOICES, default = HELD)
+    created_at = models.DateTimeField(default = timezone.now)
+    expires_at = models.DateTimeField()
+
+class ReservationLine(models.Model):
+    class Meta:
+        db_table = "reservation_line"
+
+    reservation = models.ForeignKey(Reservation, on_delete = models.CASCADE, related_name = "lines")
+    material = models.ForeignKey('material.Material', on_delete = models.CASCADE, related_name = "reservation_lines")
+    quantity = models.PositiveIntegerField()
@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+# Keyset pagination over the primary key, only used when the client asks for a page_size
+class IdCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+class CapacityCursorPagination(IdCursorPagination):
+    ordering = 'product'
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'remaining_capacities': data,
+        })
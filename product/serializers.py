@@ -1,9 +1,62 @@
 from rest_framework import serializers
-from .models import Product
+from .models import Product, ProductComponent, Reservation
+from .services.bom import component_graph, check_component, BomError
 
 class ProductSerializer(serializers.ModelSerializer):
     store = serializers.StringRelatedField()
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'store']
\ No newline at end of file
+        fields = ['id', 'name', 'store']
+
+# Read-only representation of ProductSerializer built from a values() row
+class ProductListSerializer(serializers.BaseSerializer):
+    values = ['id', 'name', 'store__name']
+
+    def to_representation(self, row):
+        return {
+            'id': row['id'],
+            'name': row['name'],
+            'store': row['store__name'],
+        }
+
+# Component of a sub-assembly, parent and component are products of the user's store
+class ProductComponentSerializer(serializers.ModelSerializer):
+    parent = serializers.SlugRelatedField(queryset = Product.objects.all(), slug_field = 'name')
+    component = serializers.SlugRelatedField(queryset = Product.objects.all(), slug_field = 'name')
+
+    class Meta:
+        model = ProductComponent
+        fields = ['id', 'parent', 'component', 'quantity']
+
+    # Only resolve the names among the products of the store
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        store = self.context.get('store')
+        if store is not None:
+            self.fields['parent'].queryset = Product.objects.filter(store = store)
+            self.fields['component'].queryset = Product.objects.filter(store = store)
+
+    def validate_quantity(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Please enter a valid value")
+        return value
+
+    # Check whether the component would make a product contain itself
+    def validate(self, data):
+        parent = data.get('parent', getattr(self.instance, 'parent', None))
+        component = data.get('component', getattr(self.instance, 'component', None))
+        graph = component_graph(parent.store_id)
+        if self.instance is not None:
+            graph[self.instance.parent_id].pop(self.instance.component_id, None)
+
+        try:
+            check_component(graph, parent.pk, component.pk)
+        except BomError as e:
+            raise serializers.ValidationError({'component': str(e)})
+        return data
+
+class ReservationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Reservation
+        fields = ['id', 'status', 'created_at', 'expires_at']
@@ -0,0 +1,116 @@
+from collections import defaultdict
+
+from django.db import transaction
+
+from product.models import Product, ProductComponent, ExplodedMaterialQuantity
+from material.models import MaterialQuantity
+from product.services.capacity import bom_matrix_cache, refresh_product_capacities
+
+class BomError(Exception):
+    pass
+
+# Component edges {parent_id: {component_id: quantity}} of the products of a store
+def component_graph(store_id):
+    graph = defaultdict(dict)
+    rows = ProductComponent.objects.filter(parent__store_id = store_id).values_list('parent_id', 'component_id', 'quantity')
+    for parent_id, component_id, quantity in rows:
+        graph[parent_id][component_id] = quantity
+    return graph
+
+# Every product reachable from the given ones following the edges
+def reachable(edges, product_ids):
+    seen = set(product_ids)
+    stack = list(product_ids)
+    while stack:
+        for next_id in edges.get(stack.pop(), ()):
+            if next_id not in seen:
+                seen.add(next_id)
+                stack.append(next_id)
+    return seen
+
+def ancestors(graph, product_ids):
+    parents = defaultdict(set)
+    for parent_id, components in graph.items():
+        for component_id in components:
+            parents[component_id].add(parent_id)
+    return reachable(parents, product_ids)
+
+# Adding parent -> component must not make a product contain itself
+def check_component(graph, parent_id, component_id):
+    if parent_id in reachable(graph, [component_id]):
+        raise BomError("A product can't be a component of itself")
+
+# Order the products so that every component comes before its parents
+def components_first(graph, product_ids):
+    order = []
+    done = set()
+    for product_id in product_ids:
+        if product_id in done:
+            continue
+        # Iterative post-order walk restricted to product_ids
+        stack = [(product_id, iter(graph.get(product_id, ())))]
+        done.add(product_id)
+        while stack:
+            node, components = stack[-1]
+            for component_id in components:
+                if component_id in product_ids and component_id not in done:
+                    done.add(component_id)
+                    stack.append((component_id, iter(graph.get(component_id, ()))))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+# Raw material of each product {product_id: {material_id: quantity}}: its own
+# materials plus the exploded materials of its components times their quantity
+def explode(graph, product_ids, recipes, exploded):
+    for product_id in components_first(graph, product_ids):
+        materials = defaultdict(int)
+        for material_id, quantity in recipes.get(product_id, {}).items():
+            materials[material_id] += quantity
+        for component_id, count in graph.get(product_id, {}).items():
+            for material_id, quantity in exploded.get(component_id, {}).items():
+                materials[material_id] += quantity * count
+        exploded[product_id] = {material_id: quantity for material_id, quantity in materials.items() if quantity > 0}
+    return exploded
+
+# Rebuild the exploded BOM of the given products and of every product that
+# contains them, then their capacities. The query count doesn't depend on the
+# depth of the tree: the component graph of the store, the recipes of the
+# affected products and the exploded BOM of their untouched components are
+# each read with one query. Materials in exclude_materials are left out.
+def rebuild_explosions(product_ids, exclude_materials = ()):
+    products = defaultdict(set)
+    for product_id, store_id in Product.objects.filter(pk__in = product_ids).values_list('id', 'store_id'):
+        products[store_id].add(product_id)
+
+    with transaction.atomic():
+        for store_id, product_ids in products.items():
+            graph = component_graph(store_id)
+            affected = ancestors(graph, product_ids)
+
+            recipes = defaultdict(dict)
+            rows = MaterialQuantity.objects.filter(product_id__in = affected, quantity__gt = 0).exclude(material_id__in = exclude_materials)
+            rows = rows.values_list('product_id', 'material_id', 'quantity')
+            for product_id, material_id, quantity in rows:
+                recipes[product_id][material_id] = quantity
+
+            # Components outside of the affected products keep their exploded BOM
+            untouched = {component_id for product_id in affected for component_id in graph.get(product_id, ())} - affected
+            exploded = defaultdict(dict)
+            rows = ExplodedMaterialQuantity.objects.filter(product_id__in = untouched).exclude(material_id__in = exclude_materials)
+            rows = rows.values_list('product_id', 'material_id', 'quantity')
+            for product_id, material_id, quantity in rows:
+                exploded[product_id][material_id] = quantity
+
+            explode(graph, affected, recipes, exploded)
+
+            ExplodedMaterialQuantity.objects.filter(product_id__in = affected).delete()
+            ExplodedMaterialQuantity.objects.bulk_create(
+                ExplodedMaterialQuantity(product_id = product_id, material_id = material_id, quantity = quantity)
+                for product_id in affected
+                for material_id, quantity in exploded[product_id].items()
+            )
+            refresh_product_capacities(list(affected))
+            bom_matrix_cache.invalidate(store_id)
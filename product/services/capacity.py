@@ -0,0 +1,231 @@
+import threading
+import time
+from array import array
+from operator import floordiv
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Min, Case, When, Exists, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+
+from product.models import Product, ProductCapacity, ExplodedMaterialQuantity
+from material.models import Material
+from material.services.shards import stock_expression
+
+# Products x materials quantity matrix of a store in CSR layout:
+# the materials of the product in row r are columns[indptr[r]:indptr[r + 1]]
+class BomMatrix:
+    def __init__(self, product_ids, material_ids, indptr, columns, quantities):
+        self.product_ids = product_ids
+        self.material_index = {material_id: i for i, material_id in enumerate(material_ids)}
+        self.material_ids = material_ids
+        self.indptr = indptr
+        self.columns = columns
+        self.quantities = quantities
+        self.built_at = time.monotonic()
+
+    # Build the matrix from (product_id, material_id, quantity) rows sorted by product,
+    # material_id and quantity are None for a product without material
+    @classmethod
+    def from_rows(cls, rows, material_ids):
+        material_index = {material_id: i for i, material_id in enumerate(material_ids)}
+        product_ids = array('q')
+        indptr = array('q', [0])
+        columns = array('q')
+        quantities = array('q')
+
+        for product_id, material_id, quantity in rows:
+            if not product_ids or product_ids[-1] != product_id:
+                if product_ids:
+                    indptr.append(len(columns))
+                product_ids.append(product_id)
+
+            # Material that isn't consumed doesn't limit the capacity
+            if material_id is None or not quantity:
+                continue
+            columns.append(material_index[material_id])
+            quantities.append(quantity)
+
+        if product_ids:
+            indptr.append(len(columns))
+
+        return cls(product_ids, array('q', material_ids), indptr, columns, quantities)
+
+    @classmethod
+    def build(cls, store_id):
+        material_ids = list(Material.objects.filter(store_id = store_id).order_by('id').values_list('id', flat = True))
+        rows = Product.objects.filter(store_id = store_id).order_by('id').values_list(
+            'id', 'exploded_material_quantity__material_id', 'exploded_material_quantity__quantity'
+        )
+        return cls.from_rows(rows, material_ids)
+
+    # Capacity vector aligned with the columns of the matrix
+    def capacity_vector(self, current_capacities):
+        vector = array('q', bytes(8 * len(self.material_ids)))
+        for material_id, current_capacity in current_capacities:
+            index = self.material_index.get(material_id)
+            if index is not None:
+                vector[index] = current_capacity
+        return vector
+
+    # Floor-divide every non-zero entry by the capacity of its column in one pass,
+    # then reduce each row with min. A product without material can't be produced.
+    def remaining_capacities(self, vector):
+        producible = list(map(floordiv, map(vector.__getitem__, self.columns), self.quantities))
+        indptr = self.indptr
+        return [
+            min(producible[indptr[row]:indptr[row + 1]], default = 0)
+            for row in range(len(self.product_ids))
+        ]
+
+# The matrix is built outside the lock. Invalidations bump the store's
+# generation (clear() bumps every store's through the epoch), a build that
+# saw the generation change is returned but not cached.
+class BomMatrixCache:
+    def __init__(self, ttl = None):
+        self.ttl = ttl
+        self.matrices = {}
+        self.generations = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+    def generation(self, store_id):
+        return self.epoch, self.generations.get(store_id, 0)
+
+    def get(self, store_id):
+        matrix = self.matrices.get(store_id)
+        if matrix is not None and (self.ttl is None or time.monotonic() - matrix.built_at < self.ttl):
+            return matrix
+
+        with self.lock:
+            generation = self.generation(store_id)
+        matrix = BomMatrix.build(store_id)
+        with self.lock:
+            if self.generation(store_id) == generation:
+                self.matrices[store_id] = matrix
+        return matrix
+
+    def invalidate(self, store_id):
+        with self.lock:
+            self.generations[store_id] = self.generations.get(store_id, 0) + 1
+            self.matrices.pop(store_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.generations.clear()
+            self.matrices.clear()
+
+# Signals only reach the current process, the TTL bounds how long
+# other worker processes may keep serving a stale matrix
+bom_matrix_cache = BomMatrixCache(ttl = getattr(settings, 'BOM_MATRIX_CACHE_TTL', 60))
+
+def matrix_capacities(store):
+    matrix = bom_matrix_cache.get(store.pk)
+    current_capacities = Material.objects.filter(store = store).annotate(stock = stock_expression()).values_list('id', 'stock')
+    quantities = matrix.remaining_capacities(matrix.capacity_vector(current_capacities))
+    return [
+        {'product': product_id, 'quantity': quantity}
+        for product_id, quantity in zip(matrix.product_ids, quantities)
+    ]
+
+# MIN(stock / quantity) per product in one GROUP BY over the exploded BOM
+# joined to material, products without material are kept by the left join and default to 0
+def annotate_capacity(products):
+    return products.annotate(
+        quantity = Coalesce(
+            Min(
+                stock_expression('exploded_material_quantity__material__') / F('exploded_material_quantity__quantity'),
+                filter = Q(exploded_material_quantity__quantity__gt = 0),
+            ),
+            0,
+        )
+    )
+
+# Both querysets yield {'product', 'quantity'} rows ordered by product
+def capacity_queryset(store):
+    products = Product.objects.filter(store = store).annotate(product = F('id'))
+    return annotate_capacity(products).order_by('product').values('product', 'quantity')
+
+# The table rows of the products using a sharded material aren't written by
+# the sales (see refresh_material_capacities), those products are computed on
+# read. So are the products left without a row by a bulk_create: the left join
+# keeps them, a product without material is reported 0.
+def table_queryset(store):
+    sharded = ExplodedMaterialQuantity.objects.filter(product = OuterRef('id'), material__shard_count__gt = 0)
+    computed = annotate_capacity(Product.objects.filter(pk = OuterRef('id'))).values('quantity')
+    products = Product.objects.filter(store = store).annotate(
+        product = F('id'),
+        quantity = Case(
+            When(Q(capacity_entry__isnull = True) | Q(Exists(sharded)), then = Subquery(computed)),
+            default = F('capacity_entry__quantity'),
+            output_field = IntegerField(),
+        ),
+    )
+    return products.order_by('product').values('product', 'quantity')
+
+def serialize_capacities(rows):
+    return [{'product': row['product'], 'quantity': row['quantity']} for row in rows]
+
+def sql_capacities(store):
+    return serialize_capacities(capacity_queryset(store))
+
+def table_capacities(store):
+    return serialize_capacities(table_queryset(store))
+
+CAPACITY_ENGINES = {
+    'table': table_capacities,
+    'matrix': matrix_capacities,
+    'sql': sql_capacities,
+}
+
+def capacity_engine():
+    return getattr(settings, 'PRODUCT_CAPACITY_ENGINE', 'table')
+
+def product_capacities(store):
+    return CAPACITY_ENGINES[capacity_engine()](store)
+
+# Queryset paged by the cursor pagination, only the table is paged without aggregating
+def paged_capacity_queryset(store):
+    if capacity_engine() == 'table':
+        return table_queryset(store)
+    return capacity_queryset(store)
+
+# Recompute the ProductCapacity rows of the given products (ids or a queryset of ids)
+# with one aggregation and one upsert, inside the caller's transaction
+def refresh_product_capacities(product_ids):
+    rows = annotate_capacity(Product.objects.filter(pk__in = product_ids)).values_list('id', 'store_id', 'quantity')
+    ProductCapacity.objects.bulk_create(
+        [
+            ProductCapacity(product_id = product_id, store_id = store_id, quantity = quantity)
+            for product_id, store_id, quantity in rows
+        ],
+        update_conflicts = True,
+        unique_fields = ['product_id'],
+        update_fields = ['quantity'],
+    )
+
+# Only the products that use the materials are recomputed. Sharded materials
+# are skipped: every sale would write the rows of all their products again and
+# queue on them, table_queryset computes those products on read instead.
+def refresh_material_capacities(material_ids):
+    product_ids = ExplodedMaterialQuantity.objects.filter(
+        material_id__in = material_ids, material__shard_count = 0,
+    ).values('product_id')
+    refresh_product_capacities(product_ids)
+
+# Rebuild the whole table (or the table of one store) from scratch
+def rebuild_product_capacities(store = None):
+    products = Product.objects.all()
+    capacities = ProductCapacity.objects.all()
+    if store is not None:
+        products = products.filter(store = store)
+        capacities = capacities.filter(store = store)
+
+    with transaction.atomic():
+        capacities.delete()
+        rows = annotate_capacity(products).values_list('id', 'store_id', 'quantity')
+        ProductCapacity.objects.bulk_create(
+            ProductCapacity(product_id = product_id, store_id = store_id, quantity = quantity)
+            for product_id, store_id, quantity in rows.iterator()
+        )
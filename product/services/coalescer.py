@@ -0,0 +1,197 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent import futures
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from material.models import StockMovement
+from material.services.stock import apply_stock_deltas, StockError
+from product.services.sale import aggregate_sales, load_recipes, basket_demand, process_sales, SaleError
+
+# The sale timed out once the worker had started applying it, it may be sold
+class SalePending(Exception):
+    pass
+
+class PendingSale:
+    QUEUED, APPLYING, CANCELLED = 'queued', 'applying', 'cancelled'
+
+    def __init__(self, store, product_quantities):
+        self.store = store
+        self.product_quantities = product_quantities
+        self.future = futures.Future()
+        self.state = self.QUEUED
+        self.lock = threading.Lock()
+
+    # Taken by the worker before the sale is applied, fails once cancelled
+    def claim(self):
+        with self.lock:
+            if self.state != self.QUEUED:
+                return False
+            self.state = self.APPLYING
+            return True
+
+    # Taken by a seller giving up, fails once the worker claimed the sale
+    def cancel(self):
+        with self.lock:
+            if self.state != self.QUEUED:
+                return False
+            self.state = self.CANCELLED
+            return True
+
+# Apply the queued sales of one store in one transaction. Every sale is accepted
+# or rejected in arrival order against the stock left by the sales accepted before
+# it, then the accepted demand is deducted with one guarded UPDATE per batch
+# instead of one per sale. Returns one SaleError or None per sale.
+def apply_sale_batch(store, pending):
+    product_ids = {product_id for sale in pending for product_id in sale.product_quantities}
+
+    try:
+        with transaction.atomic():
+            recipes, current_capacities = load_recipes(product_ids, store)
+
+            results = []
+            total = defaultdict(int)
+            for sale in pending:
+                # Product doesn't exist or doesn't belong to the store
+                if any(product_id not in recipes for product_id in sale.product_quantities):
+                    results.append(SaleError("Please enter a valid sale data"))
+                    continue
+
+                demand = basket_demand(recipes, sale.product_quantities)
+                ## Check is it able to sale after the sales accepted so far
+                if any(current_capacities[material_id] - total[material_id] < quantity for material_id, quantity in demand.items()):
+                    results.append(SaleError("Please enter a valid sale data"))
+                    continue
+
+                for material_id, quantity in demand.items():
+                    total[material_id] += quantity
+                results.append(None)
+
+            apply_stock_deltas({material_id: -quantity for material_id, quantity in total.items()}, StockMovement.SALE)
+        return results
+
+    except StockError:
+        # The stock changed outside of the coalescer since it was read:
+        # settle the sales one by one on the per-request path
+        results = []
+        for sale in pending:
+            try:
+                process_sales(
+                    [{'product': product_id, 'quantity': quantity} for product_id, quantity in sale.product_quantities.items()],
+                    store = store,
+                )
+                results.append(None)
+            except SaleError as e:
+                results.append(e)
+        return results
+
+# Queue the sales and apply them in micro-batches of at most max_batch sales,
+# collected for at most max_delay seconds after the first one, from one
+# background thread. Hot materials are then locked once per batch instead
+# of once per request.
+class SaleCoalescer:
+    def __init__(self, max_batch = 100, max_delay = 0.005):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def submit(self, sales, store):
+        # Invalid baskets are rejected right away
+        sale = PendingSale(store, aggregate_sales(sales))
+        self.queue.put(sale)
+        self.start()
+        return sale
+
+    # Sell like process_sales: returns once the sale is applied, raises SaleError
+    # when rejected. On timeout a sale still queued is cancelled and
+    # futures.TimeoutError raised, nothing was sold; a sale the worker already
+    # took raises SalePending, it is sold or rejected without the caller.
+    def sell(self, sales, store, timeout = None):
+        sale = self.submit(sales, store)
+        try:
+            error = sale.future.result(timeout)
+        except futures.TimeoutError:
+            if sale.cancel():
+                raise
+            raise SalePending("Sale is being applied")
+        if error is not None:
+            raise error
+
+    def start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target = self.run, name = 'sale-coalescer', daemon = True)
+                self.worker.start()
+
+    def stop(self):
+        with self.lock:
+            worker = self.worker
+            self.worker = None
+        if worker is not None:
+            self.queue.put(None)
+            worker.join()
+
+    def collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                sale = self.queue.get(timeout = remaining)
+            except queue.Empty:
+                break
+            if sale is None:
+                # Stop once this batch is applied
+                self.queue.put(None)
+                break
+            batch.append(sale)
+        return batch
+
+    def run(self):
+        try:
+            while True:
+                batch = self.collect()
+                if batch is None:
+                    return
+                self.apply(batch)
+        finally:
+            connection.close()
+
+    # The sales cancelled by their seller are dropped
+    def apply(self, batch):
+        self.apply_sales([sale for sale in batch if sale.claim()])
+
+    def apply_sales(self, batch):
+        stores = defaultdict(list)
+        for sale in batch:
+            stores[sale.store.pk].append(sale)
+
+        for pending in stores.values():
+            try:
+                results = apply_sale_batch(pending[0].store, pending)
+            except Exception as e:
+                for sale in pending:
+                    sale.future.set_exception(e)
+                continue
+
+            for sale, result in zip(pending, results):
+                sale.future.set_result(result)
+
+def coalescing_settings():
+    return getattr(settings, 'SALE_COALESCING', {})
+
+sale_coalescer = SaleCoalescer(
+    max_batch = coalescing_settings().get('MAX_BATCH', 100),
+    max_delay = coalescing_settings().get('MAX_DELAY', 0.005),
+)
@@ -0,0 +1,33 @@
+import threading
+from contextlib import contextmanager
+
+# Products, materials and stores in the middle of a (cascading) delete,
+# marked by pre_delete and unmarked by post_delete: the recipes using them
+# are deleted first and mustn't be rebuilt from them in between
+deleting = threading.local()
+
+def being_deleted(name):
+    if not hasattr(deleting, name):
+        setattr(deleting, name, set())
+    return getattr(deleting, name)
+
+# Products whose recipe lost rows during the current delete
+def pending_recipes():
+    return being_deleted('pending_recipes')
+
+# Deletes run inside it: a delete failing between pre_delete and post_delete
+# (a locked database, a protected row) leaves the marks as they were before
+# it, later recipe changes of the thread aren't deferred forever
+@contextmanager
+def deletion():
+    marks = {name: set(ids) for name, ids in vars(deleting).items()}
+    try:
+        yield
+    except BaseException:
+        for name, ids in vars(deleting).items():
+            ids.intersection_update(marks.get(name, ()))
+        raise
+
+def forget_deletions():
+    for ids in vars(deleting).values():
+        ids.clear()
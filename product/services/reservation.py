@@ -0,0 +1,119 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from product.models import Reservation, ReservationLine
+from product.services.sale import aggregate_sales, material_demand, SaleError
+from material.models import StockMovement
+from material.services.stock import apply_stock_deltas, StockError
+
+class ReservationError(Exception):
+    pass
+
+def reservation_ttl():
+    return getattr(settings, 'RESERVATION_TTL', 900)
+
+def reservation_max_ttl():
+    return getattr(settings, 'RESERVATION_MAX_TTL', 24 * 60 * 60)
+
+# Hold the materials of a basket for ttl seconds, all or nothing.
+# Like process_sales the stock is deducted with one guarded UPDATE.
+def reserve(sales, store, ttl = None):
+    try:
+        product_quantities = aggregate_sales(sales)
+    except SaleError as e:
+        raise ReservationError(str(e))
+
+    with transaction.atomic():
+        try:
+            demand, current_capacities = material_demand(product_quantities, store)
+        except SaleError as e:
+            raise ReservationError(str(e))
+
+        ## Check is it able to reserve
+        for material_id, quantity in demand.items():
+            if current_capacities[material_id] < quantity:
+                raise ReservationError("Please enter a valid sale data")
+
+        try:
+            apply_stock_deltas({material_id: -quantity for material_id, quantity in demand.items()}, StockMovement.RESERVATION)
+        except StockError:
+            raise ReservationError("Please enter a valid sale data")
+
+        now = timezone.now()
+        reservation = Reservation.objects.create(
+            store = store,
+            created_at = now,
+            expires_at = now + timedelta(seconds = reservation_ttl() if ttl is None else ttl),
+        )
+        ReservationLine.objects.bulk_create(
+            ReservationLine(reservation = reservation, material_id = material_id, quantity = quantity)
+            for material_id, quantity in demand.items()
+        )
+
+    return reservation
+
+# The held stock becomes a sale: nothing to give back. A hold that has
+# expired can't be committed even if the sweeper hasn't released it yet.
+def commit_reservation(reservation_id, store):
+    committed = Reservation.objects.filter(
+        pk = reservation_id, store = store, status = Reservation.HELD, expires_at__gt = timezone.now(),
+    ).update(status = Reservation.COMMITTED)
+
+    if not committed:
+        raise ReservationError("Reservation is not held anymore")
+
+# Give the stock of the given held reservations back and mark them with status.
+# The guarded status UPDATE makes sure each hold is released once. The held
+# units are given back even when the materials were restocked up to their
+# max_capacity meanwhile (the restock doesn't see the holds).
+def release_reservations(reservation_ids, status):
+    with transaction.atomic():
+        rows = ReservationLine.objects.filter(reservation_id__in = reservation_ids).values('material_id').annotate(quantity = Sum('quantity'))
+        deltas = {row['material_id']: row['quantity'] for row in rows}
+
+        released = Reservation.objects.filter(pk__in = reservation_ids, status = Reservation.HELD).update(status = status)
+        if released != len(reservation_ids):
+            raise ReservationError("Reservation is not held anymore")
+
+        try:
+            apply_stock_deltas(deltas, StockMovement.RELEASE, bounded = False)
+        except StockError:
+            raise ReservationError("Reservation can't be released")
+    return released
+
+def cancel_reservation(reservation_id, store):
+    if not Reservation.objects.filter(pk = reservation_id, store = store, status = Reservation.HELD).exists():
+        raise ReservationError("Reservation is not held anymore")
+    release_reservations([reservation_id], Reservation.CANCELLED)
+
+# Release the expired holds batch by batch: each batch is one range scan of
+# the (status, expires_at) index, one aggregate of the held quantities, one
+# status UPDATE and one guarded stock UPDATE, whatever the number of holds.
+# A batch that can't be released is retried hold by hold, the holds failing
+# on their own are left held and skipped until the next run.
+def release_expired(batch_size = 1000, now = None):
+    now = now or timezone.now()
+    total = 0
+    failed = []
+    while True:
+        with transaction.atomic():
+            expired = Reservation.objects.filter(status = Reservation.HELD, expires_at__lte = now).exclude(pk__in = failed).order_by('expires_at')
+            # Concurrent sweepers skip each other's batches where rows can be locked
+            reservation_ids = list(expired.select_for_update(skip_locked = True).values_list('id', flat = True)[:batch_size])
+            if reservation_ids:
+                # release_reservations rolls its own savepoint back when it fails
+                try:
+                    total += release_reservations(reservation_ids, Reservation.EXPIRED)
+                except ReservationError:
+                    for reservation_id in reservation_ids:
+                        try:
+                            total += release_reservations([reservation_id], Reservation.EXPIRED)
+                        except ReservationError:
+                            failed.append(reservation_id)
+
+        if len(reservation_ids) < batch_size:
+            return total
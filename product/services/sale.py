@@ -1,31 +1,94 @@
-from rest_framework.response import Response
+from collections import defaultdict
 
 from product.models import Product
-from material.models import Material, MaterialQuantity
-
-def process_sales(sales):
-  track_material_quantity = {}
-  for sale in sales:
-    product = sale['product']
-    quantity = sale['quantity']
-    materials = Product.objects.get(pk = product).material_entries.all()
-    for material in materials:
-        mq = MaterialQuantity.objects.get(material = material, product = product)
-        
-        ## Check is it able to sale
-        # If current capacity is less than the required quantity 
-        # Response an error message
-        if material.current_capacity - (mq.quantity * quantity) < 0:
-            return Response({"error_messages": "Please enter a valid sale data"})
-
-        # Initialize the material to be tracked
-        if material not in track_material_quantity:
-            track_material_quantity[material.pk] = 0
-        # Track the quantity for each material that will be deducted later
-        track_material_quantity[material.pk] += mq.quantity * quantity
-
-  ## Product sold successfully and have to deduct the material that have been sold
-  for material_id in track_material_quantity:
-    m = Material.objects.get(pk = material_id)
-    m.current_capacity -= track_material_quantity[material_id]
-    m.save()
+from material.models import StockMovement
+from material.services.stock import apply_stock_deltas, StockError
+from material.services.shards import stock_expression
+
+class SaleError(Exception):
+    pass
+
+# Merge repeated products of the basket into {product_id: quantity}
+def aggregate_sales(sales):
+    product_quantities = defaultdict(int)
+    for sale in sales:
+        try:
+            product = int(sale['product'])
+            quantity = int(sale['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise SaleError("Please enter a valid sale data")
+
+        if quantity <= 0:
+            raise SaleError("Please enter a valid sale data")
+        product_quantities[product] += quantity
+
+    if not product_quantities:
+        raise SaleError("Please enter a valid sale data")
+
+    return product_quantities
+
+# Load the exploded bill of materials of the products in one joined query:
+# {product_id: {material_id: quantity}} of the products found in the store
+# and the current capacity of every material they use
+def load_recipes(product_ids, store = None):
+    products = Product.objects.filter(pk__in = product_ids)
+    if store is not None:
+        products = products.filter(store = store)
+
+    rows = products.annotate(stock = stock_expression('exploded_material_quantity__material__')).values_list(
+        'id',
+        'exploded_material_quantity__material_id',
+        'exploded_material_quantity__quantity',
+        'stock',
+    )
+
+    recipes = {}
+    current_capacities = {}
+    for product_id, material_id, quantity, current_capacity in rows:
+        materials = recipes.setdefault(product_id, {})
+        # Product without material or material that is not consumed
+        if material_id is None or not quantity:
+            continue
+        materials[material_id] = quantity
+        current_capacities[material_id] = current_capacity
+
+    return recipes, current_capacities
+
+# Demand of every material for {product_id: quantity}
+def basket_demand(recipes, product_quantities):
+    demand = defaultdict(int)
+    for product_id, count in product_quantities.items():
+        for material_id, quantity in recipes[product_id].items():
+            demand[material_id] += quantity * count
+    return demand
+
+# Merge the demand of materials shared across products of the basket
+def material_demand(product_quantities, store = None):
+    recipes, current_capacities = load_recipes(product_quantities.keys(), store)
+
+    # Product doesn't exist or doesn't belong to the store
+    if len(recipes) != len(product_quantities):
+        raise SaleError("Please enter a valid sale data")
+
+    return basket_demand(recipes, product_quantities), current_capacities
+
+# Deduct every material of the basket or nothing at all.
+# The query count doesn't depend on the size of the basket:
+# one SELECT for the bill of materials, then one guarded UPDATE
+# and the ledger and capacity writes of apply_stock_deltas.
+# The SELECT runs before the transaction of apply_stock_deltas, which starts
+# with the guarded UPDATE: the stock read is only an early rejection.
+def process_sales(sales, store = None):
+    product_quantities = aggregate_sales(sales)
+    demand, current_capacities = material_demand(product_quantities, store)
+
+    ## Check is it able to sale
+    for material_id, quantity in demand.items():
+        if current_capacities[material_id] < quantity:
+            raise SaleError("Please enter a valid sale data")
+
+    try:
+        apply_stock_deltas({material_id: -quantity for material_id, quantity in demand.items()}, StockMovement.SALE)
+    except StockError:
+        # A material has been sold concurrently since it was read
+        raise SaleError("Please enter a valid sale data")
@@ -0,0 +1,74 @@
+from django.core.signals import request_started
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from .models import Product, ProductComponent
+from store.models import Store
+from material.models import Material, MaterialQuantity
+from .services.capacity import bom_matrix_cache, refresh_product_capacities, refresh_material_capacities
+from .services.bom import rebuild_explosions
+from .services.deletion import being_deleted, pending_recipes, forget_deletions
+
+# Whatever failed delete escaped deletion() doesn't outlive its request
+@receiver(request_started)
+def forget_failed_deletes(sender, **kwargs):
+    forget_deletions()
+
+@receiver(pre_delete, sender = Product)
+@receiver(pre_delete, sender = Material)
+def start_delete(sender, instance, **kwargs):
+    being_deleted(sender._meta.model_name).add(instance.pk)
+
+@receiver(post_delete, sender = Product)
+@receiver(post_delete, sender = Material)
+def end_delete(sender, instance, **kwargs):
+    being_deleted(sender._meta.model_name).discard(instance.pk)
+    if not being_deleted('product') and not being_deleted('material'):
+        product_ids = set(pending_recipes())
+        pending_recipes().clear()
+        rebuild_recipes(product_ids)
+
+# Recipes changed by a cascading delete are rebuilt once, after the last
+# deleted product or material is gone, instead of once per deleted row
+def rebuild_recipes(product_ids):
+    product_ids = set(product_ids) - being_deleted('product')
+    if being_deleted('product') or being_deleted('material'):
+        pending_recipes().update(product_ids)
+    elif product_ids:
+        rebuild_explosions(product_ids)
+
+# Forget the matrix of a store that is created or deleted
+@receiver(post_save, sender = Store)
+@receiver(post_delete, sender = Store)
+def invalidate_store_matrix(sender, instance, **kwargs):
+    bom_matrix_cache.invalidate(instance.pk)
+
+# Rows of the BOM matrix change with the products of the store
+@receiver(post_save, sender = Product)
+@receiver(post_delete, sender = Product)
+def invalidate_product_matrix(sender, instance, **kwargs):
+    bom_matrix_cache.invalidate(instance.store_id)
+
+# A new product starts with a capacity of 0
+@receiver(post_save, sender = Product)
+def create_product_capacity(sender, instance, created, **kwargs):
+    if created:
+        refresh_product_capacities([instance.pk])
+
+# The recipe of the product changed: rebuild the exploded BOM, the capacity
+# and the BOM matrix of the product and of every product containing it
+@receiver(post_save, sender = MaterialQuantity)
+@receiver(post_delete, sender = MaterialQuantity)
+def rebuild_recipe(sender, instance, **kwargs):
+    rebuild_recipes([instance.product_id])
+
+@receiver(post_save, sender = ProductComponent)
+@receiver(post_delete, sender = ProductComponent)
+def rebuild_parent_recipe(sender, instance, **kwargs):
+    rebuild_recipes([instance.parent_id])
+
+# The stock of a material changed through Model.save()
+@receiver(post_save, sender = Material)
+def refresh_stock_capacity(sender, instance, created, update_fields, **kwargs):
+    if not created and (update_fields is None or 'current_capacity' in update_fields):
+        refresh_material_capacities([instance.pk])
@@ -1,13 +1,27 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from store.models import Store
 from django.contrib.auth import get_user_model
 from .models import Product
-from django.db import IntegrityError
+from django.db import IntegrityError, DatabaseError, transaction
+from django.db.models.signals import pre_delete
 from .serializers import ProductSerializer
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from django.urls import reverse
-from material.models import MaterialQuantity, Material
+from material.models import MaterialQuantity, Material, StockMovement
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .services.sale import process_sales, SaleError
+from .services.capacity import BomMatrix, BomMatrixCache, sql_capacities, rebuild_product_capacities
+from .models import ProductCapacity, ProductComponent, ExplodedMaterialQuantity, Reservation
+from .services.reservation import release_expired
+from .services.coalescer import SaleCoalescer, PendingSale, SalePending, apply_sale_batch, sale_coalescer
+from concurrent import futures
+import time
+import threading
+from datetime import timedelta
+from django.utils import timezone
+from .services.bom import rebuild_explosions
 
 User = get_user_model()
 
@@ -199,6 +213,19 @@ class ProductViewTest(APITestCase):
         response = self.client.get(url)
         self.assertIn('[]', response.content.decode())
 
+    def test_list_product_matches_product_serializer(self):
+        # authentication
+        self.force_authentication()
+
+        store = Store.objects.get(pk = 1)
+        self.create_product('product1', store)
+        self.create_product('product2', store)
+
+        url = reverse('product-list')
+        response = self.client.get(url)
+        expected = ProductSerializer(Product.objects.order_by('id'), many = True).data
+        self.assertEqual(response.json(), [dict(product) for product in expected])
+
 class ProductCapacityViewTest(APITestCase):
     def setUp(self):
         user = User.objects.create_user(username = 'admin', password = 'password')
@@ -227,6 +254,173 @@ class ProductCapacityViewTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn("remaining_capacities", response.content.decode())
 
+    def test_product_capacity_quantities(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-product_capacity')
+        response = self.client.get(url)
+        self.assertEqual(response.data['remaining_capacities'], [
+            {'product': 1, 'quantity': 5},
+            {'product': 2, 'quantity': 0},
+        ])
+
+    def test_product_capacity_follows_material_quantity_changes(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-product_capacity')
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute = True):
+            MaterialQuantity.objects.create(product = Product.objects.get(pk = 2), material = Material.objects.get(pk = 2), quantity = 17)
+        response = self.client.get(url)
+        self.assertEqual(response.data['remaining_capacities'][1], {'product': 2, 'quantity': 3})
+
+    # Uncached, a cached response costs the same whatever the catalogue
+    @override_settings(INVENTORY_CACHE = {'ENABLED': False})
+    def test_product_capacity_query_count_does_not_depend_on_catalogue(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-product_capacity')
+        # Warm up the store lookup
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(url)
+
+        store = Store.objects.get(pk = 1)
+        material = Material.objects.get(pk = 1)
+        for i in range(3, 10):
+            product = Product.objects.create(name = 'product%d' % i, store = store)
+            MaterialQuantity.objects.create(product = product, material = material, quantity = i)
+
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(url)
+        self.assertEqual(len(small), len(large))
+
+    # bulk_create sends no signal, the products have no row in the table
+    def test_products_without_capacity_row_are_listed(self):
+        # authentication
+        self.force_authentication()
+
+        store = Store.objects.get(pk = 1)
+        Product.objects.bulk_create([Product(name = 'product3', store = store), Product(name = 'product4', store = store)])
+        MaterialQuantity.objects.bulk_create([
+            MaterialQuantity(product_id = 4, material = Material.objects.get(pk = 1), quantity = 25, store = store),
+        ])
+        rebuild_explosions([4])
+        ProductCapacity.objects.filter(product = 4).delete()
+        self.assertEqual(ProductCapacity.objects.filter(product__in = [3, 4]).count(), 0)
+
+        url = reverse('product-product_capacity')
+        response = self.client.get(url)
+        self.assertEqual(response.data['remaining_capacities'], [
+            {'product': 1, 'quantity': 5},
+            {'product': 2, 'quantity': 0},
+            {'product': 3, 'quantity': 0},
+            {'product': 4, 'quantity': 4},
+        ])
+
+    @override_settings(PRODUCT_CAPACITY_ENGINE = 'sql')
+    def test_sql_product_capacity_quantities(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-product_capacity')
+        response = self.client.get(url)
+        self.assertEqual(response.data['remaining_capacities'], [
+            {'product': 1, 'quantity': 5},
+            {'product': 2, 'quantity': 0},
+        ])
+
+        store = Store.objects.get(pk = 1)
+        with self.assertNumQueries(1):
+            sql_capacities(store)
+
+    def test_paginate_product_capacity(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-product_capacity')
+        response = self.client.get(url, {'page_size': 1})
+        self.assertEqual(response.data['remaining_capacities'], [{'product': 1, 'quantity': 5}])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['remaining_capacities'], [{'product': 2, 'quantity': 0}])
+        self.assertIsNone(response.data['next'])
+
+    @override_settings(PRODUCT_CAPACITY_ENGINE = 'matrix')
+    def test_matrix_product_capacity_quantities(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-product_capacity')
+        response = self.client.get(url)
+        self.assertEqual(response.data['remaining_capacities'], [
+            {'product': 1, 'quantity': 5},
+            {'product': 2, 'quantity': 0},
+        ])
+
+class ProductCapacityTableTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username = 'admin', password = 'password')
+        self.store = Store.objects.create(name = 'store1', user = user)
+        product1 = Product.objects.create(name = 'product1', store = self.store)
+        product2 = Product.objects.create(name = 'product2', store = self.store)
+        material1 = Material.objects.create(name = 'material1', price = 12.50, store = self.store, max_capacity = 100, current_capacity = 100)
+        material2 = Material.objects.create(name = 'material2', price = 12.50, store = self.store, max_capacity = 100, current_capacity = 51)
+        MaterialQuantity.objects.create(product = product1, material = material1, quantity = 10)
+        MaterialQuantity.objects.create(product = product1, material = material2, quantity = 6)
+        MaterialQuantity.objects.create(product = product2, material = material2, quantity = 20)
+
+    def capacities(self):
+        return dict(ProductCapacity.objects.values_list('product', 'quantity'))
+
+    def test_table_follows_recipe(self):
+        self.assertEqual(self.capacities(), {1: 8, 2: 2})
+        MaterialQuantity.objects.filter(product = 2).delete()
+        self.assertEqual(self.capacities(), {1: 8, 2: 0})
+
+    def test_table_follows_sale(self):
+        process_sales([{'product': 2, 'quantity': 1}], store = self.store)
+        self.assertEqual(self.capacities(), {1: 5, 2: 1})
+
+    def test_table_follows_material_update(self):
+        material = Material.objects.get(pk = 1)
+        material.current_capacity = 30
+        material.save()
+        self.assertEqual(self.capacities(), {1: 3, 2: 2})
+
+    def test_rebuild_table(self):
+        ProductCapacity.objects.all().delete()
+        Material.objects.filter(pk = 2).update(current_capacity = 40)
+        rebuild_product_capacities()
+        self.assertEqual(self.capacities(), {1: 6, 2: 2})
+
+class BomMatrixTest(TestCase):
+    def test_remaining_capacities(self):
+        rows = [(1, 10, 2), (1, 11, 3), (2, None, None), (3, 11, 0), (4, 10, 50)]
+        matrix = BomMatrix.from_rows(rows, [10, 11])
+        vector = matrix.capacity_vector([(10, 20), (11, 9)])
+        self.assertEqual(list(matrix.product_ids), [1, 2, 3, 4])
+        self.assertEqual(matrix.remaining_capacities(vector), [3, 0, 0, 0])
+
+    def test_matrix_invalidated_during_its_build_is_not_cached(self):
+        cache = BomMatrixCache()
+        user = User.objects.create_user(username = 'user', password = 'password')
+        store = Store.objects.create(name = 'store', user = user)
+
+        # A recipe change lands while the matrix is being read
+        def invalidate(execute, sql, params, many, context):
+            cache.invalidate(store.pk)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(invalidate):
+            stale = cache.get(store.pk)
+        self.assertIsNot(cache.get(store.pk), stale)
+        self.assertIs(cache.get(store.pk), cache.get(store.pk))
+
 class SaleViewTest(APITestCase):
     def setUp(self):
         user = User.objects.create_user(username = 'admin', password = 'password')
@@ -312,4 +506,407 @@ class SaleViewTest(APITestCase):
 
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertIn("error_messages", response.content.decode())
\ No newline at end of file
+        self.assertIn("error_messages", response.content.decode())
+
+    def test_create_sale_with_json_body(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-sale')
+        data = {'sale': [{'product': 1, 'quantity': 4}, {'product': 1, 'quantity': 1}]}
+        response = self.client.post(url, data, format = 'json')
+        self.assertEqual(response.data, {"message": "Sale Successfully"})
+        self.assertEqual(Material.objects.get(pk = 1).current_capacity, 50)
+
+    def test_create_sale_with_json_array_body(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-sale')
+        response = self.client.post(url, [{'product': 1, 'quantity': 5}], format = 'json')
+        self.assertEqual(response.data, {"message": "Sale Successfully"})
+        self.assertEqual(Material.objects.get(pk = 3).current_capacity, 4)
+
+    def test_create_sale_with_malformed_json(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-sale')
+        response = self.client.post(url, '{"sale": [', content_type = 'application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_sale_with_scalar_json_body(self):
+        # authentication
+        self.force_authentication()
+
+        url = reverse('product-sale')
+        for body in ('"x"', '5', 'null'):
+            response = self.client.post(url, body, content_type = 'application/json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class ProcessSalesTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username = 'admin', password = 'password')
+        self.store = Store.objects.create(name = 'store1', user = user)
+        product1 = Product.objects.create(name = 'product1', store = self.store)
+        product2 = Product.objects.create(name = 'product2', store = self.store)
+        material1 = Material.objects.create(name = 'material1', price = 12.50, store = self.store, max_capacity = 100, current_capacity = 100)
+        material2 = Material.objects.create(name = 'material2', price = 12.50, store = self.store, max_capacity = 100, current_capacity = 51)
+        MaterialQuantity.objects.create(product = product1, material = material1, quantity = 10)
+        MaterialQuantity.objects.create(product = product1, material = material2, quantity = 6)
+        MaterialQuantity.objects.create(product = product2, material = material1, quantity = 20)
+
+    def test_merge_demand_of_shared_material(self):
+        process_sales([{'product': 1, 'quantity': 2}, {'product': 2, 'quantity': 3}], store = self.store)
+        self.assertEqual(Material.objects.get(pk = 1).current_capacity, 20)
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 39)
+
+    def test_shared_material_shortage_deducts_nothing(self):
+        # material1 alone could serve each line but not both of them
+        with self.assertRaises(SaleError):
+            process_sales([{'product': 1, 'quantity': 5}, {'product': 2, 'quantity': 3}], store = self.store)
+        self.assertEqual(Material.objects.get(pk = 1).current_capacity, 100)
+        self.assertEqual(Material.objects.get(pk = 2).current_capacity, 51)
+
+    def test_product_of_other_store_is_rejected(self):
+        user = User.objects.create_user(username = 'admin2', password = 'password')
+        store = Store.objects.create(name = 'store2', user = user)
+        with self.assertRaises(SaleError):
+            process_sales([{'product': 1, 'quantity': 1}], store = store)
+
+    def test_query_count_does_not_depend_on_basket_size(self):
+        with CaptureQueriesContext(connection) as small:
+            process_sales([{'product': 1, 'quantity': 1}], store = self.store)
+        with CaptureQueriesContext(connection) as large:
+            process_sales([{'product': 1, 'quantity': 1}, {'product': 2, 'quantity': 1}, {'product': 1, 'quantity': 1}], store = self.store)
+        self.assertEqual(len(small), len(large))
+
+
+class MultiLevelBomTest(APITestCase):
+    def setUp(self):
+        user = User.objects.create_user(username = 'admin', password = 'password')
+        self.store = Store.objects.create(name = 'store1', user = user)
+        # bike <- 2 x wheel <- 3 x spoke, bike <- 1 x frame
+        self.bike = Product.objects.create(name = 'bike', store = self.store)
+        self.wheel = Product.objects.create(name = 'wheel', store = self.store)
+        self.steel = Material.objects.create(name = 'steel', price = 1, store = self.store, max_capacity = 100, current_capacity = 60)
+        self.rubber = Material.objects.create(name = 'rubber', price = 1, store = self.store, max_capacity = 100, current_capacity = 50)
+        self.frame = Material.objects.create(name = 'frame', price = 1, store = self.store, max_capacity = 100, current_capacity = 4)
+        MaterialQuantity.objects.create(product = self.wheel, material = self.steel, quantity = 3)
+        MaterialQuantity.objects.create(product = self.wheel, material = self.rubber, quantity = 1)
+        MaterialQuantity.objects.create(product = self.bike, material = self.frame, quantity = 1)
+        ProductComponent.objects.create(parent = self.bike, component = self.wheel, quantity = 2)
+        self.client.force_authenticate(user = user)
+
+    def exploded(self, product):
+        return dict(ExplodedMaterialQuantity.objects.filter(product = product).values_list('material__name', 'quantity'))
+
+    def capacities(self):
+        return {row['product']: row['quantity'] for row in sql_capacities(self.store)}
+
+    def test_exploded_bom_adds_up_components(self):
+        self.assertEqual(self.exploded(self.wheel), {'steel': 3, 'rubber': 1})
+        self.assertEqual(self.exploded(self.bike), {'steel': 6, 'rubber': 2, 'frame': 1})
+        self.assertEqual(ProductCapacity.objects.get(product = self.bike).quantity, 4)
+        self.assertEqual(ProductCapacity.objects.get(product = self.wheel).quantity, 20)
+
+    def test_sub_recipe_change_rebuilds_ancestors(self):
+        line = MaterialQuantity.objects.get(product = self.wheel, material = self.steel)
+        line.quantity = 10
+        line.save()
+        self.assertEqual(self.exploded(self.bike), {'steel': 20, 'rubber': 2, 'frame': 1})
+        self.assertEqual(ProductCapacity.objects.get(product = self.bike).quantity, 3)
+
+        ProductComponent.objects.get(parent = self.bike).delete()
+        self.assertEqual(self.exploded(self.bike), {'frame': 1})
+
+    def test_failed_delete_does_not_defer_later_rebuilds(self):
+        # The delete fails after pre_delete, like on a locked database
+        def fail(sender, instance, **kwargs):
+            raise DatabaseError("database is locked")
+        pre_delete.connect(fail, sender = Material)
+        try:
+            with self.assertRaises(DatabaseError), transaction.atomic():
+                Material.objects.get(pk = self.frame.pk).delete()
+        finally:
+            pre_delete.disconnect(fail, sender = Material)
+
+        MaterialQuantity.objects.create(product = self.bike, material = self.rubber, quantity = 1)
+        self.assertEqual(self.exploded(self.bike), {'steel': 6, 'rubber': 3, 'frame': 1})
+
+    def test_every_engine_reads_the_exploded_bom(self):
+        expected = {self.bike.pk: 4, self.wheel.pk: 20}
+        self.assertEqual(self.capacities(), expected)
+        for engine in ['table', 'matrix', 'sql']:
+            with self.settings(PRODUCT_CAPACITY_ENGINE = engine):
+                response = self.client.get(reverse('product-product_capacity'))
+            self.assertEqual({row['product']: row['quantity'] for row in response.data['remaining_capacities']}, expected)
+
+    def test_sale_consumes_raw_materials_of_components(self):
+        process_sales([{'product': self.bike.pk, 'quantity': 2}], store = self.store)
+        self.assertEqual(Material.objects.get(pk = self.steel.pk).current_capacity, 48)
+        self.assertEqual(Material.objects.get(pk = self.rubber.pk).current_capacity, 46)
+        self.assertEqual(Material.objects.get(pk = self.frame.pk).current_capacity, 2)
+
+    def test_cycle_is_rejected(self):
+        url = reverse('product_component-list')
+        response = self.client.post(url, {'parent': 'wheel', 'component': 'bike', 'quantity': 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, {'parent': 'bike', 'component': 'bike', 'quantity': 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(ProductComponent.objects.count(), 1)
+
+    def test_create_component_through_api(self):
+        seat = Product.objects.create(name = 'seat', store = self.store)
+        MaterialQuantity.objects.create(product = seat, material = self.rubber, quantity = 5)
+        response = self.client.post(reverse('product_component-list'), {'parent': 'bike', 'component': 'seat', 'quantity': 1})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.exploded(self.bike), {'steel': 6, 'rubber': 7, 'frame': 1})
+
+    def test_deleting_component_or_material_rebuilds_parents(self):
+        self.wheel.delete()
+        self.assertEqual(self.exploded(self.bike), {'frame': 1})
+        self.frame.delete()
+        self.assertEqual(self.exploded(self.bike), {})
+        self.assertEqual(ProductCapacity.objects.get(product = self.bike).quantity, 0)
+        self.bike.delete()
+        self.assertEqual(ExplodedMaterialQuantity.objects.count(), 0)
+
+    def test_rebuild_query_count_does_not_depend_on_depth(self):
+        def chain(depth):
+            products = [Product.objects.create(name = 'level%d-%d' % (depth, i), store = self.store) for i in range(depth)]
+            for parent, component in zip(products, products[1:]):
+                ProductComponent.objects.create(parent = parent, component = component, quantity = 2)
+            MaterialQuantity.objects.create(product = products[-1], material = self.steel, quantity = 1)
+            return products
+
+        shallow = chain(2)
+        deep = chain(8)
+        with CaptureQueriesContext(connection) as small:
+            rebuild_explosions([shallow[-1].pk])
+        with CaptureQueriesContext(connection) as large:
+            rebuild_explosions([deep[-1].pk])
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(self.exploded(deep[0]), {'steel': 2 ** 7})
+
+class ReservationTest(APITestCase):
+    def setUp(self):
+        user = User.objects.create_user(username = 'admin', password = 'password')
+        self.store = Store.objects.create(name = 'store1', user = user)
+        self.product = Product.objects.create(name = 'product1', store = self.store)
+        self.material = Material.objects.create(name = 'material1', price = 1, store = self.store, max_capacity = 100, current_capacity = 50)
+        MaterialQuantity.objects.create(product = self.product, material = self.material, quantity = 5)
+        self.client.force_authenticate(user = user)
+
+    def stock(self):
+        return Material.objects.get(pk = self.material.pk).current_capacity
+
+    def capacity(self):
+        return ProductCapacity.objects.get(product = self.product).quantity
+
+    def reserve(self, quantity, **data):
+        data['sale'] = [{'product': self.product.pk, 'quantity': quantity}]
+        return self.client.post(reverse('reservation-list'), data, format = 'json')
+
+    def test_reserve_holds_stock_and_capacity(self):
+        response = self.reserve(4)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], Reservation.HELD)
+        self.assertEqual(self.stock(), 30)
+        self.assertEqual(self.capacity(), 6)
+        inventory = self.client.get(reverse('material-inventory')).data
+        self.assertEqual(inventory[0]['current_capacity'], 30)
+
+    def test_reserve_more_than_available_fails(self):
+        self.reserve(8)
+        response = self.reserve(3)
+        self.assertEqual(response.data, {"error_messages": "Please enter a valid sale data"})
+        self.assertEqual(self.stock(), 10)
+        self.assertEqual(Reservation.objects.count(), 1)
+
+    def test_commit_keeps_the_stock_deducted(self):
+        reservation = self.reserve(4).data['id']
+        response = self.client.post(reverse('reservation-commit', args = (reservation, )))
+        self.assertEqual(response.data, {"message": "Sale Successfully"})
+        self.assertEqual(self.stock(), 30)
+        # Can't be cancelled or committed twice
+        response = self.client.post(reverse('reservation-cancel', args = (reservation, )))
+        self.assertIn('error_messages', response.data)
+        self.assertEqual(self.stock(), 30)
+
+    def test_cancel_gives_the_stock_back(self):
+        reservation = self.reserve(4).data['id']
+        response = self.client.post(reverse('reservation-cancel', args = (reservation, )))
+        self.assertEqual(response.data, {"message": "Reservation cancelled"})
+        self.assertEqual(self.stock(), 50)
+        self.assertEqual(self.capacity(), 10)
+        self.assertEqual(
+            list(StockMovement.objects.filter(reason__in = [StockMovement.RESERVATION, StockMovement.RELEASE]).values_list('reason', 'delta')),
+            [(StockMovement.RESERVATION, -20), (StockMovement.RELEASE, 20)],
+        )
+
+    @override_settings(RESERVATION_MAX_TTL = 3600)
+    def test_reserve_rejects_a_ttl_out_of_range(self):
+        for ttl in (0, -1, 'soon', 3601, 10 ** 12):
+            response = self.reserve(4, ttl = ttl)
+            self.assertEqual(response.data, {"error_messages": "Please enter a valid ttl"})
+        self.assertFalse(Reservation.objects.exists())
+        self.assertEqual(self.stock(), 50)
+
+        response = self.reserve(4, ttl = 3600)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_expired_reservation_cannot_be_committed(self):
+        reservation = self.reserve(4, ttl = 60).data['id']
+        Reservation.objects.filter(pk = reservation).update(expires_at = timezone.now() - timedelta(seconds = 1))
+        response = self.client.post(reverse('reservation-commit', args = (reservation, )))
+        self.assertIn('error_messages', response.data)
+
+    def test_sweeper_releases_expired_holds_in_batches(self):
+        for _ in range(5):
+            self.reserve(1)
+        kept = self.reserve(1).data['id']
+        Reservation.objects.exclude(pk = kept).update(expires_at = timezone.now() - timedelta(seconds = 1))
+        self.assertEqual(self.stock(), 20)
+
+        self.assertEqual(release_expired(batch_size = 2, now = timezone.now() - timedelta(days = 1)), 0)
+        self.assertEqual(release_expired(batch_size = 2), 5)
+        self.assertEqual(self.stock(), 45)
+        self.assertEqual(Reservation.objects.filter(status = Reservation.EXPIRED).count(), 5)
+        self.assertEqual(Reservation.objects.get(pk = kept).status, Reservation.HELD)
+        self.assertEqual(release_expired(batch_size = 2), 0)
+
+    def test_reserve_with_a_bare_array(self):
+        response = self.client.post(reverse('reservation-list'), [{'product': self.product.pk, 'quantity': 1}], format = 'json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.stock(), 45)
+
+    def test_hold_is_released_after_a_restock_to_max_capacity(self):
+        cancelled = self.reserve(2).data['id']
+        expired = self.reserve(2).data['id']
+        # 30 left, the restock doesn't see the 20 held units
+        response = self.client.post(reverse('material-restock'), {'materials': [{'id': self.material.pk, 'quantity': 70}], 'total_price': 70}, format = 'json')
+        self.assertEqual(response.data, {"message": "Restock successfully"})
+
+        response = self.client.post(reverse('reservation-cancel', args = (cancelled, )))
+        self.assertEqual(response.data, {"message": "Reservation cancelled"})
+        self.assertEqual(self.stock(), 110)
+
+        Reservation.objects.filter(pk = expired).update(expires_at = timezone.now() - timedelta(seconds = 1))
+        self.assertEqual(release_expired(), 1)
+        self.assertEqual(Reservation.objects.get(pk = expired).status, Reservation.EXPIRED)
+        self.assertEqual(self.stock(), 120)
+
+    def test_sweeper_query_count_does_not_depend_on_batch_size(self):
+        for _ in range(6):
+            self.reserve(1)
+        Reservation.objects.update(expires_at = timezone.now() - timedelta(seconds = 1))
+        with CaptureQueriesContext(connection) as queries:
+            release_expired(batch_size = 10)
+        self.reserve(1)
+        Reservation.objects.filter(status = Reservation.HELD).update(expires_at = timezone.now() - timedelta(seconds = 1))
+        with CaptureQueriesContext(connection) as single:
+            release_expired(batch_size = 10)
+        self.assertEqual(len(queries), len(single))
+
+class SaleBatchTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username = 'admin', password = 'password')
+        self.store = Store.objects.create(name = 'store1', user = user)
+        self.product = Product.objects.create(name = 'product1', store = self.store)
+        self.material = Material.objects.create(name = 'material1', price = 1, store = self.store, max_capacity = 100, current_capacity = 50)
+        MaterialQuantity.objects.create(product = self.product, material = self.material, quantity = 10)
+
+    def test_sales_are_settled_in_arrival_order(self):
+        pending = [
+            PendingSale(self.store, {self.product.pk: 2}),
+            PendingSale(self.store, {self.product.pk: 4}),
+            PendingSale(self.store, {self.product.pk + 100: 1}),
+            PendingSale(self.store, {self.product.pk: 3}),
+        ]
+        results = apply_sale_batch(self.store, pending)
+        self.assertEqual([result is None for result in results], [True, False, False, True])
+        self.assertIsInstance(results[1], SaleError)
+        self.assertEqual(Material.objects.get(pk = self.material.pk).current_capacity, 0)
+        # One aggregated movement for the whole batch
+        self.assertEqual(list(StockMovement.objects.filter(reason = StockMovement.SALE).values_list('delta', flat = True)), [-50])
+
+    def test_batch_query_count_does_not_depend_on_batch_size(self):
+        with CaptureQueriesContext(connection) as small:
+            apply_sale_batch(self.store, [PendingSale(self.store, {self.product.pk: 1})])
+        with CaptureQueriesContext(connection) as large:
+            apply_sale_batch(self.store, [PendingSale(self.store, {self.product.pk: 1}) for _ in range(3)])
+        self.assertEqual(len(small), len(large))
+
+class SaleCoalescerTest(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_user(username = 'admin', password = 'password')
+        self.store = Store.objects.create(name = 'store1', user = user)
+        self.product = Product.objects.create(name = 'product1', store = self.store)
+        self.material = Material.objects.create(name = 'material1', price = 1, store = self.store, max_capacity = 100, current_capacity = 50)
+        MaterialQuantity.objects.create(product = self.product, material = self.material, quantity = 1)
+        self.coalescer = SaleCoalescer(max_batch = 20, max_delay = 0.05)
+
+    def tearDown(self):
+        self.coalescer.stop()
+
+    def test_concurrent_sales_are_coalesced(self):
+        results = []
+        def sell():
+            try:
+                self.coalescer.sell([{'product': self.product.pk, 'quantity': 3}], self.store, timeout = 10)
+                results.append(True)
+            except SaleError:
+                results.append(False)
+
+        threads = [threading.Thread(target = sell) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 16 sales of 3 fit in a stock of 50
+        self.assertEqual(results.count(True), 16)
+        self.assertEqual(Material.objects.get(pk = self.material.pk).current_capacity, 2)
+        self.assertLess(StockMovement.objects.filter(reason = StockMovement.SALE).count(), 16)
+
+    def test_invalid_basket_is_rejected_before_queueing(self):
+        with self.assertRaises(SaleError):
+            self.coalescer.submit([{'product': self.product.pk, 'quantity': 0}], self.store)
+        self.assertIsNone(self.coalescer.worker)
+
+    def test_sale_timed_out_in_the_queue_is_never_applied(self):
+        self.coalescer.stop()
+        # The batch waits long after the seller gave up
+        self.coalescer = SaleCoalescer(max_batch = 20, max_delay = 0.5)
+        with self.assertRaises(futures.TimeoutError):
+            self.coalescer.sell([{'product': self.product.pk, 'quantity': 3}], self.store, timeout = 0.01)
+        # The retry
+        self.coalescer.sell([{'product': self.product.pk, 'quantity': 3}], self.store, timeout = 10)
+        self.coalescer.stop()
+        self.assertEqual(Material.objects.get(pk = self.material.pk).current_capacity, 47)
+
+    def test_sale_timed_out_while_applied_is_pending(self):
+        class SlowCoalescer(SaleCoalescer):
+            def apply_sales(self, batch):
+                time.sleep(0.2)
+                super().apply_sales(batch)
+
+        self.coalescer.stop()
+        self.coalescer = SlowCoalescer(max_batch = 20, max_delay = 0)
+        with self.assertRaises(SalePending):
+            self.coalescer.sell([{'product': self.product.pk, 'quantity': 3}], self.store, timeout = 0.05)
+        self.coalescer.stop()
+        self.assertEqual(Material.objects.get(pk = self.material.pk).current_capacity, 47)
+
+    @override_settings(SALE_COALESCING = {'ENABLED': True, 'TIMEOUT': 10})
+    def test_sale_view_goes_through_the_coalescer(self):
+        client = APIClient()
+        client.force_authenticate(user = User.objects.get(username = 'admin'))
+        try:
+            response = client.post(reverse('product-sale'), {'sale': [{'product': self.product.pk, 'quantity': 5}]}, format = 'json')
+            self.assertEqual(response.data, {"message": "Sale Successfully"})
+            self.assertTrue(sale_coalescer.worker.is_alive())
+        finally:
+            sale_coalescer.stop()
+        self.assertEqual(Material.objects.get(pk = self.material.pk).current_capacity, 45)
@@ -1,7 +1,9 @@
 from rest_framework.routers import SimpleRouter
-from .views import ProductViewSet
+from .views import ProductViewSet, ProductComponentViewSet, ReservationViewSet
 
 router = SimpleRouter()
 router.register(r'product', ProductViewSet, basename = 'product')
+router.register(r'product-component', ProductComponentViewSet, basename = 'product_component')
+router.register(r'reservation', ReservationViewSet, basename = 'reservation')
 
 urlpatterns = router.urls
\ No newline at end of file
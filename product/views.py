@@ -1,28 +1,44 @@
-from rest_framework import viewsets
-from rest_framework.authentication import TokenAuthentication
+from concurrent import futures
+
+from rest_framework import viewsets, mixins, serializers
+from store.authentication import CachedTokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import action
-from .models import Product
-from .serializers import ProductSerializer
-from store.models import Store
-from material.models import MaterialQuantity
-import json
-from product.services.sale import process_sales
-
-class ProductViewSet(viewsets.ModelViewSet):
+from .models import Product, ProductComponent, Reservation
+from .serializers import ProductSerializer, ProductListSerializer, ProductComponentSerializer, ReservationSerializer
+from store.mixins import StoreMixin, conditional_inventory
+from inventory_management_api.parsers import parse_items
+from product.services.sale import process_sales, SaleError
+from product.services.coalescer import sale_coalescer, coalescing_settings, SalePending
+from product.services.reservation import reserve, commit_reservation, cancel_reservation, reservation_max_ttl, ReservationError
+from product.services.capacity import product_capacities, paged_capacity_queryset, serialize_capacities
+from product.pagination import CapacityCursorPagination
+
+class ProductViewSet(StoreMixin, viewsets.ModelViewSet):
     serializer_class = ProductSerializer    
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
+    query_budgets = {
+        'list': 2, 'retrieve': 1, 'create': 5, 'update': 3, 'partial_update': 3, 'destroy': 9,
+        'product_capacity': 2, 'sale': 6,
+    }
+
     # Only using user's own products
     def get_queryset(self):
-        store = Store.objects.get(user = self.request.user)
-        return Product.objects.filter(store = store)
+        store = self.get_store()
+        return Product.objects.filter(store = store).select_related('store')
+
+    @conditional_inventory
+    def list(self, request):
+        products = self.get_queryset().values(*ProductListSerializer.values)
+        serializer = ProductListSerializer(products, many = True)
+        return Response(serializer.data)
 
     def create(self, request):
-        store = Store.objects.get(user = request.user)
+        store = self.get_store()
         name = request.data.get('name')
 
         # Check is the product within the store
@@ -36,40 +52,106 @@ class ProductViewSet(viewsets.ModelViewSet):
         return Response(serializer.errors)
 
     @action(detail = False, methods = ['get'], url_path = "product-capacity", url_name = "product_capacity")
+    @conditional_inventory
     def product_capacity(self, request):
-        remaining_capacities = []
-
-        products = self.get_queryset()
-        for product in products:
-            remaining_capacity = {'product': product.id}
-            min_quantity = 99999
-
-            # Find the minimum quantity of the product that can be produced by the material
-            for material in product.material_entries.all():
-                mq = MaterialQuantity.objects.get(material = material, product = product)
-                temp = material.current_capacity // mq.quantity
-                # If there is one material that causes the product cannot be produced
-                if temp == 0:
-                    min_quantity = 0
-                    break
-                
-                # If the current material can only produce a smaller number 
-                # of product than other materials
-                # Then the number of product can be produced must 
-                # be less than or equal to temp
-                if temp < min_quantity:
-                    min_quantity = temp
-
-            remaining_capacity['quantity'] = min_quantity if min_quantity != 99999 else 0
-            remaining_capacities.append(remaining_capacity)
-                
+        store = self.get_store()
+
+        # Paging through the capacities never loads every product in memory
+        paginator = CapacityCursorPagination()
+        page = paginator.paginate_queryset(paged_capacity_queryset(store), request, view = self)
+        if page is not None:
+            return paginator.get_paginated_response(serialize_capacities(page))
+
+        remaining_capacities = self.cached_inventory('product_capacity', lambda: product_capacities(store))
         return Response({"remaining_capacities": remaining_capacities})
 
     @action(detail = False, methods = ["post"])
     def sale(self, request):
-        sales = [json.loads(sale.replace('\'', '\"')) for sale in request.data.getlist('sale')]
-        process_sales(sales)
+        store = self.get_store()
+        sales = parse_items(request.data, 'sale')
+
+        try:
+            if coalescing_settings().get('ENABLED', False):
+                sale_coalescer.sell(sales, store, timeout = coalescing_settings().get('TIMEOUT', 5))
+            else:
+                process_sales(sales, store = store)
+        except SaleError as e:
+            return Response({"error_messages": str(e)})
+        except futures.TimeoutError:
+            # The sale was cancelled before being applied
+            return Response({"error_messages": "Sale timed out, please retry"}, status = status.HTTP_503_SERVICE_UNAVAILABLE)
+        except SalePending:
+            # Not a 5xx: an Idempotency-Key keeps this answer instead of letting a retry sell twice
+            return Response({"message": "Sale is being processed"}, status = status.HTTP_202_ACCEPTED)
+
+        return Response({"message": "Sale Successfully"})
+
+
+class ProductComponentViewSet(StoreMixin, viewsets.ModelViewSet):
+    serializer_class = ProductComponentSerializer
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    query_budgets = {'list': 1, 'retrieve': 1, 'create': 14, 'update': 15, 'partial_update': 13, 'destroy': 10}
+
+    # Only using the components of user's own products
+    def get_queryset(self):
+        store = self.get_store()
+        return ProductComponent.objects.filter(parent__store = store).select_related('parent', 'component').order_by('id')
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['store'] = self.get_store()
+        return context
+
+# Hold the materials of a basket with POST {"sale": [...], "ttl": seconds},
+# then pay with POST reservation/<id>/commit/ or give up with reservation/<id>/cancel/
+class ReservationViewSet(StoreMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    serializer_class = ReservationSerializer
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    query_budgets = {'list': 1, 'retrieve': 1, 'create': 8, 'commit': 1, 'cancel': 8}
+
+    # Only using user's own reservations
+    def get_queryset(self):
+        store = self.get_store()
+        return Reservation.objects.filter(store = store).order_by('id')
+
+    def create(self, request):
+        store = self.get_store()
+        sales = parse_items(request.data, 'sale')
+        # A bare JSON array of items has no ttl
+        ttl = request.data.get('ttl') if isinstance(request.data, dict) else None
+
+        # Check whether the ttl is a number of seconds between 1 and RESERVATION_MAX_TTL
+        if ttl is not None:
+            try:
+                ttl = serializers.IntegerField(min_value = 1, max_value = reservation_max_ttl()).run_validation(ttl)
+            except serializers.ValidationError:
+                return Response({"error_messages": "Please enter a valid ttl"})
+
+        try:
+            reservation = reserve(sales, store, ttl = ttl)
+        except ReservationError as e:
+            return Response({"error_messages": str(e)})
+
+        return Response(ReservationSerializer(reservation).data, status = status.HTTP_201_CREATED)
+
+    @action(detail = True, methods = ['post'])
+    def commit(self, request, pk = None):
+        try:
+            commit_reservation(pk, self.get_store())
+        except ReservationError as e:
+            return Response({"error_messages": str(e)})
 
         return Response({"message": "Sale Successfully"})
 
+    @action(detail = True, methods = ['post'])
+    def cancel(self, request, pk = None):
+        try:
+            cancel_reservation(pk, self.get_store())
+        except ReservationError as e:
+            return Response({"error_messages": str(e)})
 
+        return Response({"message": "Reservation cancelled"})
@@ -0,0 +1,32 @@
+from rest_framework.authentication import TokenAuthentication
+from rest_framework import exceptions
+
+from .services.lookup import remember_store, get_user_store
+from .services.tokens import cached_token, remember_token
+
+# Token authentication that joins the user's store into the token lookup
+class StoreTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        model = self.get_model()
+        try:
+            token = model.objects.select_related('user', 'user__store_entries').get(key = key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+
+        remember_store(token.user.pk, get_user_store(token.user))
+        return (token.user, token)
+
+# Drop-in StoreTokenAuthentication serving token -> user and store from
+# token_cache, only a cache miss reaches the database
+class CachedTokenAuthentication(StoreTokenAuthentication):
+    def authenticate_credentials(self, key):
+        token = cached_token(key)
+        if token is not None:
+            return (token.user, token)
+
+        user, token = super().authenticate_credentials(key)
+        remember_token(token)
+        return (user, token)
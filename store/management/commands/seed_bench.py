@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from store.services.seed import seed_stores
+
+class Command(BaseCommand):
+    help = "Generate stores, products, materials and bills of materials for benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stores', type = int, default = 1)
+        parser.add_argument('--products', type = int, default = 100, help = "Products per store")
+        parser.add_argument('--materials', type = int, default = 100, help = "Materials per store")
+        parser.add_argument('--bom-density', type = float, default = 0.1, help = "Fraction of the materials used by each product")
+        parser.add_argument('--stock', type = int, default = 1000, help = "Initial stock of every material")
+        parser.add_argument('--prefix', default = 'bench', help = "Prefix of the usernames, which must not exist yet")
+        parser.add_argument('--password', default = 'bench')
+        parser.add_argument('--seed', type = int, default = 0, help = "Seed of the random bills of materials")
+
+    def handle(self, *args, **options):
+        seeded = seed_stores(
+            options['stores'], options['products'], options['materials'],
+            bom_density = options['bom_density'], stock = options['stock'],
+            prefix = options['prefix'], password = options['password'], seed = options['seed'],
+        )
+        self.stdout.write("Seeded %d stores with %d products and %d materials each" % (len(seeded), options['products'], options['materials']))
+        for s, entry in enumerate(seeded):
+            self.stdout.write("%s%d token %s" % (options['prefix'], s, entry['token']))
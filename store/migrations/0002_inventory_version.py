@@ -0,0 +1,19 @@
+# Generated by Django 4.1.3 on 2026-10-18 05:29
+
+from django.db import migrations, models
+import store.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='inventory_version',
+            field=models.PositiveBigIntegerField(default=store.models.initial_inventory_version),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.3 on 2026-10-18 07:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_inventory_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='inventory_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,52 @@
+import functools
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .models import Store
+from .services.lookup import get_user_store
+from .services.inventory import cached_inventory, inventory_etag, inventory_state
+
+class StoreMixin:
+    # Store of the authenticated user, resolved once per request
+    def get_store(self):
+        if not hasattr(self, '_store'):
+            self._store = get_user_store(self.request.user)
+
+        if self._store is None:
+            raise Store.DoesNotExist("User doesn't have a store")
+        return self._store
+
+    # Cached response of the store, under the version read by conditional_inventory if any
+    def cached_inventory(self, endpoint, compute):
+        return cached_inventory(self.get_store(), endpoint, compute, version = getattr(self, '_inventory_version', None))
+
+# Conditional GET of a store-scoped read: the ETag and Last-Modified come from
+# the inventory version of the store, so an unchanged poll is answered 304 Not
+# Modified after one primary key lookup, without running the action. Clients
+# revalidate every time (no-cache), shared caches don't keep the responses
+# (private). If-None-Match wins over If-Modified-Since. Last-Modified has a
+# one second resolution, every version bump moves it to a later second (see
+# update_store_versions). The browsable API isn't byte for byte stable and
+# gets no validators.
+def conditional_inventory(method):
+    @functools.wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or request.accepted_renderer.format == 'api':
+            return method(self, request, *args, **kwargs)
+
+        store = self.get_store()
+        version, modified = inventory_state(store)
+        etag = inventory_etag(store, version, request.get_full_path(), request.accepted_media_type)
+        last_modified = int(modified.timestamp())
+
+        response = get_conditional_response(request, etag = etag, last_modified = last_modified)
+        if response is None:
+            self._inventory_version = version
+            response = method(self, request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, private = True, no_cache = True)
+        return response
+    return wrapper
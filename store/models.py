@@ -1,14 +1,44 @@
+import secrets
+
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from product.services.deletion import deletion
 
 User = get_user_model()
 
+# Versions start at random so that a store id reused after a rollback (or
+# another database behind the same cache) doesn't find the cached responses
+# of a previous store
+def initial_inventory_version():
+    return secrets.randbits(62)
+
 class Store(models.Model):
     class Meta:
         db_table = "store"
 
     name = models.CharField(max_length = 40)
     user = models.OneToOneField(User, on_delete = models.CASCADE, related_name = "store_entries")
+    # Bumped once every write to the materials, products, recipes or stock
+    # of the store commits, see store.services.inventory
+    inventory_version = models.PositiveBigIntegerField(default = initial_inventory_version)
+    # Time of the last bump, the Last-Modified of the store's inventory reads
+    inventory_modified = models.DateTimeField(default = timezone.now)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+    # The versions are only written by bump_inventory_versions, saving a store
+    # loaded before a concurrent bump mustn't put its version back
+    def save(self, force_insert = False, force_update = False, using = None, update_fields = None):
+        if not self._state.adding and update_fields is None:
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ('inventory_version', 'inventory_modified')
+            ]
+        super().save(force_insert = force_insert, force_update = force_update, using = using, update_fields = update_fields)
+
+    # Cascades through the materials and products, see product.services.deletion
+    def delete(self, *args, **kwargs):
+        with deletion():
+            return super().delete(*args, **kwargs)
\ No newline at end of file
@@ -0,0 +1,75 @@
+from django.db import connections, models, transaction
+
+from .services.inventory import bump_inventory_versions, bumps_are_skipped, bumps_skipped
+from product.services.deletion import deletion
+
+# QuerySet of the models the inventory responses are computed from: the
+# queryset writes, which send no signal, bump the inventory version of the
+# stores they touch. The model names the path to its store in store_lookup.
+# The write runs in the caller's transaction, or in one of its own under
+# autocommit, whose commit bumps: a new version never comes before its data.
+class InventoryQuerySet(models.QuerySet):
+    # The stores are read before the write, whose filter may not match the
+    # rows afterwards. Without FOR UPDATE, which PostgreSQL refuses with
+    # DISTINCT: the write locks the rows anyway.
+    def bump(self):
+        if not bumps_are_skipped():
+            store_ids = self.order_by().values_list(self.model.store_lookup, flat = True).distinct()
+            store_ids.query.select_for_update = False
+            bump_inventory_versions(set(store_ids))
+
+    # Stores of objects about to be created or updated in bulk
+    def store_ids_of(self, objs):
+        field, _, rest = self.model.store_lookup.partition('__')
+        field = self.model._meta.get_field(field)
+        ids = {getattr(obj, field.attname) for obj in objs}
+        if not rest:
+            return ids
+        return field.related_model._base_manager.filter(pk__in = ids).values(rest)
+
+    def update(self, **kwargs):
+        with transaction.atomic(using = self.db, savepoint = False):
+            self.bump()
+            return super().update(**kwargs)
+
+    def delete(self):
+        with transaction.atomic(using = self.db, savepoint = False):
+            self.bump()
+            with bumps_skipped(), deletion():
+                return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    # One DELETE of the rows, neither collected for the delete signals nor
+    # cascaded: for rows nothing references, whose receivers' work the caller
+    # does once for all of them. The derived table lets MySQL delete from a
+    # table its subquery reads.
+    def delete_rows(self):
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        sql, params = self.order_by().values('pk').query.sql_with_params()
+        with transaction.atomic(using = self.db, savepoint = False), connection.cursor() as cursor:
+            self.bump()
+            cursor.execute('DELETE FROM %s WHERE %s IN (SELECT * FROM (%s) AS doomed)' % (
+                quote(self.model._meta.db_table), quote(self.model._meta.pk.column), sql,
+            ), params)
+            return cursor.rowcount
+
+    delete_rows.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        with transaction.atomic(using = self.db, savepoint = False):
+            if objs:
+                bump_inventory_versions(self.store_ids_of(objs))
+            return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        with transaction.atomic(using = self.db, savepoint = False):
+            if objs:
+                bump_inventory_versions(self.store_ids_of(objs))
+            # Made of update() calls
+            with bumps_skipped():
+                return super().bulk_update(objs, fields, *args, **kwargs)
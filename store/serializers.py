@@ -11,3 +11,13 @@ class StoreSerializer(serializers.ModelSerializer):
         model = Store
         fields = ['id', 'name', 'user']
 
+# Read-only representation of StoreSerializer built from a values() row
+class StoreListSerializer(serializers.BaseSerializer):
+    values = ['id', 'name', 'user__username']
+
+    def to_representation(self, row):
+        return {
+            'id': row['id'],
+            'name': row['name'],
+            'user': row['user__username'],
+        }
@@ -0,0 +1,129 @@
+import functools
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction, DatabaseError
+from django.db.models import F, Q, Value, DateTimeField
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from store.models import Store
+
+logger = logging.getLogger('store.services.inventory')
+
+DEFAULTS = {
+    'ENABLED': True,
+    # Alias of CACHES holding the responses, shared by every worker when it's shared
+    'ALIAS': 'default',
+    # Seconds a response is kept, versions make older ones unreachable anyway
+    'TTL': 300,
+}
+
+def inventory_cache_settings():
+    return {**DEFAULTS, **getattr(settings, 'INVENTORY_CACHE', {})}
+
+state = threading.local()
+
+MISSING = object()
+
+# Bump the inventory version of stores given as ids or as querysets of store
+# ids once the caller's transaction commits, right away under autocommit,
+# in one UPDATE. The querysets are read by that UPDATE, they must still
+# match after the write. The Store rows are written outside the writers'
+# transactions: concurrent writers of a store don't wait on each other for
+# the version, and a new version is never visible before the data that
+# changed. A reader between the commit and the bump caches newer data under
+# the old version, which the bump makes unreachable.
+def bump_inventory_versions(*stores):
+    if bumps_are_skipped():
+        return
+
+    condition = Q()
+    for store_ids in stores:
+        if isinstance(store_ids, (set, list, tuple)):
+            store_ids = [store_id for store_id in store_ids if store_id is not None]
+            if not store_ids:
+                continue
+        condition |= Q(pk__in = store_ids)
+    if condition:
+        transaction.on_commit(functools.partial(bump_stores, condition))
+
+# The write has committed when the bump runs: a failing bump is logged rather
+# than turning the committed write into an error, which a client would retry.
+# The stores keep serving their cached responses until the TTL expires them,
+# and their validators until the next write bumps.
+def bump_stores(condition):
+    try:
+        update_store_versions(condition)
+    except DatabaseError:
+        logger.exception("Inventory version bump failed")
+
+# Every bump moves inventory_modified into a later second, Last-Modified has a
+# one second resolution and must tell every version apart from the previous one
+def update_store_versions(condition):
+    Store.objects.filter(condition).update(
+        inventory_version = F('inventory_version') + 1,
+        inventory_modified = Greatest(
+            Value(timezone.now(), output_field = DateTimeField()),
+            F('inventory_modified') + timedelta(seconds = 1),
+        ),
+    )
+
+def bumps_are_skipped():
+    return getattr(state, 'skipped', 0) > 0
+
+# Writes inside the block don't bump, the caller bumps once for all of them
+@contextmanager
+def bumps_skipped():
+    state.skipped = getattr(state, 'skipped', 0) + 1
+    try:
+        yield
+    finally:
+        state.skipped -= 1
+
+def inventory_version(store):
+    return Store.objects.filter(pk = store.pk).values_list('inventory_version', flat = True).first()
+
+# (version, modified) of the store in one primary key lookup
+def inventory_state(store):
+    return Store.objects.filter(pk = store.pk).values_list('inventory_version', 'inventory_modified').first()
+
+# Strong validator of a store-scoped read: the version of the store, the path
+# and query string (pages, filters) and the media type make the body
+def inventory_etag(store, version, path, media_type):
+    key = '%d:%d:%s:%s' % (store.pk, version, path, media_type)
+    return '"%s"' % hashlib.blake2b(key.encode(), digest_size = 16).hexdigest()
+
+def record_cache_request(endpoint, result):
+    from monitoring.metrics import registry
+    registry.inc('inventory_cache_requests_total', (('endpoint', endpoint), ('result', result)))
+
+# Read-through cache of a store's inventory response: compute() runs on a
+# miss and its (picklable) result is kept under the current version of the
+# store, so any write to the store makes it unreachable. The version is read
+# before compute() runs: a response computed from newer data than its
+# version is only ever served until the next version. A caller that already
+# read the version passes it.
+def cached_inventory(store, endpoint, compute, version = None):
+    options = inventory_cache_settings()
+    if not options['ENABLED']:
+        return compute()
+
+    if version is None:
+        version = inventory_version(store)
+    cache = caches[options['ALIAS']]
+    key = 'inventory:%d:%d:%s' % (store.pk, version, endpoint)
+    data = cache.get(key, MISSING)
+    if data is not MISSING:
+        record_cache_request(endpoint, 'hit')
+        return data
+
+    record_cache_request(endpoint, 'miss')
+    data = compute()
+    cache.set(key, data, options['TTL'])
+    return data
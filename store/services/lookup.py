@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from inventory_management_api.cache import TTLCache
+from store.models import Store
+
+User = get_user_model()
+
+STORE_CACHE = getattr(settings, 'STORE_CACHE', {})
+
+# user id -> (id, name) of the user's store, or None when the user has no store.
+# Store signals only reach the current process, the TTL bounds staleness elsewhere.
+store_cache = TTLCache(maxsize = STORE_CACHE.get('MAXSIZE', 10000), ttl = STORE_CACHE.get('TTL', 300))
+
+MISSING = object()
+
+def remember_store(user_id, store):
+    store_cache.set(user_id, (store.pk, store.name) if store is not None else None)
+
+def forget_store(user_id):
+    store_cache.delete(user_id)
+
+# Store of the user: from the token lookup when the authentication joined it,
+# then from the cache, then from the database
+def get_user_store(user):
+    if User.store_entries.related.is_cached(user):
+        return getattr(user, 'store_entries', None)
+
+    cached = store_cache.get(user.pk, MISSING)
+    if cached is MISSING:
+        store = Store.objects.filter(user_id = user.pk).first()
+        remember_store(user.pk, store)
+        return store
+
+    if cached is None:
+        return None
+
+    store_id, name = cached
+    store = Store(id = store_id, name = name, user_id = user.pk)
+    store._state.adding = False
+    return store
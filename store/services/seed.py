@@ -0,0 +1,63 @@
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from rest_framework.authtoken.models import Token
+
+from store.models import Store
+from product.models import Product
+from material.models import Material, StockMovement
+from material.services.ledger import record_movements
+from material.services.recipes import upsert_recipes
+
+User = get_user_model()
+
+# Generate stores x products x materials with bulk_create. Every product uses
+# bom_density of the materials of its store, 1 to 3 units each. Every user
+# gets the given password and a token. Returns one
+# {'store', 'token', 'products', 'materials'} dict per store.
+def seed_stores(stores, products, materials, bom_density = 0.1, stock = 1000, prefix = 'bench', password = 'bench', seed = 0):
+    rng = random.Random(seed)
+    recipe_size = min(materials, max(1, round(bom_density * materials)))
+    password = make_password(password)
+
+    users = User.objects.bulk_create(
+        User(username = '%s%d' % (prefix, s), password = password) for s in range(stores)
+    )
+    # SQLite and PostgreSQL return the primary keys, fetch them for the other databases
+    if users and users[0].pk is None:
+        users = list(User.objects.filter(username__in = [user.username for user in users]).order_by('id'))
+    Store.objects.bulk_create(Store(name = user.username, user_id = user.pk) for user in users)
+    store_entries = list(Store.objects.filter(user__in = [user.pk for user in users]).order_by('id'))
+    tokens = Token.objects.bulk_create(Token(key = Token.generate_key(), user_id = user.pk) for user in users)
+
+    Material.objects.bulk_create(
+        Material(name = 'material%d' % i, store = store, price = rng.randint(1, 100), max_capacity = 32767, current_capacity = stock)
+        for store in store_entries
+        for i in range(materials)
+    )
+    Product.objects.bulk_create(
+        Product(name = 'product%d' % i, store = store)
+        for store in store_entries
+        for i in range(products)
+    )
+
+    material_ids = {store.pk: [] for store in store_entries}
+    for material_id, store_id in Material.objects.filter(store__in = store_entries).order_by('id').values_list('id', 'store_id'):
+        material_ids[store_id].append(material_id)
+    product_ids = {store.pk: [] for store in store_entries}
+    for product_id, store_id in Product.objects.filter(store__in = store_entries).order_by('id').values_list('id', 'store_id'):
+        product_ids[store_id].append(product_id)
+
+    # The stock of bulk created materials isn't recorded by the post_save signal
+    record_movements({material_id: stock for ids in material_ids.values() for material_id in ids if stock}, StockMovement.ADJUSTMENT)
+    upsert_recipes({
+        product_id: {material_id: rng.randint(1, 3) for material_id in rng.sample(material_ids[store_id], recipe_size)}
+        for store_id, ids in product_ids.items() if material_ids[store_id]
+        for product_id in ids
+    })
+
+    return [
+        {'store': store.pk, 'token': token.key, 'products': product_ids[store.pk], 'materials': material_ids[store.pk]}
+        for store, token in zip(store_entries, tokens)
+    ]
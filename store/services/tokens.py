@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.authtoken.models import Token
+
+from inventory_management_api.cache import build_cache
+from store.models import Store
+
+User = get_user_model()
+
+# token key -> fields of the token, its user and the user's store.
+# 'local' keeps a per-process LRU, 'django' shares a Django cache alias
+# across processes. Signals evict the entries of their own process only:
+# with 'local' the TTL is how long other workers may still accept a deleted
+# token or a deactivated user, keep it to a few seconds.
+token_cache = build_cache(getattr(settings, 'TOKEN_AUTH_CACHE', {}), prefix = 'auth-token:')
+
+# The password hash never leaves the database
+USER_FIELDS = [field.attname for field in User._meta.concrete_fields if field.attname != 'password']
+STORE_FIELDS = ['id', 'name', 'user_id']
+
+def remember_token(token):
+    user = token.user
+    store = getattr(user, 'store_entries', None)
+    token_cache.set(token.key, {
+        'created': token.created,
+        'user': {attname: getattr(user, attname) for attname in USER_FIELDS},
+        'store': (store.pk, store.name) if store is not None else None,
+    })
+
+# Rebuild the token, its user and the user's store from a cache entry without
+# any query. The fields left out of the entry (the password, the inventory
+# versions) are deferred like with only(): read from the database when
+# accessed and left alone by save().
+def cached_token(key):
+    entry = token_cache.get(key)
+    if entry is None:
+        return None
+
+    user = User.from_db(DEFAULT_DB_ALIAS, USER_FIELDS, [entry['user'][attname] for attname in USER_FIELDS])
+    store = None
+    if entry['store'] is not None:
+        store_id, name = entry['store']
+        store = Store.from_db(DEFAULT_DB_ALIAS, STORE_FIELDS, [store_id, name, user.pk])
+        Store.user.field.set_cached_value(store, user)
+    User.store_entries.related.set_cached_value(user, store)
+
+    token = Token(key = key, user = user, created = entry['created'])
+    token._state.adding = False
+    return token
+
+def forget_token(key):
+    token_cache.delete(key)
+
+def forget_user_tokens(user_id):
+    for key in Token.objects.filter(user_id = user_id).values_list('key', flat = True):
+        forget_token(key)
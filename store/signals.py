@@ -0,0 +1,69 @@
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from django.contrib.auth import get_user_model
+from rest_framework.authtoken.models import Token
+
+from material.models import Material, MaterialQuantity
+from product.models import Product, ProductComponent
+from product.services.deletion import being_deleted
+from .models import Store
+from .services.inventory import bump_inventory_versions
+from .services.lookup import forget_store
+from .services.tokens import forget_token, forget_user_tokens
+
+User = get_user_model()
+
+@receiver(post_save, sender = Store)
+@receiver(post_delete, sender = Store)
+def forget_user_store(sender, instance, **kwargs):
+    forget_store(instance.user_id)
+    forget_user_tokens(instance.user_id)
+
+# Deactivated users drop out of the token cache with their store
+@receiver(post_save, sender = User)
+@receiver(post_delete, sender = User)
+def forget_store_of_user(sender, instance, **kwargs):
+    forget_store(instance.pk)
+    forget_user_tokens(instance.pk)
+
+# Deleted or rotated tokens
+@receiver(post_save, sender = Token)
+@receiver(post_delete, sender = Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    forget_token(instance.key)
+
+# Model.save() and delete() of the inventory models bump the version of the
+# store, the rows deleted along with their product, material or store don't
+@receiver(pre_delete, sender = Store)
+def start_store_delete(sender, instance, **kwargs):
+    being_deleted('store').add(instance.pk)
+
+@receiver(post_delete, sender = Store)
+def end_store_delete(sender, instance, **kwargs):
+    being_deleted('store').discard(instance.pk)
+
+# The material and product lists show the name of the store
+@receiver(post_save, sender = Store)
+def bump_renamed_store(sender, instance, created, **kwargs):
+    if not created:
+        bump_inventory_versions([instance.pk])
+
+@receiver(post_save, sender = Material)
+@receiver(post_delete, sender = Material)
+@receiver(post_save, sender = Product)
+@receiver(post_delete, sender = Product)
+def bump_store_inventory(sender, instance, **kwargs):
+    if instance.store_id not in being_deleted('store'):
+        bump_inventory_versions([instance.store_id])
+
+@receiver(post_save, sender = MaterialQuantity)
+@receiver(post_delete, sender = MaterialQuantity)
+def bump_recipe_inventory(sender, instance, **kwargs):
+    if instance.product_id not in being_deleted('product') and instance.material_id not in being_deleted('material'):
+        bump_inventory_versions(Product.objects.filter(pk = instance.product_id).values('store'))
+
+@receiver(post_save, sender = ProductComponent)
+@receiver(post_delete, sender = ProductComponent)
+def bump_component_inventory(sender, instance, **kwargs):
+    if instance.parent_id not in being_deleted('product') and instance.component_id not in being_deleted('product'):
+        bump_inventory_versions(Product.objects.filter(pk = instance.parent_id).values('store'))
@@ -1,11 +1,24 @@
-from django.test import TestCase
-from rest_framework.test import APITestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from django.contrib.auth import get_user_model
 from .models import Store
-from django.db import IntegrityError
+from unittest import mock
+
+from django.db import IntegrityError, OperationalError, connection
+from django.test.utils import CaptureQueriesContext
 from .serializers import StoreSerializer
+from .services.lookup import get_user_store, store_cache
+from .services.tokens import token_cache, cached_token
+from .services.inventory import bump_inventory_versions, bumps_skipped, cached_inventory, inventory_cache_settings
+from django.core.cache import caches
+from material.models import Material, MaterialQuantity
+from product.models import Product
+from monitoring.metrics import registry
+from rest_framework.authtoken.models import Token
 from django.urls import reverse
+from django.db.models import F
+from django.utils.http import parse_http_date
 
 User = get_user_model()
 
@@ -77,6 +90,18 @@ class StoreViewTest(APITestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_list_store_matches_store_serializer(self):
+        # authentication
+        self.force_authentication()
+
+        user = User.objects.get(pk = 1)
+        self.create_store('store1', user)
+
+        url = reverse('store-list')
+        response = self.client.get(url)
+        expected = StoreSerializer(Store.objects.all(), many = True).data
+        self.assertEqual(response.json(), [dict(store) for store in expected])
+
     def test_create_store(self):
         # authentication
         self.force_authentication()
@@ -133,4 +158,291 @@ class StoreViewTest(APITestCase):
         url = reverse('store-detail', args = (1, ))
         response = self.client.delete(url)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
-        self.assertEqual(Store.objects.count(), 0)
\ No newline at end of file
+        self.assertEqual(Store.objects.count(), 0)
+
+class StoreLookupCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username = "admin", password = 'password123')
+        store_cache.clear()
+
+    def test_store_is_cached_after_first_lookup(self):
+        store = Store.objects.create(name = "store1", user = self.user)
+        get_user_store(User.objects.get(pk = self.user.pk))
+        user = User.objects.get(pk = self.user.pk)
+        with self.assertNumQueries(0):
+            cached = get_user_store(user)
+        self.assertEqual(cached.pk, store.pk)
+        self.assertEqual(cached.name, 'store1')
+
+    def test_cache_is_invalidated_on_store_create_and_delete(self):
+        user = User.objects.get(pk = self.user.pk)
+        self.assertIsNone(get_user_store(user))
+        store = Store.objects.create(name = "store1", user = self.user)
+        self.assertEqual(get_user_store(User.objects.get(pk = self.user.pk)).pk, store.pk)
+        store.delete()
+        self.assertIsNone(get_user_store(User.objects.get(pk = self.user.pk)))
+
+class CachedTokenAuthenticationTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username = "admin", password = 'password123')
+        Store.objects.create(name = "store1", user = self.user)
+        self.token = Token.objects.create(user = self.user)
+        token_cache.clear()
+        store_cache.clear()
+
+    def get_store_list(self, key = None):
+        self.client.credentials(HTTP_AUTHORIZATION = 'Token ' + (key or self.token.key))
+        return self.client.get(reverse('store-list'))
+
+    def test_cached_token_skips_auth_queries(self):
+        self.get_store_list()
+        # Only the store list itself is queried once the token is cached
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_store_list()
+        self.assertFalse([query for query in queries if 'authtoken_token' in query['sql']])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['name'], 'store1')
+
+    def test_deleted_token_is_rejected(self):
+        self.get_store_list()
+        key = self.token.key
+        self.token.delete()
+        response = self.get_store_list(key)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_is_rejected(self):
+        self.get_store_list()
+        self.user.is_active = False
+        self.user.save()
+        response = self.get_store_list()
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_saving_a_cached_user_keeps_its_password(self):
+        self.get_store_list()
+        user = cached_token(self.token.key).user
+        user.first_name = 'admin'
+        user.save()
+        user = User.objects.get(pk = self.user.pk)
+        self.assertEqual(user.first_name, 'admin')
+        self.assertTrue(user.check_password('password123'))
+
+    def test_deleted_store_is_not_served_from_cache(self):
+        self.get_store_list()
+        Store.objects.get(user = self.user).delete()
+        response = self.client.post(reverse('store-list'), {'name': 'store2'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+class InventoryCacheTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username = "admin", password = 'password123')
+        self.store = Store.objects.create(name = "store1", user = self.user)
+        Material.objects.create(name = 'material1', store = self.store, price = 1, max_capacity = 100, current_capacity = 10)
+        caches[inventory_cache_settings()['ALIAS']].clear()
+        self.client.force_authenticate(user = self.user)
+
+    def version(self):
+        return Store.objects.get(pk = self.store.pk).inventory_version
+
+    def cache_requests(self, result):
+        return registry.collect().counters.get(('inventory_cache_requests_total', (('endpoint', 'inventory'), ('result', result))), 0)
+
+    def test_inventory_is_served_from_cache_until_a_write(self):
+        url = reverse('material-inventory')
+        self.client.get(url)
+        # Only the version is read
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 1)
+        self.assertIn('inventory_version', statements[0])
+        self.assertEqual(response.data[0]['max_capacity'], 100)
+
+        material = Material.objects.get(pk = 1)
+        material.max_capacity = 50
+        with self.captureOnCommitCallbacks(execute = True):
+            material.save()
+        response = self.client.get(url)
+        self.assertEqual(response.data[0]['max_capacity'], 50)
+
+    def test_cache_hits_and_misses_are_counted(self):
+        hits, misses = self.cache_requests('hit'), self.cache_requests('miss')
+        url = reverse('material-inventory')
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(self.cache_requests('hit'), hits + 1)
+        self.assertEqual(self.cache_requests('miss'), misses + 1)
+
+    def test_queryset_writes_bump_the_version(self):
+        version = self.version()
+        with self.captureOnCommitCallbacks(execute = True):
+            Material.objects.filter(store = self.store).update(current_capacity = F('current_capacity') + 1)
+        self.assertEqual(self.version(), version + 1)
+        with self.captureOnCommitCallbacks(execute = True):
+            Material.objects.bulk_create([Material(name = 'material2', store = self.store, price = 1)])
+        self.assertEqual(self.version(), version + 2)
+        with self.captureOnCommitCallbacks(execute = True):
+            Material.objects.filter(name = 'material2').delete()
+        self.assertEqual(self.version(), version + 3)
+
+    def test_writes_inside_bumps_skipped_bump_once(self):
+        version = self.version()
+        with self.captureOnCommitCallbacks(execute = True):
+            with bumps_skipped():
+                Material.objects.filter(store = self.store).update(current_capacity = 1)
+                Material.objects.create(name = 'material2', store = self.store, price = 1)
+            bump_inventory_versions([self.store.pk])
+        self.assertEqual(self.version(), version + 1)
+
+    # The version changes once the write commits, not while it's open
+    def test_version_is_bumped_on_commit(self):
+        version = self.version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            Material.objects.filter(store = self.store).update(current_capacity = 1)
+            self.assertEqual(self.version(), version)
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEqual(self.version(), version + 1)
+
+    @override_settings(INVENTORY_CACHE = {'ENABLED': False})
+    def test_disabled_cache_computes_every_time(self):
+        self.assertEqual(cached_inventory(self.store, 'test', lambda: 1), 1)
+        self.assertEqual(cached_inventory(self.store, 'test', lambda: 2), 2)
+
+# Queryset writes outside any transaction
+class AutocommitBumpTest(TransactionTestCase):
+    def test_failed_write_does_not_bump(self):
+        user = User.objects.create_user(username = "admin", password = 'password123')
+        store = Store.objects.create(name = "store1", user = user)
+        Material.objects.create(name = 'material1', store = store, price = 1)
+        version = Store.objects.get(pk = store.pk).inventory_version
+
+        with self.assertRaises(IntegrityError):
+            Material.objects.bulk_create([Material(name = 'material1', store = store, price = 1)])
+        self.assertEqual(Store.objects.get(pk = store.pk).inventory_version, version)
+
+    # The sale has committed when its bump fails: it succeeds, and its retry
+    # is replayed rather than selling again
+    def test_failed_bump_does_not_fail_the_committed_write(self):
+        user = User.objects.create_user(username = "admin", password = 'password123')
+        store = Store.objects.create(name = "store1", user = user)
+        product = Product.objects.create(name = 'product1', store = store)
+        material = Material.objects.create(name = 'material1', store = store, price = 1, max_capacity = 100, current_capacity = 50)
+        MaterialQuantity.objects.create(product = product, material = material, quantity = 5)
+        client = APIClient()
+        client.force_authenticate(user = user)
+        data = {'sale': [{'product': product.pk, 'quantity': 1}]}
+
+        failure = OperationalError('database is locked')
+        with mock.patch('store.services.inventory.update_store_versions', side_effect = failure), \
+                self.assertLogs('store.services.inventory', 'ERROR'):
+            responses = [
+                client.post(reverse('product-sale'), data, format = 'json', HTTP_IDEMPOTENCY_KEY = 'key-1')
+                for _ in range(2)
+            ]
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[1]['Idempotent-Replayed'], 'true')
+        self.assertEqual(Material.objects.get(pk = material.pk).current_capacity, 45)
+
+class ConditionalInventoryTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username = "admin", password = 'password123')
+        self.store = Store.objects.create(name = "store1", user = self.user)
+        Material.objects.create(name = 'material1', store = self.store, price = 1, max_capacity = 100, current_capacity = 10)
+        self.client.force_authenticate(user = self.user)
+
+    def test_unchanged_poll_is_not_modified_after_one_lookup(self):
+        for name in ('material-list', 'material-inventory', 'material-restock', 'product-list', 'product-product_capacity', 'material_quantity-list'):
+            url = reverse(name)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn('Last-Modified', response)
+            self.assertIn('private', response['Cache-Control'])
+
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH = response['ETag'])
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(len([query for query in queries if 'SAVEPOINT' not in query['sql']]), 1)
+
+    def test_write_changes_the_etag(self):
+        url = reverse('material-inventory')
+        etag = self.client.get(url)['ETag']
+        material = Material.objects.get(pk = 1)
+        material.max_capacity = 50
+        with self.captureOnCommitCallbacks(execute = True):
+            material.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data[0]['max_capacity'], 50)
+
+    def test_store_rename_changes_the_etag(self):
+        url = reverse('material-list')
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute = True):
+            response = self.client.put(reverse('store-detail', args = (self.user.pk, )), {'name': 'renamed'})
+        self.assertEqual(response.data['name'], 'renamed')
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['store'], 'renamed')
+
+    def test_saving_a_stale_store_keeps_the_version(self):
+        store = Store.objects.get(pk = self.store.pk)
+        with self.captureOnCommitCallbacks(execute = True):
+            Material.objects.create(name = 'material2', store = self.store, price = 1)
+        version = Store.objects.get(pk = self.store.pk).inventory_version
+        store.name = 'renamed'
+        with self.captureOnCommitCallbacks(execute = True):
+            store.save()
+        self.assertEqual(Store.objects.get(pk = self.store.pk).inventory_version, version + 1)
+
+    def test_etag_depends_on_the_query_string(self):
+        url = reverse('material_quantity-list')
+        self.assertNotEqual(self.client.get(url)['ETag'], self.client.get(url, {'product': 'product1'})['ETag'])
+
+    def test_if_modified_since(self):
+        url = reverse('product-list')
+        response = self.client.get(url)
+        last_modified = response['Last-Modified']
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE = last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # A write in the same second still moves Last-Modified to a later second
+        with self.captureOnCommitCallbacks(execute = True):
+            Material.objects.create(name = 'material2', store = self.store, price = 1)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE = last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(parse_http_date(response['Last-Modified']), parse_http_date(last_modified))
+
+    def test_browsable_api_has_no_validators(self):
+        response = self.client.get(reverse('material-list'), HTTP_ACCEPT = 'text/html')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('ETag', response)
+
+class SeedBenchTest(APITestCase):
+    def test_seed_bench_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from material.models import Material, MaterialQuantity
+        from material.services.ledger import stock_balances
+        from product.models import Product, ProductCapacity
+
+        out = StringIO()
+        call_command('seed_bench', stores = 2, products = 5, materials = 10, bom_density = 0.2, stock = 50, stdout = out)
+        self.assertIn("Seeded 2 stores with 5 products and 10 materials each", out.getvalue())
+
+        self.assertEqual(Store.objects.count(), 2)
+        self.assertEqual(Material.objects.count(), 20)
+        self.assertEqual(Product.objects.count(), 10)
+        # 2 materials of the own store per product
+        self.assertEqual(MaterialQuantity.objects.count(), 20)
+        self.assertFalse(MaterialQuantity.objects.exclude(material__store = F('product__store')).exists())
+        self.assertEqual(set(stock_balances().values()), {50})
+        self.assertEqual(ProductCapacity.objects.count(), 10)
+
+        # The seeded users can use the API with their token
+        token = out.getvalue().split()[-1]
+        self.client.credentials(HTTP_AUTHORIZATION = 'Token %s' % token)
+        response = self.client.get(reverse('material-list'))
+        self.assertEqual(len(response.data), 10)
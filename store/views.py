@@ -2,23 +2,37 @@ from django.shortcuts import render
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.authentication import TokenAuthentication
+from .authentication import CachedTokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from .models import Store
-from .serializers import StoreSerializer
+from .serializers import StoreSerializer, StoreListSerializer
+from .services.lookup import get_user_store
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from material.services.recipes import delete_store_recipes
+from .services.inventory import bumps_skipped
 
 User = get_user_model()
 
 class StoreViewSet(ModelViewSet):
     queryset = Store.objects.all()
     serializer_class = StoreSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
+    query_budgets = {'list': 1, 'retrieve': 1, 'create': 2, 'update': 6, 'partial_update': 7, 'destroy': 25}
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('user')
+
+    def list(self, request):
+        stores = self.get_queryset().values(*StoreListSerializer.values)
+        serializer = StoreListSerializer(stores, many = True)
+        return Response(serializer.data)
+
     def create(self, request):
         # Check whether user has already created store
-        if hasattr(User.objects.get(username = request.user), 'store_entries'):
+        if get_user_store(request.user) is not None:
             return Response({'error_messages': "User already created a store!"})
        
         serializer = self.get_serializer(data = request.data)
@@ -35,7 +49,10 @@ class StoreViewSet(ModelViewSet):
 
         if request.user == user:
             store = Store.objects.get(user = user)
-            store.delete()
+            # The versions of a deleted store aren't read anymore
+            with transaction.atomic(), bumps_skipped():
+                delete_store_recipes(store)
+                store.delete()
             return Response({"messages": "Store deleted!"}, status = status.HTTP_204_NO_CONTENT)
         
         return Response({"error_messages": "Invalid User"})